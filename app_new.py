@@ -1,56 +1,143 @@
 #!/usr/bin/env python3
 """
 API REST NUEVA - Implementación simplificada desde cero
+
+Despliegue recomendado (muchos clientes haciendo polling de /batch-status):
+    pip install gunicorn gevent
+    GEVENT=1 gunicorn -k gevent -w 4 --worker-connections 2000 app_new:app
+
+`python app_new.py` sirve con waitress si está instalado (servidor de desarrollo solo con DEBUG=True)
 """
 import os
+
+# Con GEVENT=1 los sockets se vuelven cooperativos: cada petición es un greenlet,
+# no un hilo del servidor. Debe ejecutarse antes de importar threading/requests.
+if os.getenv('GEVENT') == '1':
+    from gevent import monkey
+    monkey.patch_all()
+
 import json
+import logging
+import mimetypes
+import re
 import uuid
 import random
-import copy
+import secrets
 import time
 import shutil
 import threading
 import concurrent.futures
-import stat
+import queue
 from datetime import datetime
 from io import BytesIO
+from urllib.parse import quote
+from collections import OrderedDict
+from functools import lru_cache
+from operator import itemgetter
+from dataclasses import dataclass, field
+
+try:
+    import fcntl
+except ImportError:  # Windows: sin ioctl, stage_output salta directamente a las copias
+    fcntl = None
+
+try:
+    import orjson  # Opcional: serialización JSON en C para /batch-status
+except ImportError:
+    orjson = None
+
+try:
+    import websocket  # websocket-client: eventos de ejecución de ComfyUI sin polling
+except ImportError:
+    websocket = None
 
-from flask import Flask, request, jsonify, send_file
+from flask import Flask, request, jsonify, send_file, Response
 from flask_cors import CORS
 from PIL import Image
 import requests
+from requests.adapters import HTTPAdapter
 from werkzeug.utils import secure_filename
 
 # Importar configuración de estilos
-from style_presets import get_available_styles, apply_style_to_workflow, get_workflow_nodes_for_style
+from style_presets import (
+    get_available_styles, apply_style_to_workflow, get_workflow_nodes_for_style,
+    style_forces_text2img, get_style_prompt, get_style_negative_prompt
+)
 
 # Importar sistema de persistencia de sesión
 from job_persistence import session_manager
 
+# Importar tracking en memoria de batches (módulo compilable con mypyc)
+from batch_tracking import (
+    BatchInfo, get_active_batch, find_batch, batch_snapshot, register_batch, set_batch_fields, set_current_op,
+    wait_batch_change, snapshot_active_batches, remove_batch, retire_batch, record_batch_result, start_batch_drainer, stop_batch_drainer
+)
+
 # Importar sistema de cancelación de trabajos ComfyUI
 from comfyui_cancel import cancel_all_comfyui_jobs, get_comfyui_queue_status, cancel_specific_comfyui_job
 
 # Configuración básica
-app = Flask(__name__)
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+STATIC_DIR = os.path.join(BASE_DIR, 'static')  # Clientes web (HTML estático)
+CLIENT_MAX_AGE = 86400  # Cache del navegador para el cliente web (1 día)
+
+# static/ se monta bajo /static (con ETag y Cache-Control); los clientes web tienen sus propias rutas
+app = Flask(__name__, static_folder=STATIC_DIR, static_url_path='/static')
+app.config['SEND_FILE_MAX_AGE_DEFAULT'] = CLIENT_MAX_AGE
 CORS(app)
 
 # URLs y directorios
 COMFYUI_HOST = os.getenv('COMFYUI_HOST', 'localhost')
 COMFYUI_PORT = os.getenv('COMFYUI_PORT', '8188')
 COMFYUI_URL = f"http://{COMFYUI_HOST}:{COMFYUI_PORT}"
+COMFYUI_WS_URL = f"ws://{COMFYUI_HOST}:{COMFYUI_PORT}/ws"
+
+# Sesión HTTP compartida con ComfyUI: conexiones keep-alive reutilizadas por todos los hilos
+COMFYUI_SESSION = requests.Session()
+COMFYUI_SESSION.mount("http://", HTTPAdapter(pool_connections=32, pool_maxsize=64, max_retries=0))
+WS_SAFETY_SWEEP_INTERVAL = 30  # Segundos entre barridos de /history por si se perdió algún evento del WebSocket
+WS_RECONNECT_DELAY = 5  # Segundos entre reintentos del WebSocket de fondo
 
-# Sistema de tracking de batches en progreso
-ACTIVE_BATCHES = {}  # batch_id -> batch_info
-BATCH_LOCK = threading.Lock()
+# Eventos de ejecución de ComfyUI para wait_for_completion (un único WebSocket de fondo por proceso)
+COMFYUI_CLIENT_ID = str(uuid.uuid4())  # clientId de los prompts individuales: ComfyUI le envía sus eventos
+COMPLETION_LOCK = threading.Lock()
+PENDING_COMPLETIONS = {}  # prompt_id -> threading.Event
+COMPLETION_RESULTS = {}  # prompt_id -> (error o None, outputs recibidos por el WebSocket o None)
+EARLY_COMPLETIONS = {}  # prompt_id -> (error, outputs): completions recibidas antes de registrar la espera
+MAX_EARLY_COMPLETIONS = 1000
+COMFYUI_LISTENER = None
+
+# ioctl de Linux para clonar un archivo completo (reflink) - ver stage_output
+FICLONE = 0x40049409
 
 # Sistema de control de throttling para batches
-BATCH_THROTTLE_LOCK = threading.Lock()
-LAST_BATCH_SUBMIT_TIME = 0
+# Tiempos en reloj monotónico (time.monotonic): inmunes a ajustes del reloj del sistema
+BATCH_THROTTLE_LOCK = threading.Lock()  # Solo protege la reserva del turno, nunca una espera
+LAST_BATCH_SUBMIT_TIME = 0  # Instante (monotónico) de envío del último lote, o el reservado si aún espera
 BATCH_PROMPT_SEND_DELAY = 0  # Sin delay entre prompts del mismo lote
 CURRENT_BATCH_PROMPTS = 0  # Número de prompts del lote actual
 
+# Hilos que procesan resultados de un batch (la espera la hace un único poller compartido)
+MAX_WAIT_WORKERS = int(os.getenv("SWITCH_MAX_WAIT_WORKERS", "64"))
+# POSTs /prompt simultáneos al enviar un batch (comparten el pool de conexiones de COMFYUI_SESSION)
+MAX_SUBMIT_WORKERS = int(os.getenv("SWITCH_MAX_SUBMIT_WORKERS", "16"))
+
+# Cola única de envíos a ComfyUI: un hilo despachador agrupa lo que llega a la vez
+# (de cualquier petición o batch) y lo envía por un pool compartido de MAX_SUBMIT_WORKERS hilos
+SUBMIT_QUEUE = queue.Queue()  # (workflow, client_id, Future)
+MAX_SUBMIT_COALESCE = 64  # Prompts como máximo por tanda del despachador
+SUBMIT_DISPATCHER = None
+SUBMIT_DISPATCHER_LOCK = threading.Lock()
+
+# Allocator de bloques de Pillow: conservar bloques liberados entre peticiones en lugar de
+# devolverlos al sistema y volver a pedirlos (mmap/munmap) en cada imagen
+# Memoria máxima retenida: PIL_BLOCKS_MAX × PIL_BLOCK_SIZE (por defecto 16 × 16 MiB = 256 MiB)
+PIL_BLOCKS_MAX = int(os.getenv("SWITCH_PIL_BLOCKS_MAX", "16"))
+PIL_BLOCK_SIZE = int(os.getenv("SWITCH_PIL_BLOCK_SIZE", str(16 * 1024 * 1024)))
+Image.core.set_block_size(PIL_BLOCK_SIZE)
+Image.core.set_blocks_max(PIL_BLOCKS_MAX)
+
 # Directorios principales (simplificados)
-BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 COMFYUI_ROOT = os.path.abspath(os.path.join(BASE_DIR, '..', '..'))
 COMFYUI_INPUT_DIR = os.path.join(COMFYUI_ROOT, 'input')
 COMFYUI_OUTPUT_DIR = os.path.join(COMFYUI_ROOT, 'output')  # ComfyUI output (solo para leer)
@@ -64,10 +151,23 @@ OUR_OUTPUT_DIR = os.path.join(os.path.dirname(COMFYUI_ROOT), 'output')  # C:\Use
 for directory in [COMFYUI_INPUT_DIR, COMFYUI_OUTPUT_DIR, TEMP_UPLOADS_DIR, OUR_OUTPUT_DIR]:
     os.makedirs(directory, exist_ok=True)
 
+# Envío de imágenes delegado al servidor web (sendfile en el proxy en lugar de copiar por Python)
+# SWITCH_X_ACCEL_PREFIX: prefijo de las location internas de nginx (p. ej. /_internal); vacío = desactivado
+#   location /_internal/outputs/ { internal; alias <OUR_OUTPUT_DIR>/; } (ídem comfyui-output y session)
+# SWITCH_X_SENDFILE=1: cabecera X-Sendfile de Flask (Apache mod_xsendfile, lighttpd)
+X_ACCEL_PREFIX = os.getenv("SWITCH_X_ACCEL_PREFIX", "").rstrip('/')
+X_ACCEL_LOCATIONS = [
+    (OUR_OUTPUT_DIR, 'outputs'),
+    (COMFYUI_OUTPUT_DIR, 'comfyui-output'),
+    (session_manager.session_dir, 'session'),
+]
+app.config['USE_X_SENDFILE'] = os.getenv("SWITCH_X_SENDFILE", "0") == "1"
+
 # Configuración del workflow (actualizar según tu nuevo workflow)
 WORKFLOW_CONFIG = {
     'load_image_node_id': '699',  # ID del nodo LoadImage para el cuadro
     'save_image_node_id': '704',  # ID del nodo SaveImage principal
+    'upscale_save_node_id': '696',  # ID del nodo SaveImage de la imagen upscale
     'frame_node_id': '692',       # ID del nodo DynamicFrameNode
     'allowed_extensions': ['png', 'jpg', 'jpeg', 'gif', 'bmp', 'webp'],
      'frame_colors': ['none', 'black', 'white', 'brown', 'gold'],  # Incluir 'none' para sin marco
@@ -82,105 +182,98 @@ WORKFLOW_CONFIG = {
     }
 }
 
+# Conjuntos para validar parámetros por petición (WORKFLOW_CONFIG y STYLE_PRESETS no cambian en ejecución)
+FRAME_COLORS = frozenset(WORKFLOW_CONFIG['frame_colors'])
+STYLE_IDS = frozenset(style['id'] for style in get_available_styles())
+
 # ==================== FUNCIONES UTILITARIAS ====================
 
+# Parámetros del marco por estilo: (estilo de perspectiva, color de pared 200-255, intensidad de profundidad)
+# Tabla construida una vez al importar; una sola búsqueda por workflow
+STYLE_FRAME_PARAMS = {
+    # Estilos normales (conservadores, profundidad moderada)
+    'default': ('realistic', 240, 0.7),          # Gris claro neutro
+    'casa_ciudad': ('realistic', 235, 0.6),      # Gris urbano
+    'casa_campo': ('subtle', 245, 0.8),          # Blanco cálido
+    'casa_playa': ('subtle', 250, 0.5),          # Blanco costero
+    'casa_montana': ('dramatic', 230, 0.9),      # Gris piedra
+    'casa_moderna': ('realistic', 240, 0.6),     # Gris moderno
+    
+    # Estilos creativos (más dramáticos, profundidad variable)
+    'minimalist': ('subtle', 252, 0.4),          # Blanco puro, muy sutil
+    'luxury': ('dramatic', 235, 0.9),            # Gris elegante, muy dramático
+    'industrial': ('realistic', 220, 0.8),       # Gris concreto, fuerte
+    'warm_cozy': ('subtle', 242, 0.7),           # Beige cálido, moderado
+    'futuristic': ('realistic', 245, 0.5),       # Blanco tech, sutil
+    'artistic_bohemian': ('dramatic', 238, 0.8)  # Gris artístico, fuerte
+}
+DEFAULT_STYLE_FRAME_PARAMS = ('realistic', 240, 0.8)  # Estilos desconocidos
+
+def get_style_frame_params(style_id):
+    """
+    Retorna (perspective_style, wall_color, depth_intensity) apropiados según el estilo seleccionado
+    """
+    return STYLE_FRAME_PARAMS.get(style_id, DEFAULT_STYLE_FRAME_PARAMS)
+
 def get_perspective_style_for_style(style_id):
     """
     Retorna el estilo de perspectiva apropiado según el estilo seleccionado
     """
-    style_perspective_styles = {
-        'default': 'realistic',
-        'casa_ciudad': 'realistic',
-        'casa_campo': 'subtle',
-        'casa_playa': 'subtle',
-        'casa_montana': 'dramatic',
-        'casa_moderna': 'realistic',
-        'minimalist': 'subtle',
-        'luxury': 'dramatic',
-        'industrial': 'realistic',
-        'warm_cozy': 'subtle',
-        'futuristic': 'realistic',
-        'artistic_bohemian': 'dramatic'
-    }
-    
-    return style_perspective_styles.get(style_id, 'realistic')  # Default: realistic
+    return get_style_frame_params(style_id)[0]
 
 def get_wall_color_for_style(style_id):
     """
     Retorna el color de pared apropiado según el estilo seleccionado
     """
-    style_wall_colors = {
-        # Estilos normales (conservadores)
-        'default': 240,        # Gris claro neutro
-        'casa_ciudad': 235,    # Gris urbano
-        'casa_campo': 245,     # Blanco cálido
-        'casa_playa': 250,     # Blanco costero
-        'casa_montana': 230,   # Gris piedra
-        'casa_moderna': 240,   # Gris moderno
-        
-        # Estilos creativos (más dramáticos)
-        'minimalist': 252,     # Blanco puro
-        'luxury': 235,         # Gris elegante
-        'industrial': 220,     # Gris concreto
-        'warm_cozy': 242,      # Beige cálido
-        'futuristic': 245,     # Blanco tech
-        'artistic_bohemian': 238  # Gris artístico
-    }
-    
-    return style_wall_colors.get(style_id, 240)  # Default: gris claro
+    return get_style_frame_params(style_id)[1]
 
 def get_depth_intensity_for_style(style_id):
     """
     Retorna la intensidad de profundidad apropiada según el estilo
     """
-    style_depth_intensities = {
-        # Estilos normales (profundidad moderada)
-        'default': 0.7,
-        'casa_ciudad': 0.6,
-        'casa_campo': 0.8,
-        'casa_playa': 0.5,
-        'casa_montana': 0.9,
-        'casa_moderna': 0.6,
-        
-        # Estilos creativos (profundidad variable)
-        'minimalist': 0.4,       # Muy sutil
-        'luxury': 0.9,           # Muy dramático
-        'industrial': 0.8,       # Fuerte
-        'warm_cozy': 0.7,        # Moderado
-        'futuristic': 0.5,       # Sutil
-        'artistic_bohemian': 0.8  # Fuerte
-    }
-    
-    return style_depth_intensities.get(style_id, 0.8)  # Default: 0.8
+    return get_style_frame_params(style_id)[2]
 
-def log_info(message):
+# Logger del módulo: el mensaje solo se formatea si el nivel está habilitado
+# Uso perezoso: log_info("Progreso: %d/%d", completed, total) en lugar de f-strings en bucles
+logger = logging.getLogger("comfyui_switch")
+if not logger.handlers:
+    _log_handler = logging.StreamHandler()
+    _log_handler.setFormatter(logging.Formatter('[%(asctime)s] %(message)s', '%H:%M:%S'))
+    logger.addHandler(_log_handler)
+    # SWITCH_LOG_LEVEL=WARNING en producción: los log_info/log_success se descartan sin formatear nada
+    logger.setLevel(getattr(logging, os.getenv("SWITCH_LOG_LEVEL", "INFO").upper(), logging.INFO))
+    logger.propagate = False
+
+def log_info(message, *args):
     """Log con timestamp"""
-    timestamp = datetime.now().strftime("%H:%M:%S")
-    print(f"[{timestamp}] ℹ️  {message}")
+    logger.info("ℹ️  " + message, *args)
+
+def log_debug(message, *args):
+    """Log detallado (por imagen/nodo): solo se formatea si el nivel DEBUG está activo"""
+    logger.debug("🔎 " + message, *args)
 
-def log_success(message):
+def log_success(message, *args):
     """Log de éxito"""
-    timestamp = datetime.now().strftime("%H:%M:%S")
-    print(f"[{timestamp}] ✅ {message}")
+    logger.info("✅ " + message, *args)
 
-def log_error(message):
+def log_error(message, *args):
     """Log de error"""
-    timestamp = datetime.now().strftime("%H:%M:%S")
-    print(f"[{timestamp}] ❌ {message}")
+    logger.error("❌ " + message, *args)
 
-def log_warning(message):
+def log_exception(message, *args):
+    """Log de error con traceback (llamar solo desde un bloque except)"""
+    logger.exception("❌ " + message, *args)
+
+def log_warning(message, *args):
     """Log de advertencia"""
-    timestamp = datetime.now().strftime("%H:%M:%S")
-    print(f"[{timestamp}] ⚠️  {message}")
+    logger.warning("⚠️  " + message, *args)
 
 def calculate_batch_throttle_delay(num_prompts):
     """
     Calcula el tiempo de espera necesario antes de enviar un nuevo lote
     Sin delay entre prompts, solo consideramos el tiempo de procesamiento
     """
-    global LAST_BATCH_SUBMIT_TIME, CURRENT_BATCH_PROMPTS
-    
-    current_time = time.time()
+    current_time = time.monotonic()
     
     # Tiempo mínimo estimado para que ComfyUI procese el lote anterior
     # Asumimos un mínimo de 1 segundo de procesamiento por prompt
@@ -198,23 +291,25 @@ def calculate_batch_throttle_delay(num_prompts):
 def enforce_batch_throttle(num_prompts):
     """
     Aplica el throttling de batches - espera si es necesario
+    Bajo el lock solo se reserva el turno (instante de envío); la espera se hace fuera,
+    así un lote que espera no bloquea a los demás hilos que consultan o reservan
     """
     global LAST_BATCH_SUBMIT_TIME, CURRENT_BATCH_PROMPTS
     
     with BATCH_THROTTLE_LOCK:
         wait_time = calculate_batch_throttle_delay(num_prompts)
         
-        if wait_time > 0:
-            log_warning(f"🕐 Throttling batch: esperando {wait_time:.1f}s para que ComfyUI procese el lote anterior...")
-            time.sleep(wait_time)
-        
-        # Actualizar variables de control
-        LAST_BATCH_SUBMIT_TIME = time.time()
+        # Reservar el turno: el siguiente lote contará desde este instante de envío
+        LAST_BATCH_SUBMIT_TIME = time.monotonic() + wait_time
         CURRENT_BATCH_PROMPTS = num_prompts
-        
-        log_info(f"🎯 Batch throttle aplicado: {num_prompts} prompts, envío inmediato")
-        
-        return wait_time
+    
+    if wait_time > 0:
+        log_warning("🕐 Throttling batch: esperando %.1fs para que ComfyUI procese el lote anterior...", wait_time)
+        time.sleep(wait_time)
+    
+    log_info("🎯 Batch throttle aplicado: %s prompts, envío inmediato", num_prompts)
+    
+    return wait_time
 
 def allowed_file(filename):
     """Verifica si el archivo tiene una extensión permitida"""
@@ -232,61 +327,166 @@ def generate_unique_filename(original_filename):
 
 # ==================== GESTIÓN DE ARCHIVOS ====================
 
+# Formatos que ComfyUI lee tal cual: si ya son RGB y caben en UPLOAD_MAX_SIZE se copian sin recodificar
+PASSTHROUGH_FORMATS = {'JPEG': '.jpg', 'PNG': '.png'}
+UPLOAD_MAX_SIZE = 2048
+# zlib del PNG de entrada de ComfyUI: lo lee el mismo host al momento, así que por defecto sin compresión
+# (0 = sin DEFLATE; subir a 1-6 si el directorio de input está en un disco de red)
+INPUT_PNG_COMPRESS_LEVEL = int(os.getenv("SWITCH_INPUT_PNG_COMPRESS_LEVEL", "0"))
+EXIF_ORIENTATION_TAG = 0x0112
+UPLOAD_FILE_MODE = 0o644  # rw-r--r--: ComfyUI puede leerla aunque corra con otro usuario
+
+def remove_file_quietly(path):
+    """Borra un archivo temporal si existe (sin error si ya no está)"""
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+def write_file_bytes(path, data, mode=UPLOAD_FILE_MODE):
+    """
+    Escribe bytes ya en memoria directamente sobre el descriptor (sin el objeto archivo con buffer de Python)
+    """
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, mode)
+    try:
+        view = memoryview(data)
+        while view:
+            written = os.write(fd, view)
+            view = view[written:]
+    finally:
+        os.close(fd)
+
+def write_stream_to_file(stream, path, mode=UPLOAD_FILE_MODE):
+    """
+    Copia un stream de subida (SpooledTemporaryFile de Werkzeug) a path
+    Si el stream ya está volcado a disco, os.sendfile copia de archivo a archivo dentro del kernel;
+    si sigue en memoria (subidas pequeñas) se copia desde el buffer: llamar a fileno() lo volcaría
+    a un temporal (rollover), una escritura completa extra
+    Si sendfile falla, copia en espacio de usuario con buffer de 1 MiB
+    """
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, mode)
+    try:
+        if hasattr(os, 'sendfile') and getattr(stream, '_rolled', True):
+            try:
+                src_fd = stream.fileno()
+                size = os.fstat(src_fd).st_size
+                # Con offset explícito sendfile no mueve la posición del stream
+                _copy_fd_chunks(lambda s, d, off, n: os.sendfile(d, s, off, n), src_fd, fd, size)
+                return
+            except (OSError, ValueError, AttributeError):
+                os.ftruncate(fd, 0)
+                os.lseek(fd, 0, os.SEEK_SET)
+        stream.seek(0)
+        with os.fdopen(fd, 'wb', closefd=False) as f:
+            shutil.copyfileobj(stream, f, 1024 * 1024)
+    finally:
+        os.close(fd)
+
+# Escrituras de imágenes de sesión en segundo plano: se solapan con la codificación de la siguiente imagen
+# La URL se conoce sin esperar al disco, pero NO se entrega al cliente hasta wait_session_writes
+# (serve_session_image daría 404 o un archivo a medio escribir)
+SESSION_WRITE_EXECUTOR = concurrent.futures.ThreadPoolExecutor(max_workers=2, thread_name_prefix='session-write')
+
+def log_session_write_error(future):
+    """Callback de SESSION_WRITE_EXECUTOR: registra las escrituras de sesión fallidas"""
+    error = future.exception()
+    if error is not None:
+        log_error("❌ Error guardando imagen en sesión: %s", error)
+
+def save_job_image_async(job_id, image_data, filename, pending):
+    """
+    Encola session_manager.save_job_image sin esperar a la escritura
+    pending: lista donde se añade el Future; pasarla a wait_session_writes antes de publicar la URL
+    Retorna: la URL de sesión de la imagen (la misma que devolvería save_job_image)
+    """
+    future = SESSION_WRITE_EXECUTOR.submit(session_manager.save_job_image, job_id, image_data, filename)
+    future.add_done_callback(log_session_write_error)
+    pending.append(future)
+    return session_manager.job_image_url(job_id, filename)
+
+def wait_session_writes(pending):
+    """Espera las escrituras de sesión encoladas (los fallos ya los registra log_session_write_error)"""
+    if pending:
+        concurrent.futures.wait(pending)
+        pending.clear()
+
+def stage_job_image(job_id, source_path, filename):
+    """
+    Coloca en la sesión una imagen que ya está en disco con stage_output (link/reflink/copia en kernel),
+    sin pasar sus bytes por Python
+    Retorna: la URL de sesión de la imagen
+    """
+    job_dir = os.path.join(session_manager.session_dir, job_id)
+    os.makedirs(job_dir, exist_ok=True)
+    stage_output(source_path, os.path.join(job_dir, filename))
+    return session_manager.job_image_url(job_id, filename)
+
+def passthrough_extension(image, max_size=UPLOAD_MAX_SIZE):
+    """
+    Decide, solo con la cabecera de una imagen abierta, si sus bytes originales sirven como input de ComfyUI
+    (RGB, dentro de max_size, formato de PASSTHROUGH_FORMATS y sin orientación EXIF)
+    Retorna: extensión con la que guardarla tal cual, o None si hay que recodificarla
+    """
+    if (image.format in PASSTHROUGH_FORMATS and image.mode == 'RGB'
+            and image.width <= max_size and image.height <= max_size
+            and image.getexif().get(EXIF_ORIENTATION_TAG, 1) == 1):
+        return PASSTHROUGH_FORMATS[image.format]
+    return None
+
 def save_uploaded_image(file, base_name=None):
     """
     Guarda la imagen subida en el directorio de input de ComfyUI
+    Si la imagen ya es RGB, cabe en UPLOAD_MAX_SIZE y está en un formato de PASSTHROUGH_FORMATS
+    se copian sus bytes originales (solo se lee la cabecera); si no, se decodifica y se guarda como PNG
     Retorna: (input_path, filename_for_workflow)
     """
     if not base_name:
         base_name = secure_filename(file.filename.rsplit('.', 1)[0] if '.' in file.filename else 'image')
     
     # Generar nombre único para evitar conflictos
-    unique_filename = f"{base_name}_{uuid.uuid4().hex[:8]}.png"
+    unique_id = uuid.uuid4().hex[:8]
+    unique_filename = f"{base_name}_{unique_id}.png"
     input_path = os.path.join(COMFYUI_INPUT_DIR, unique_filename)
     
     try:
-        # Abrir y procesar la imagen
+        # Abrir la imagen: Image.open solo lee la cabecera (formato, modo, tamaño)
         image = Image.open(file.stream)
+        max_size = UPLOAD_MAX_SIZE
         
-        # Convertir a RGB si es necesario (eliminar canal alpha)
-        if image.mode in ('RGBA', 'LA', 'P'):
-            # Crear fondo blanco
-            background = Image.new('RGB', image.size, (255, 255, 255))
-            if image.mode == 'P':
-                image = image.convert('RGBA')
-            background.paste(image, mask=image.split()[-1] if image.mode in ('RGBA', 'LA') else None)
-            image = background
-        elif image.mode != 'RGB':
-            image = image.convert('RGB')
-        
-        # Redimensionar si es muy grande (para evitar problemas de memoria)
-        max_size = 2048
-        if image.width > max_size or image.height > max_size:
-            image.thumbnail((max_size, max_size), Image.Resampling.LANCZOS)
-            log_info(f"Imagen redimensionada a: {image.width}x{image.height}")
-        
-        # Guardar como PNG con calidad alta
-        image.save(input_path, format='PNG', optimize=False)
-        file.stream.seek(0)  # Reset stream para uso posterior
+        # Camino rápido: copiar los bytes originales sin decodificar ni recodificar
+        # (con orientación EXIF se recodifica, como siempre, para no cambiar cómo se ve la imagen)
+        extension = passthrough_extension(image, max_size)
+        if extension:
+            unique_filename = f"{base_name}_{unique_id}{extension}"
+            input_path = os.path.join(COMFYUI_INPUT_DIR, unique_filename)
+            # Werkzeug entrega la subida como SpooledTemporaryFile (en memoria o ya volcada a disco)
+            write_stream_to_file(file.stream, input_path)
+            file.stream.seek(0)  # Reset stream para uso posterior
+            log_info("Imagen copiada sin recodificar (%s %sx%s)", image.format, image.width, image.height)
+        else:
+            save_normalized_upload(image, input_path, max_size)
+            file.stream.seek(0)  # Reset stream para uso posterior
         
         # Establecer permisos de lectura para todos
         try:
-            import stat
-            os.chmod(input_path, stat.S_IRUSR | stat.S_IWUSR | stat.S_IRGRP | stat.S_IROTH)
+            os.chmod(input_path, UPLOAD_FILE_MODE)
         except:
             pass  # No crítico si falla
         
-        # Verificar que el archivo se guardó correctamente
-        if os.path.exists(input_path) and os.path.getsize(input_path) > 0:
-            file_size = os.path.getsize(input_path)
-            log_success(f"Imagen guardada correctamente: {unique_filename} ({file_size} bytes)")
-            log_info(f"Ruta completa: {input_path}")
-            return input_path, unique_filename
-        else:
+        # Verificar que el archivo se guardó correctamente (un solo stat: existencia y tamaño)
+        try:
+            file_size = os.stat(input_path).st_size
+        except FileNotFoundError:
+            file_size = 0
+        if file_size == 0:
             raise Exception("El archivo no se guardó correctamente")
         
+        log_success("Imagen guardada correctamente: %s (%s bytes)", unique_filename, file_size)
+        log_info("Ruta completa: %s", input_path)
+        return input_path, unique_filename
+        
     except Exception as e:
-        log_error(f"Error al guardar imagen: {str(e)}")
+        log_error("Error al guardar imagen: %s", str(e))
         # Limpiar archivo parcial si existe
         if os.path.exists(input_path):
             try:
@@ -295,6 +495,41 @@ def save_uploaded_image(file, base_name=None):
                 pass
         raise
 
+def flatten_to_rgb(image):
+    """
+    Retorna la imagen en modo RGB; las transparencias (RGBA, LA, P) se componen sobre fondo blanco
+    Si ya está en RGB se devuelve tal cual, sin conversión ni copia
+    """
+    mode = image.mode
+    if mode == 'RGB':
+        return image
+    if mode in ('RGBA', 'LA', 'P'):
+        if mode == 'P':
+            image = image.convert('RGBA')
+        background = Image.new('RGB', image.size, (255, 255, 255))
+        background.paste(image, mask=image.split()[-1])
+        return background
+    return image.convert('RGB')
+
+def save_normalized_upload(image, input_path, max_size):
+    """
+    Decodifica la imagen subida, la normaliza (RGB sobre fondo blanco, como máximo max_size) y la guarda como PNG
+    Los JPEG grandes se reducen durante la decodificación (draft: escalado DCT de libjpeg)
+    """
+    if image.format == 'JPEG' and (image.width > max_size or image.height > max_size):
+        image.draft('RGB', (max_size, max_size))
+    
+    # Convertir a RGB si es necesario (eliminar canal alpha)
+    image = flatten_to_rgb(image)
+    
+    # Redimensionar si es muy grande (para evitar problemas de memoria)
+    if image.width > max_size or image.height > max_size:
+        image.thumbnail((max_size, max_size), Image.Resampling.LANCZOS)
+        log_info("Imagen redimensionada a: %sx%s", image.width, image.height)
+    
+    # Guardar como PNG sin pérdida (sin DEFLATE por defecto: el zlib domina el tiempo de CPU)
+    image.save(input_path, format='PNG', compress_level=INPUT_PNG_COMPRESS_LEVEL)
+
 def create_output_directory(base_name):
     """
     Crea directorio de salida para las imágenes procesadas en NUESTRO directorio personalizado
@@ -302,75 +537,324 @@ def create_output_directory(base_name):
     """
     output_dir = os.path.join(OUR_OUTPUT_DIR, base_name)
     os.makedirs(output_dir, exist_ok=True)
-    log_info(f"📁 Directorio de salida personalizado creado: {output_dir}")
+    log_info("📁 Directorio de salida personalizado creado: %s", output_dir)
     return output_dir
 
-# ==================== GESTIÓN DE WORKFLOWS ====================
+def _copy_fd_chunks(copy_chunk, src_fd, dst_fd, size):
+    """Copia size bytes llamando copy_chunk(src_fd, dst_fd, offset, count) hasta completar"""
+    offset = 0
+    while offset < size:
+        copied = copy_chunk(src_fd, dst_fd, offset, size - offset)
+        if copied == 0:
+            raise OSError(f"Copia incompleta: {offset}/{size} bytes")
+        offset += copied
 
-def load_workflow(workflow_name):
+def stage_output(source_path, dest_path):
     """
-    Carga un workflow desde archivo JSON
-    Soporta tanto nombres simples como rutas completas (e.g., "bathroom/H80x60/cuadro-bathroom-open-H60x802")
-    Retorna: diccionario del workflow
+    Coloca una copia de source_path en dest_path sin recodificar
+    Orden de intentos (el primero que funcione gana, cada uno es una sola syscall o un bucle de ellas):
+      1. os.link: hardlink, sin copiar bytes (mismo sistema de archivos)
+      2. ioctl FICLONE: reflink (btrfs/xfs/overlayfs)
+      3. os.copy_file_range: copia dentro del kernel (Linux 4.5+, server-side copy en NFSv4.2)
+      4. os.sendfile: copia dentro del kernel
+      5. shutil.copyfileobj: copia en espacio de usuario
+    Con hardlink/reflink dest_path comparte datos con source_path: nunca modificar dest_path en sitio
+    (para cambiarlo, escribir un archivo nuevo y reemplazarlo con os.replace)
     """
-    # Limpiar el nombre del workflow
-    workflow_name = workflow_name.strip()
-    
-    # Construir posibles rutas
-    possible_paths = []
+    try:
+        os.link(source_path, dest_path)
+        return
+    except OSError:
+        pass
     
-    # Si contiene barras, es una ruta relativa completa
-    if '/' in workflow_name:
-        # Ejemplo: "bathroom/H80x60/cuadro-bathroom-open-H60x802"
-        full_path = os.path.join(WORKFLOWS_DIR, workflow_name + '.json')
-        possible_paths.append(full_path)
+    with open(source_path, 'rb') as src, open(dest_path, 'wb') as dst:
+        src_fd, dst_fd = src.fileno(), dst.fileno()
+        size = os.fstat(src_fd).st_size
+        
+        if fcntl is not None:
+            try:
+                fcntl.ioctl(dst_fd, FICLONE, src_fd)
+                return
+            except OSError:
+                pass
+        
+        if hasattr(os, 'copy_file_range'):
+            try:
+                _copy_fd_chunks(lambda s, d, off, n: os.copy_file_range(s, d, n, off, off), src_fd, dst_fd, size)
+                return
+            except OSError:
+                dst.seek(0)
+                dst.truncate()
         
-        # También probar la ruta directa
-        direct_path = os.path.join(WORKFLOWS_DIR, workflow_name)
-        possible_paths.append(direct_path)
+        if hasattr(os, 'sendfile'):
+            try:
+                _copy_fd_chunks(lambda s, d, off, n: os.sendfile(d, s, off, n), src_fd, dst_fd, size)
+                return
+            except OSError:
+                dst.seek(0)
+                dst.truncate()
+        
+        src.seek(0)
+        shutil.copyfileobj(src, dst)
+
+# ==================== GESTIÓN DE WORKFLOWS ====================
+
+# Índice nombre -> ruta de los workflows (un recorrido con os.scandir; se reconstruye si cambia
+# el mtime de WORKFLOWS_DIR o ante un fallo, p. ej. un archivo nuevo en una subcarpeta)
+WORKFLOW_INDEX = {}
+WORKFLOW_INDEX_MTIME = None
+WORKFLOW_INDEX_LOCK = threading.Lock()
+# Workflows ya parseados con su WorkflowPlan, por (ruta, mtime): un cambio en el archivo invalida la entrada
+WORKFLOW_CACHE = OrderedDict()
+WORKFLOW_CACHE_LOCK = threading.Lock()
+MAX_CACHED_WORKFLOWS = 64
+
+def scan_workflow_dir(directory, index):
+    """
+    Añade al índice los .json de directory y sus subcarpetas
+    os.scandir da el tipo de cada entrada sin un stat extra por archivo
+    """
+    subdirs = []
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            if entry.is_dir():
+                subdirs.append(entry.path)
+            elif entry.name.endswith('.json') and entry.is_file():
+                # Gana la primera coincidencia (archivos de la carpeta antes que los de subcarpetas)
+                index.setdefault(entry.name, entry.path)
+                index.setdefault(entry.name[:-len('.json')], entry.path)
+    for subdir in subdirs:
+        scan_workflow_dir(subdir, index)
+
+def rebuild_workflow_index():
+    """Recorre WORKFLOWS_DIR una vez e indexa cada .json por nombre de archivo y por nombre sin extensión"""
+    global WORKFLOW_INDEX, WORKFLOW_INDEX_MTIME
+    with WORKFLOW_INDEX_LOCK:
+        index = {}
+        try:
+            mtime = os.stat(WORKFLOWS_DIR).st_mtime_ns
+            scan_workflow_dir(WORKFLOWS_DIR, index)
+        except OSError as e:
+            log_warning(f"No se pudo indexar {WORKFLOWS_DIR}: {str(e)}")
+            mtime = None
+        WORKFLOW_INDEX = index
+        WORKFLOW_INDEX_MTIME = mtime
+    return index
+
+def get_workflow_index():
+    """Índice actual; se reconstruye si el mtime de WORKFLOWS_DIR cambió desde la última vez"""
+    try:
+        mtime = os.stat(WORKFLOWS_DIR).st_mtime_ns
+    except OSError:
+        mtime = None
+    if mtime is None or mtime != WORKFLOW_INDEX_MTIME:
+        return rebuild_workflow_index()
+    return WORKFLOW_INDEX
+
+# Catálogo de workflows (workflows/<room_type>/<orientation>/<workflow>.json) para /workflows y los batches
+# Se valida con el mtime de cada carpeta del árbol: unas decenas de stat en vez de recorrer todos los archivos
+WORKFLOW_CATALOG = None  # {'dir_mtimes', 'list', 'structure', 'body' (respuesta de /workflows serializada)}
+WORKFLOW_CATALOG_LOCK = threading.Lock()
+
+def dir_mtime(path):
+    """mtime en ns de una carpeta, o None si no existe"""
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+
+def scan_workflow_catalog():
+    """
+    Recorre WORKFLOWS_DIR (estructura fija de 3 niveles) con os.scandir, sin stat extra por archivo
+    El mtime de cada carpeta se toma ANTES de listarla: un cambio durante el recorrido invalida el catálogo
+    """
+    dir_mtimes = {WORKFLOWS_DIR: dir_mtime(WORKFLOWS_DIR)}
+    workflows_list = []
+    workflows_structure = {}
+    if dir_mtimes[WORKFLOWS_DIR] is None:
+        return {'dir_mtimes': dir_mtimes, 'list': workflows_list, 'structure': workflows_structure, 'body': None}
     
-    # Rutas tradicionales (nombre simple)
-    possible_paths.extend([
+    with os.scandir(WORKFLOWS_DIR) as room_entries:
+        room_dirs = [(entry.name, entry.path) for entry in room_entries if entry.is_dir()]
+    for room_type, room_path in room_dirs:  # bathroom
+        dir_mtimes[room_path] = dir_mtime(room_path)
+        with os.scandir(room_path) as orientation_entries:
+            orientation_dirs = [(entry.name, entry.path) for entry in orientation_entries if entry.is_dir()]
+        for orientation, orientation_path in orientation_dirs:  # H80x60
+            dir_mtimes[orientation_path] = dir_mtime(orientation_path)
+            with os.scandir(orientation_path) as file_entries:
+                filenames = [entry.name for entry in file_entries
+                             if entry.name.endswith('.json') and entry.is_file()]
+            if not filenames:
+                continue
+            # El recorrido ya agrupa por sala/orientación: una lista por carpeta, enlazada en la
+            # estructura una sola vez y volcada a la lista plana con un extend
+            prefix = f"{room_type}/{orientation}/"
+            orientation_workflows = [{
+                "id": prefix + filename[:-5],  # ID único para el workflow
+                "name": filename[:-5],  # cuadro-bathroom-open-H60x802
+                "filename": filename,
+                "room_type": room_type,
+                "orientation": orientation,
+                "path": prefix + filename,
+                "status": "available"
+            } for filename in filenames]
+            workflows_structure.setdefault(room_type, {})[orientation] = orientation_workflows
+            workflows_list.extend(orientation_workflows)
+    
+    return {'dir_mtimes': dir_mtimes, 'list': workflows_list, 'structure': workflows_structure, 'body': None}
+
+def get_workflow_catalog():
+    """
+    Catálogo actual; se vuelve a recorrer solo si cambió el mtime de alguna carpeta del árbol
+    Compartido entre peticiones: NO modificar sus listas ni diccionarios
+    """
+    global WORKFLOW_CATALOG
+    catalog = WORKFLOW_CATALOG
+    if catalog is not None and all(dir_mtime(path) == mtime for path, mtime in catalog['dir_mtimes'].items()):
+        return catalog
+    with WORKFLOW_CATALOG_LOCK:
+        if WORKFLOW_CATALOG is catalog:
+            try:
+                WORKFLOW_CATALOG = scan_workflow_catalog()
+            except OSError as e:
+                log_warning(f"No se pudo recorrer {WORKFLOWS_DIR}: {str(e)}")
+                return catalog or {'dir_mtimes': {}, 'list': [], 'structure': {}, 'body': None}
+        return WORKFLOW_CATALOG
+
+def invalidate_workflow_caches():
+    """
+    Descarta índice, catálogo y workflows parseados: la siguiente petición vuelve a leer WORKFLOWS_DIR
+    Para cambios que el mtime no detecta (p. ej. un archivo reemplazado conservando su fecha)
+    Retorna: número de workflows parseados descartados
+    """
+    global WORKFLOW_INDEX_MTIME, WORKFLOW_CATALOG
+    with WORKFLOW_INDEX_LOCK:
+        WORKFLOW_INDEX_MTIME = None
+    with WORKFLOW_CATALOG_LOCK:
+        WORKFLOW_CATALOG = None
+    with WORKFLOW_CACHE_LOCK:
+        dropped = len(WORKFLOW_CACHE)
+        WORKFLOW_CACHE.clear()
+    return dropped
+
+def resolve_workflow_path(workflow_name):
+    """
+    Resuelve el nombre de un workflow a su archivo
+    Primero las rutas directas, luego el índice (reconstruido una vez si falla o está desactualizado)
+    Retorna: (ruta o None, rutas intentadas)
+    """
+    possible_paths = [
         os.path.join(WORKFLOWS_DIR, f"{workflow_name}.json"),
         os.path.join(WORKFLOWS_DIR, workflow_name),
-    ])
-    
-    # Búsqueda recursiva como respaldo
-    for root, dirs, files in os.walk(WORKFLOWS_DIR):
-        for file in files:
-            if file.endswith('.json'):
-                # Coincidencia exacta del nombre del archivo
-                if file == f"{workflow_name}.json" or file == workflow_name:
-                    possible_paths.append(os.path.join(root, file))
-                
-                # Coincidencia del nombre sin extensión
-                file_base = file.replace('.json', '')
-                if file_base == workflow_name:
-                    possible_paths.append(os.path.join(root, file))
-    
-    # Buscar el primer archivo que exista
-    workflow_path = None
+    ]
     for path in possible_paths:
-        if os.path.exists(path):
-            workflow_path = path
-            break
+        if os.path.isfile(path):
+            return path, possible_paths
+    
+    # Búsqueda recursiva como respaldo (vía índice)
+    path = get_workflow_index().get(workflow_name)
+    if path is None or not os.path.isfile(path):
+        path = rebuild_workflow_index().get(workflow_name)
+    if path is not None:
+        possible_paths.append(path)
+    return path, possible_paths
+
+def load_workflow(workflow_name, with_plan=False):
+    """
+    Carga un workflow desde archivo JSON
+    Soporta tanto nombres simples como rutas completas (e.g., "bathroom/H80x60/cuadro-bathroom-open-H60x802")
+    El resultado se cachea por (ruta, mtime) y se comparte: NO modificarlo (update_workflow trabaja sobre una copia)
+    with_plan: retornar también el WorkflowPlan del archivo (calculado una vez por versión del archivo)
+    Retorna: diccionario del workflow, o (workflow, plan) si with_plan
+    """
+    # Limpiar el nombre del workflow
+    workflow_name = workflow_name.strip()
+    
+    workflow_path, possible_paths = resolve_workflow_path(workflow_name)
     
     if not workflow_path:
-        log_error(f"Workflow '{workflow_name}' no encontrado. Rutas intentadas: {possible_paths[:5]}")
+        log_error("Workflow '%s' no encontrado. Rutas intentadas: %s", workflow_name, possible_paths[:5])
         raise FileNotFoundError(f"Workflow '{workflow_name}' no encontrado")
     
     try:
-        with open(workflow_path, 'r', encoding='utf-8') as f:
-            workflow = json.load(f)
+        cache_key = (workflow_path, os.stat(workflow_path).st_mtime_ns)
+        with WORKFLOW_CACHE_LOCK:
+            cached = WORKFLOW_CACHE.get(cache_key)
+            if cached is not None:
+                WORKFLOW_CACHE.move_to_end(cache_key)
+        
+        if cached is None:
+            # Una lectura binaria del archivo completo; orjson parsea directamente los bytes UTF-8
+            with open(workflow_path, 'rb') as f:
+                data = f.read()
+            workflow = orjson.loads(data) if orjson is not None else json.loads(data)
+            cached = (workflow, build_workflow_plan(workflow))
+            
+            with WORKFLOW_CACHE_LOCK:
+                WORKFLOW_CACHE[cache_key] = cached
+                while len(WORKFLOW_CACHE) > MAX_CACHED_WORKFLOWS:
+                    WORKFLOW_CACHE.popitem(last=False)
+            
+            log_success("Workflow cargado: %s", workflow_path)
         
-        log_success(f"Workflow cargado: {workflow_path}")
-        return workflow
+        return cached if with_plan else cached[0]
         
     except Exception as e:
-        log_error(f"Error al cargar workflow: {str(e)}")
+        log_error("Error al cargar workflow: %s", str(e))
         raise
 
-def update_workflow(workflow, image_filename, frame_color='black', style_id='default', style_node_id=None, output_subfolder=None):
+def clone_workflow(workflow):
+    """
+    Copia profunda de un workflow (JSON puro: dicts, listas, str, números)
+    Serializar y parsear es bastante más rápido que copy.deepcopy; con orjson, más aún
+    """
+    if orjson is not None:
+        return orjson.loads(orjson.dumps(workflow))
+    return json.loads(json.dumps(workflow))
+
+# Generador de seeds de ComfyUI: no necesitan calidad criptográfica, solo variar entre prompts
+SEED_RNG = random.Random(os.urandom(16))
+
+@dataclass(slots=True)
+class WorkflowPlan:
+    """
+    IDs de los nodos que update_workflow modifica, calculados una vez por workflow de origen
+    Los IDs sirven igual para cualquier copia del workflow (clone_workflow conserva la estructura)
+    """
+    op_mode_ids: list = field(default_factory=list)  # SeargeOperatingMode con inputs.workflow_mode
+    cn_depth_ids: list = field(default_factory=list)  # SeargeControlnetAdapterV2 en modo depth
+    cn_canny_ids: list = field(default_factory=list)  # SeargeControlnetAdapterV2 en modo canny
+    save_ids: list = field(default_factory=list)  # SaveImage con inputs.filename_prefix
+    seed_ids: list = field(default_factory=list)  # Cualquier nodo con inputs.seed
+
+def build_workflow_plan(workflow):
+    """Recorre el workflow UNA vez y clasifica los nodos que update_workflow necesita"""
+    plan = WorkflowPlan()
+    for node_id, node_data in workflow.items():
+        if not isinstance(node_data, dict):
+            continue
+        inputs = node_data.get('inputs')
+        if not isinstance(inputs, dict):
+            continue
+        
+        class_type = node_data.get('class_type')
+        if class_type == 'SeargeOperatingMode' and 'workflow_mode' in inputs:
+            plan.op_mode_ids.append(node_id)
+        elif class_type == 'SeargeControlnetAdapterV2':
+            controlnet_mode = inputs.get('controlnet_mode')
+            if controlnet_mode == 'depth':
+                plan.cn_depth_ids.append(node_id)
+            elif controlnet_mode == 'canny':
+                plan.cn_canny_ids.append(node_id)
+        elif class_type == 'SaveImage' and 'filename_prefix' in inputs:
+            plan.save_ids.append(node_id)
+        
+        if 'seed' in inputs:
+            plan.seed_ids.append(node_id)
+    return plan
+
+def update_workflow(workflow, image_filename, frame_color='black', style_id='default', style_node_id=None, output_subfolder=None, plan=None, include_upscale=True):
     """
     Actualiza el workflow con la nueva imagen, configuraciones y estilo
     
@@ -378,9 +862,13 @@ def update_workflow(workflow, image_filename, frame_color='black', style_id='def
     - Por defecto: img2img (más fiel a la imagen original)
     - Con estilo aplicado: text2img + ControlNet depth/canny con strength 0.85
     
+    plan: WorkflowPlan del workflow (load_workflow(..., with_plan=True)); si falta se calcula aquí
+    include_upscale: si es False se quita el SaveImage del upscale (ComfyUI no lo codifica ni lo escribe)
     Retorna: workflow actualizado
     """
-    workflow_copy = copy.deepcopy(workflow)
+    workflow_copy = clone_workflow(workflow)
+    if plan is None:
+        plan = build_workflow_plan(workflow_copy)
     
     # Determinar si se aplica estilo (para decidir img2img vs text2img)
     has_style = style_id and style_id != 'default'
@@ -388,18 +876,17 @@ def update_workflow(workflow, image_filename, frame_color='black', style_id='def
     # Verificar si el estilo fuerza text2img
     forces_text2img = False
     if has_style:
-        from style_presets import style_forces_text2img
         forces_text2img = style_forces_text2img(style_id)
     
-    log_info(f"🎯 Modo de procesamiento: {'TEXT2IMG + ControlNet 0.85 (estilo fuerza)' if forces_text2img else 'IMG2IMG (preservar original)'} (estilo: {style_id})")
+    log_info("🎯 Modo de procesamiento: %s (estilo: %s)", 'TEXT2IMG + ControlNet 0.85 (estilo fuerza)' if forces_text2img else 'IMG2IMG (preservar original)', style_id)
     
     # Actualizar nodo LoadImage
     load_node_id = WORKFLOW_CONFIG['load_image_node_id']
     if load_node_id in workflow_copy:
         workflow_copy[load_node_id]['inputs']['image'] = image_filename
-        log_success(f"Nodo LoadImage ({load_node_id}) actualizado con: {image_filename}")
+        log_success("Nodo LoadImage (%s) actualizado con: %s", load_node_id, image_filename)
     else:
-        log_warning(f"Nodo LoadImage ({load_node_id}) no encontrado en el workflow")
+        log_warning("Nodo LoadImage (%s) no encontrado en el workflow", load_node_id)
     
     # Actualizar nodo DynamicFrameNodeImproved (nodo mejorado con profundidad)
     frame_node_id = WORKFLOW_CONFIG['frame_node_id']
@@ -413,9 +900,7 @@ def update_workflow(workflow, image_filename, frame_color='black', style_id='def
         frame_defaults = WORKFLOW_CONFIG['frame_node_defaults']
         
         # Obtener color de pared, intensidad de profundidad y estilo de perspectiva basado en el estilo
-        wall_color = get_wall_color_for_style(style_id)
-        depth_intensity = get_depth_intensity_for_style(style_id)
-        perspective_style = get_perspective_style_for_style(style_id)
+        perspective_style, wall_color, depth_intensity = get_style_frame_params(style_id)
         
         # Configuración especial para "none" (sin marco pero con profundidad)
         if frame_color == 'none':
@@ -427,12 +912,12 @@ def update_workflow(workflow, image_filename, frame_color='black', style_id='def
             frame_node['inputs']['wall_color'] = wall_color
             frame_node['inputs']['upscale_workflow'] = frame_defaults['upscale_workflow']
             
-            log_success(f"🚫 DynamicFrameNodeImproved ({frame_node_id}) configurado SIN MARCO pero CON PROFUNDIDAD")
-            log_info(f"   🎨 Estilo: {style_id} -> Color pared: {wall_color}, Profundidad: {depth_intensity}")
-            log_info(f"   📐 Perspectiva: {perspective_style}")
+            log_success("🚫 DynamicFrameNodeImproved (%s) configurado SIN MARCO pero CON PROFUNDIDAD", frame_node_id)
+            log_info("   🎨 Estilo: %s -> Color pared: %s, Profundidad: %s", style_id, wall_color, depth_intensity)
+            log_info("   📐 Perspectiva: %s", perspective_style)
         else:
             # Configuración normal con marco y profundidad
-            frame_node['inputs']['preset'] = frame_color if frame_color in WORKFLOW_CONFIG['frame_colors'] else 'black'
+            frame_node['inputs']['preset'] = frame_color if frame_color in FRAME_COLORS else 'black'
             frame_node['inputs']['frame_width'] = frame_defaults['frame_width']
             frame_node['inputs']['depth_enabled'] = frame_defaults['depth_enabled']
             frame_node['inputs']['depth_intensity'] = depth_intensity
@@ -441,19 +926,19 @@ def update_workflow(workflow, image_filename, frame_color='black', style_id='def
             frame_node['inputs']['upscale_workflow'] = frame_defaults['upscale_workflow']
             
             # Log detallado para verificar configuración
-            log_success(f"🖼️ DynamicFrameNodeImproved ({frame_node_id}) configurado:")
-            log_info(f"   📏 Marco: {frame_color} (ancho: {frame_defaults['frame_width']}px)")
-            log_info(f"   🎨 Preset aplicado: {frame_node['inputs']['preset']}")
-            log_info(f"   🏗️ Profundidad: {'ACTIVADA' if frame_defaults['depth_enabled'] else 'DESACTIVADA'} (intensidad: {depth_intensity})")
-            log_info(f"   📐 Perspectiva: {perspective_style}")
-            log_info(f"   🎯 Color de pared: {wall_color} (estilo: {style_id})")
+            log_success("🖼️ DynamicFrameNodeImproved (%s) configurado:", frame_node_id)
+            log_info("   📏 Marco: %s (ancho: %spx)", frame_color, frame_defaults['frame_width'])
+            log_info("   🎨 Preset aplicado: %s", frame_node['inputs']['preset'])
+            log_info("   🏗️ Profundidad: %s (intensidad: %s)", 'ACTIVADA' if frame_defaults['depth_enabled'] else 'DESACTIVADA', depth_intensity)
+            log_info("   📐 Perspectiva: %s", perspective_style)
+            log_info("   🎯 Color de pared: %s (estilo: %s)", wall_color, style_id)
             
             # Verificar que el color es válido
-            if frame_color not in WORKFLOW_CONFIG['frame_colors']:
-                log_warning(f"⚠️ Color '{frame_color}' no está en la lista de colores válidos: {WORKFLOW_CONFIG['frame_colors']}")
-                log_warning(f"   Usando color por defecto: black")
+            if frame_color not in FRAME_COLORS:
+                log_warning("⚠️ Color '%s' no está en la lista de colores válidos: %s", frame_color, WORKFLOW_CONFIG['frame_colors'])
+                log_warning("   Usando color por defecto: black")
     else:
-        log_warning(f"Nodo DynamicFrameNodeImproved ({frame_node_id}) no encontrado en el workflow")
+        log_warning("Nodo DynamicFrameNodeImproved (%s) no encontrado en el workflow", frame_node_id)
     
     # CONFIGURAR MODO DE WORKFLOW Y CONTROLNET SEGÚN ESTILO
     if forces_text2img:
@@ -461,39 +946,26 @@ def update_workflow(workflow, image_filename, frame_color='black', style_id='def
         log_info("🎨 Estilo aplicado: Configurando TEXT2IMG + ControlNet 0.85...")
         
         # Cambiar a text2img
-        for node_id, node_data in workflow_copy.items():
-            if isinstance(node_data, dict) and node_data.get('class_type') == 'SeargeOperatingMode':
-                if 'inputs' in node_data and 'workflow_mode' in node_data['inputs']:
-                    node_data['inputs']['workflow_mode'] = 'text-to-image'
-                    log_success(f"Modo cambiado a TEXT2IMG en nodo {node_id}")
+        for node_id in plan.op_mode_ids:
+            workflow_copy[node_id]['inputs']['workflow_mode'] = 'text-to-image'
+            log_success("Modo cambiado a TEXT2IMG en nodo %s", node_id)
         
         # Configurar ControlNet Depth con strength 0.85
-        for node_id, node_data in workflow_copy.items():
-            if (isinstance(node_data, dict) and 
-                node_data.get('class_type') == 'SeargeControlnetAdapterV2' and
-                'inputs' in node_data and 
-                node_data['inputs'].get('controlnet_mode') == 'depth'):
-                
-                node_data['inputs']['strength'] = 0.85
-                log_success(f"ControlNet Depth strength actualizado a 0.85 en nodo {node_id}")
+        for node_id in plan.cn_depth_ids:
+            workflow_copy[node_id]['inputs']['strength'] = 0.85
+            log_success("ControlNet Depth strength actualizado a 0.85 en nodo %s", node_id)
         
         # Configurar ControlNet Canny con strength 0.85
-        for node_id, node_data in workflow_copy.items():
-            if (isinstance(node_data, dict) and 
-                node_data.get('class_type') == 'SeargeControlnetAdapterV2' and
-                'inputs' in node_data and 
-                node_data['inputs'].get('controlnet_mode') == 'canny'):
-                
-                node_data['inputs']['strength'] = 0.85
-                log_success(f"ControlNet Canny strength actualizado a 0.85 en nodo {node_id}")
+        for node_id in plan.cn_canny_ids:
+            workflow_copy[node_id]['inputs']['strength'] = 0.85
+            log_success("ControlNet Canny strength actualizado a 0.85 en nodo %s", node_id)
         
         # Aplicar el estilo
-        from style_presets import get_style_prompt, get_style_negative_prompt, style_forces_text2img
         style_prompt = get_style_prompt(style_id)
         negative_prompt = get_style_negative_prompt(style_id)
-        log_info(f"📝 Prompt del estilo: '{style_prompt[:100]}...'")
+        log_info("📝 Prompt del estilo: '%s...'", style_prompt[:100])
         if negative_prompt:
-            log_info(f"❌ Prompt negativo del estilo: '{negative_prompt[:100]}...'")
+            log_info("❌ Prompt negativo del estilo: '%s...'", negative_prompt[:100])
         
         workflow_copy = apply_style_to_workflow(workflow_copy, style_id, style_node_id)
         
@@ -504,17 +976,17 @@ def update_workflow(workflow, image_filename, frame_color='black', style_id='def
                 node = workflow_copy[style_node_id]
                 if "inputs" in node:
                     applied_value = node["inputs"].get("prompt", node["inputs"].get("text", ""))
-                log_success(f"Estilo aplicado: {style_id} al nodo {style_node_id}")
-                log_info(f"Valor aplicado en nodo {style_node_id}: '{applied_value}'")
+                log_success("Estilo aplicado: %s al nodo %s", style_id, style_node_id)
+                log_info("Valor aplicado en nodo %s: '%s'", style_node_id, applied_value)
             else:
-                log_error(f"Nodo especificado {style_node_id} no existe en el workflow")
+                log_error("Nodo especificado %s no existe en el workflow", style_node_id)
         else:
             # Verificar en el nodo de estilo por defecto para Searge
             style_node_6 = workflow_copy.get("6", {})
             if "inputs" in style_node_6:
                 applied_value = style_node_6["inputs"].get("prompt", "")
-                log_success(f"Estilo aplicado: {style_id} (auto-detectado al nodo 6)")
-                log_info(f"Valor aplicado en nodo 6: '{applied_value}'")
+                log_success("Estilo aplicado: %s (auto-detectado al nodo 6)", style_id)
+                log_info("Valor aplicado en nodo 6: '%s'", applied_value)
             else:
                 log_warning("No se pudo verificar la aplicación del estilo")
     
@@ -523,30 +995,18 @@ def update_workflow(workflow, image_filename, frame_color='black', style_id='def
         log_info("📷 Sin estilo o estilo compatible: Manteniendo IMG2IMG...")
         
         # Asegurar img2img
-        for node_id, node_data in workflow_copy.items():
-            if isinstance(node_data, dict) and node_data.get('class_type') == 'SeargeOperatingMode':
-                if 'inputs' in node_data and 'workflow_mode' in node_data['inputs']:
-                    node_data['inputs']['workflow_mode'] = 'image-to-image'
-                    log_success(f"Modo mantenido en IMG2IMG en nodo {node_id}")
+        for node_id in plan.op_mode_ids:
+            workflow_copy[node_id]['inputs']['workflow_mode'] = 'image-to-image'
+            log_success("Modo mantenido en IMG2IMG en nodo %s", node_id)
         
         # Configurar ControlNet con strength más baja para preservar imagen original
-        for node_id, node_data in workflow_copy.items():
-            if (isinstance(node_data, dict) and 
-                node_data.get('class_type') == 'SeargeControlnetAdapterV2' and
-                'inputs' in node_data and 
-                node_data['inputs'].get('controlnet_mode') == 'depth'):
-                
-                node_data['inputs']['strength'] = 0.2  # Strength baja para img2img
-                log_success(f"ControlNet Depth strength mantenido en 0.2 para IMG2IMG en nodo {node_id}")
-        
-        for node_id, node_data in workflow_copy.items():
-            if (isinstance(node_data, dict) and 
-                node_data.get('class_type') == 'SeargeControlnetAdapterV2' and
-                'inputs' in node_data and 
-                node_data['inputs'].get('controlnet_mode') == 'canny'):
-                
-                node_data['inputs']['strength'] = 0.71  # Strength actual para img2img
-                log_success(f"ControlNet Canny strength mantenido en 0.71 para IMG2IMG en nodo {node_id}")
+        for node_id in plan.cn_depth_ids:
+            workflow_copy[node_id]['inputs']['strength'] = 0.2  # Strength baja para img2img
+            log_success("ControlNet Depth strength mantenido en 0.2 para IMG2IMG en nodo %s", node_id)
+        
+        for node_id in plan.cn_canny_ids:
+            workflow_copy[node_id]['inputs']['strength'] = 0.71  # Strength actual para img2img
+            log_success("ControlNet Canny strength mantenido en 0.71 para IMG2IMG en nodo %s", node_id)
     
     # Actualizar nodos SaveImage (subfolder si se especifica Y configurar prefijo descriptivo)
     save_node_id = WORKFLOW_CONFIG['save_image_node_id']
@@ -562,107 +1022,362 @@ def update_workflow(workflow, image_filename, frame_color='black', style_id='def
     #         save_node['inputs']['filename_prefix'] = descriptive_prefix
     #         log_success(f"SaveImage {save_node_id}: prefijo actualizado a '{descriptive_prefix}'")
     
-    log_info(f"💾 Manteniendo prefijo original 'ComfyUI' en nodo {save_node_id} para identificación correcta")
+    log_info("💾 Manteniendo prefijo original 'ComfyUI' en nodo %s para identificación correcta", save_node_id)
     
     if output_subfolder:
-        for node_id, node_data in workflow_copy.items():
-            if isinstance(node_data, dict) and node_data.get('class_type') == 'SaveImage':
-                if 'inputs' in node_data and 'filename_prefix' in node_data['inputs']:
-                    old_prefix = node_data['inputs']['filename_prefix']
-                    new_prefix = f"{output_subfolder}/{old_prefix}"
-                    node_data['inputs']['filename_prefix'] = new_prefix
-                    log_info(f"SaveImage {node_id}: {old_prefix} → {new_prefix}")
-    
-    # Randomizar seeds
-    for node_id, node_data in workflow_copy.items():
-        if isinstance(node_data, dict) and 'inputs' in node_data and 'seed' in node_data['inputs']:
-            new_seed = random.randint(1, 2**32-1)
-            node_data['inputs']['seed'] = new_seed
-    
-    log_success(f"✅ Workflow actualizado correctamente en modo: {'TEXT2IMG + ControlNet 0.85' if forces_text2img else 'IMG2IMG (fiel al original)'}")
+        for node_id in plan.save_ids:
+            save_inputs = workflow_copy[node_id]['inputs']
+            old_prefix = save_inputs['filename_prefix']
+            new_prefix = f"{output_subfolder}/{old_prefix}"
+            save_inputs['filename_prefix'] = new_prefix
+            log_info("SaveImage %s: %s → %s", node_id, old_prefix, new_prefix)
+    
+    # Sin upscale solicitado no se guarda: ningún nodo consume la salida de un SaveImage, así que
+    # quitarlo no cambia la composición y evita codificar/escribir el PNG grande (y copiarlo después)
+    if not include_upscale:
+        upscale_save_id = WORKFLOW_CONFIG['upscale_save_node_id']
+        if workflow_copy.pop(upscale_save_id, None) is not None:
+            log_info("📈 SaveImage de upscale (%s) quitado del workflow (include_upscale=False)", upscale_save_id)
+    
+    # Randomizar seeds (solo los nodos con seed del plan: O(nodos con seed), no O(nodos))
+    getrandbits = SEED_RNG.getrandbits
+    for node_id in plan.seed_ids:
+        workflow_copy[node_id]['inputs']['seed'] = getrandbits(32) or 1  # Rango 1..2**32-1
+    
+    log_success("✅ Workflow actualizado correctamente en modo: %s", 'TEXT2IMG + ControlNet 0.85' if forces_text2img else 'IMG2IMG (fiel al original)')
     return workflow_copy
 
 # ==================== COMUNICACIÓN CON COMFYUI ====================
 
+# Segundos máximos de espera al sondeo /view de verify_image_accessibility: con un valor bajo, un ComfyUI
+# ocupado falla el sondeo y process_image añade su espera de 1s
+IMAGE_PROBE_TIMEOUT = float(os.getenv("SWITCH_IMAGE_PROBE_TIMEOUT", "10"))
+
 def verify_image_accessibility(filename):
     """
     Verifica que ComfyUI pueda acceder al archivo de imagen
+    Un stat local y un HEAD a /view (sin descargar la imagen); GET de 1 byte si ComfyUI rechaza HEAD
     Retorna: True si es accesible, False en caso contrario
     """
     try:
-        # Verificar que el archivo existe físicamente
+        # Verificar que el archivo existe físicamente (un solo stat: existencia y tamaño)
         input_path = os.path.join(COMFYUI_INPUT_DIR, filename)
-        if not os.path.exists(input_path):
-            log_error(f"Archivo no existe en disco: {input_path}")
+        try:
+            file_size = os.stat(input_path).st_size
+        except FileNotFoundError:
+            log_error("Archivo no existe en disco: %s", input_path)
             return False
         
-        file_size = os.path.getsize(input_path)
         if file_size == 0:
-            log_error(f"Archivo vacío: {input_path}")
+            log_error("Archivo vacío: %s", input_path)
             return False
         
-        log_info(f"Archivo verificado en disco: {filename} ({file_size} bytes)")
+        log_info("Archivo verificado en disco: %s (%s bytes)", filename, file_size)
         
-        # Hacer una petición a ComfyUI para verificar la imagen
-        response = requests.get(f"{COMFYUI_URL}/view", params={'filename': filename}, timeout=10)
-        if response.status_code == 200:
-            log_success(f"Imagen accesible para ComfyUI: {filename}")
+        # Preguntar a ComfyUI por la imagen en su carpeta de input
+        params = {'filename': filename, 'type': 'input'}
+        response = COMFYUI_SESSION.head(f"{COMFYUI_URL}/view", params=params, timeout=IMAGE_PROBE_TIMEOUT)
+        if response.status_code == 405:
+            # Sin soporte de HEAD: pedir solo el primer byte
+            with COMFYUI_SESSION.get(f"{COMFYUI_URL}/view", params=params, headers={'Range': 'bytes=0-0'},
+                                     stream=True, timeout=IMAGE_PROBE_TIMEOUT) as response:
+                pass
+        
+        if response.status_code in (200, 206, 301, 302):
+            log_success("Imagen accesible para ComfyUI: %s", filename)
             return True
-        else:
-            log_warning(f"ComfyUI no puede acceder a la imagen: {filename} (status: {response.status_code})")
-            
-            # Intentar con diferentes parámetros
-            response2 = requests.get(f"{COMFYUI_URL}/view", params={'filename': filename, 'type': 'input'}, timeout=10)
-            if response2.status_code == 200:
-                log_success(f"Imagen accesible para ComfyUI (con type=input): {filename}")
-                return True
-            
-            return False
+        
+        log_warning("ComfyUI no puede acceder a la imagen: %s (status: %s)", filename, response.status_code)
+        return False
     except Exception as e:
-        log_warning(f"Error verificando acceso a imagen: {str(e)}")
+        log_warning("Error verificando acceso a imagen: %s", str(e))
         return False
 
-def submit_workflow_to_comfyui(workflow):
+def parse_json_response(response):
+    """
+    Parsea el cuerpo JSON de una respuesta de ComfyUI
+    Con orjson (si está instalado) directamente desde los bytes: bastante más rápido en historiales grandes
+    """
+    if orjson is None:
+        return response.json()
+    return orjson.loads(response.content)
+
+def post_prompt_to_comfyui(workflow, client_id):
     """
-    Envía el workflow a ComfyUI para procesamiento
+    POST /prompt a ComfyUI (lo ejecutan los hilos del despachador de envíos)
     Retorna: prompt_id
     """
-    client_id = str(uuid.uuid4())
     prompt_data = {
         "prompt": workflow,
         "client_id": client_id
     }
     
     try:
-        response = requests.post(f"{COMFYUI_URL}/prompt", json=prompt_data, timeout=60)
+        response = COMFYUI_SESSION.post(f"{COMFYUI_URL}/prompt", json=prompt_data, timeout=60)
         response.raise_for_status()
         
-        result = response.json()
+        result = parse_json_response(response)
         prompt_id = result.get('prompt_id')
         
         if not prompt_id:
             raise ValueError("ComfyUI no devolvió prompt_id")
         
-        log_success(f"Workflow enviado a ComfyUI. Prompt ID: {prompt_id}")
+        log_success("Workflow enviado a ComfyUI. Prompt ID: %s", prompt_id)
         return prompt_id
         
     except Exception as e:
-        log_error(f"Error enviando workflow a ComfyUI: {str(e)}")
+        log_error("Error enviando workflow a ComfyUI: %s", str(e))
         raise
 
+def run_prompt_post(workflow, client_id, future):
+    """Ejecuta un envío encolado y resuelve su Future"""
+    try:
+        future.set_result(post_prompt_to_comfyui(workflow, client_id))
+    except Exception as e:
+        future.set_exception(e)
+
+def submit_dispatcher_loop():
+    """
+    Hilo despachador: toma de SUBMIT_QUEUE todo lo que haya llegado a la vez y lo reparte
+    en el pool compartido; cada llamador espera solo su Future
+    """
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=MAX_SUBMIT_WORKERS)
+    while True:
+        items = [SUBMIT_QUEUE.get()]
+        while len(items) < MAX_SUBMIT_COALESCE:
+            try:
+                items.append(SUBMIT_QUEUE.get_nowait())
+            except queue.Empty:
+                break
+        
+        if len(items) > 1:
+            log_info("📦 %d prompts agrupados en una tanda de envío", len(items))
+        for workflow, client_id, future in items:
+            if future.set_running_or_notify_cancel():
+                executor.submit(run_prompt_post, workflow, client_id, future)
+
+def enqueue_workflow_submission(workflow, client_id=None):
+    """
+    Encola un workflow para enviarlo a ComfyUI (arranca el despachador la primera vez)
+    client_id: ComfyUI envía los eventos de ejecución al WebSocket con este clientId
+               (por defecto el del WebSocket de fondo de wait_for_completion)
+    Retorna: Future que se resuelve con el prompt_id
+    """
+    global SUBMIT_DISPATCHER
+    if SUBMIT_DISPATCHER is None or not SUBMIT_DISPATCHER.is_alive():
+        with SUBMIT_DISPATCHER_LOCK:
+            if SUBMIT_DISPATCHER is None or not SUBMIT_DISPATCHER.is_alive():
+                SUBMIT_DISPATCHER = threading.Thread(target=submit_dispatcher_loop, daemon=True)
+                SUBMIT_DISPATCHER.start()
+    
+    future = concurrent.futures.Future()
+    SUBMIT_QUEUE.put((workflow, client_id or COMFYUI_CLIENT_ID, future))
+    return future
+
+def submit_workflow_to_comfyui(workflow, client_id=None):
+    """
+    Envía el workflow a ComfyUI para procesamiento (vía la cola de envíos compartida)
+    client_id: ComfyUI envía los eventos de ejecución al WebSocket con este clientId
+               (por defecto el del WebSocket de fondo de wait_for_completion)
+    Retorna: prompt_id
+    """
+    return enqueue_workflow_submission(workflow, client_id).result()
+
+def submit_workflows_batch(workflows, client_id=None):
+    """
+    Envía varios workflows a ComfyUI a la vez: se encolan todos juntos y el despachador
+    los manda en paralelo (con lo que llegue de otras peticiones en ese momento)
+    El tiempo de envío del lote pasa de N round-trips a ~1
+    Retorna: lista de (prompt_id, error) en el mismo orden que workflows (uno de los dos es None)
+    """
+    return submission_results([enqueue_workflow_submission(workflow, client_id) for workflow in workflows])
+
+def submission_results(futures):
+    """
+    Espera los Futures de enqueue_workflow_submission
+    Retorna: lista de (prompt_id, error) en el mismo orden que futures (uno de los dos es None)
+    """
+    submissions = []
+    for future in futures:
+        error = future.exception()
+        submissions.append((None, str(error)) if error else (future.result(), None))
+    return submissions
+
+def parse_comfyui_event(message):
+    """
+    Decodifica un mensaje del WebSocket de ComfyUI
+    Retorna (tipo, data) si el evento es de un prompt; si no, None
+    """
+    if not isinstance(message, str):
+        return None  # Previews binarios
+    try:
+        event = json.loads(message)
+    except ValueError:
+        return None
+    
+    data = event.get('data') or {}
+    if not data.get('prompt_id'):
+        return None
+    return event.get('type'), data
+
+def parse_completion_event(message):
+    """
+    Interpreta un mensaje del WebSocket de ComfyUI
+    Retorna (prompt_id, error) si indica que un prompt terminó (error None si fue bien); si no, None
+    """
+    event = parse_comfyui_event(message)
+    return completion_from_event(*event) if event is not None else None
+
+def completion_from_event(event_type, data):
+    """(prompt_id, error) si el evento ya decodificado indica el fin de un prompt; si no, None"""
+    prompt_id = data['prompt_id']
+    if event_type == 'execution_error':
+        return prompt_id, f"Error en ComfyUI: {data.get('exception_message', 'error de ejecución')}"
+    if event_type == 'execution_success' or (event_type == 'executing' and data.get('node') is None):
+        return prompt_id, None
+    return None
+
+def signal_prompt_completion(prompt_id, error, outputs=None):
+    """
+    Despierta a wait_for_completion de prompt_id (la primera señal gana: ComfyUI puede
+    enviar execution_success y executing(node=None) para el mismo prompt)
+    Si la completion llega antes de que la espera se registre, se guarda en EARLY_COMPLETIONS
+    """
+    with COMPLETION_LOCK:
+        event = PENDING_COMPLETIONS.get(prompt_id)
+        if event is not None:
+            COMPLETION_RESULTS.setdefault(prompt_id, (error, outputs))
+            event.set()
+        else:
+            EARLY_COMPLETIONS.setdefault(prompt_id, (error, outputs))
+            while len(EARLY_COMPLETIONS) > MAX_EARLY_COMPLETIONS:
+                EARLY_COMPLETIONS.pop(next(iter(EARLY_COMPLETIONS)))
+
+def comfyui_listener_loop():
+    """
+    Hilo de fondo: mantiene abierto el WebSocket de ComfyUI con COMFYUI_CLIENT_ID
+    y convierte los eventos de fin de prompt en señales para wait_for_completion (reconecta si se cae)
+    Acumula los outputs de los eventos 'executed' de cada prompt (mismo formato que /history):
+    si el prompt se siguió completo, la espera termina sin consultar /history
+    """
+    connected_once = False
+    while True:
+        ws = None
+        # prompt_id -> {node_id: output}, o None si no se pudo seguir completo (nodos de caché,
+        # que no emiten 'executed'). Solo se sigue lo que empezó en esta conexión
+        collected = {}
+        try:
+            ws = websocket.create_connection(f"{COMFYUI_WS_URL}?clientId={COMFYUI_CLIENT_ID}", timeout=10)
+            ws.settimeout(None)
+            if not connected_once:
+                log_info("🔌 WebSocket de ComfyUI conectado (eventos de ejecución)")
+                connected_once = True
+            while True:
+                event = parse_comfyui_event(ws.recv())
+                if event is None:
+                    continue
+                event_type, data = event
+                prompt_id = data['prompt_id']
+                if event_type == 'execution_start':
+                    collected[prompt_id] = {}
+                elif event_type == 'executed':
+                    outputs = collected.get(prompt_id)
+                    if outputs is not None and data.get('output') is not None:
+                        outputs[str(data.get('node'))] = data['output']
+                elif event_type == 'execution_cached':
+                    if data.get('nodes') and prompt_id in collected:
+                        collected[prompt_id] = None
+                else:
+                    completion = completion_from_event(event_type, data)
+                    if completion is not None:
+                        signal_prompt_completion(*completion, collected.pop(prompt_id, None))
+        except (websocket.WebSocketException, OSError) as e:
+            if connected_once:
+                log_warning(f"⚠️ WebSocket de ComfyUI desconectado ({str(e)}), reintentando...")
+                connected_once = False
+        finally:
+            if ws is not None:
+                ws.close()
+        time.sleep(WS_RECONNECT_DELAY)
+
+def ensure_comfyui_listener():
+    """Arranca (una sola vez por proceso) el hilo que escucha el WebSocket de ComfyUI"""
+    global COMFYUI_LISTENER
+    with COMPLETION_LOCK:
+        if COMFYUI_LISTENER is None or not COMFYUI_LISTENER.is_alive():
+            COMFYUI_LISTENER = threading.Thread(target=comfyui_listener_loop, daemon=True)
+            COMFYUI_LISTENER.start()
+
 def wait_for_completion(prompt_id, timeout=300):
     """
     Espera a que ComfyUI complete el procesamiento
+    Sin polling: espera el evento del WebSocket; los outputs llegan con los eventos 'executed'
+    y /history solo se consulta si el prompt no se pudo seguir completo (caché, reconexión).
+    Si no llega evento (WebSocket caído) revisa /history cada WS_SAFETY_SWEEP_INTERVAL segundos
     Retorna: outputs del workflow
     """
-    log_info(f"Esperando completion del prompt: {prompt_id}")
+    log_info("Esperando completion del prompt: %s", prompt_id)
     
+    if websocket is None:
+        return wait_for_completion_polling(prompt_id, timeout)
+    
+    ensure_comfyui_listener()
+    
+    # Registrar la espera; la completion pudo llegar antes (carrera con el envío)
+    with COMPLETION_LOCK:
+        if prompt_id in EARLY_COMPLETIONS:
+            event = threading.Event()
+            event.set()
+            COMPLETION_RESULTS[prompt_id] = EARLY_COMPLETIONS.pop(prompt_id)
+        else:
+            event = PENDING_COMPLETIONS.setdefault(prompt_id, threading.Event())
+    
+    deadline = time.monotonic() + timeout
+    signaled = False
+    try:
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise TimeoutError(f"Timeout esperando completion después de {timeout} segundos")
+            
+            # Tras el evento, /history puede tardar un instante en escribirse: reintentos cortos
+            if not signaled:
+                signaled = event.wait(min(remaining, WS_SAFETY_SWEEP_INTERVAL))
+            else:
+                time.sleep(min(remaining, 0.25))
+            
+            if signaled:
+                with COMPLETION_LOCK:
+                    error, outputs = COMPLETION_RESULTS.pop(prompt_id, (None, None))
+                if error:
+                    raise Exception(error)
+                if outputs is not None:
+                    log_success("Procesamiento completado")
+                    return outputs
+            
+            done, outputs, error = fetch_prompt_result(COMFYUI_SESSION, prompt_id)
+            if done:
+                if error:
+                    raise Exception(error)
+                log_success("Procesamiento completado")
+                return outputs
+    finally:
+        with COMPLETION_LOCK:
+            PENDING_COMPLETIONS.pop(prompt_id, None)
+            COMPLETION_RESULTS.pop(prompt_id, None)
+
+def wait_for_completion_polling(prompt_id, timeout=300):
+    """
+    Espera a que ComfyUI complete el procesamiento consultando /history cada segundo
+    (solo si websocket-client no está instalado)
+    Retorna: outputs del workflow
+    """
     for i in range(timeout):
         try:
-            response = requests.get(f"{COMFYUI_URL}/history/{prompt_id}", timeout=30)
+            response = COMFYUI_SESSION.get(f"{COMFYUI_URL}/history/{prompt_id}", timeout=30)
             
             if response.status_code == 200:
-                history = response.json()
+                history = parse_json_response(response)
                 
                 if prompt_id in history:
                     prompt_history = history[prompt_id]
@@ -688,8 +1403,134 @@ def wait_for_completion(prompt_id, timeout=300):
     
     raise TimeoutError(f"Timeout esperando completion después de {timeout} segundos")
 
+def fetch_prompt_result(session, prompt_id):
+    """
+    Consulta /history de un prompt
+    Retorna: (terminado, outputs, error)
+    """
+    try:
+        response = session.get(f"{COMFYUI_URL}/history/{prompt_id}", timeout=30)
+        if response.status_code != 200:
+            return False, None, None
+        prompt_history = parse_json_response(response).get(prompt_id)
+    except (requests.exceptions.RequestException, ValueError):
+        return False, None, None
+    
+    if not prompt_history:
+        return False, None, None
+    
+    # Verificar si hay outputs
+    if 'outputs' in prompt_history:
+        return True, prompt_history['outputs'], None
+    
+    # Verificar errores
+    if 'error' in prompt_history.get('status', {}):
+        return True, None, f"Error en ComfyUI: {prompt_history['status']['error']}"
+    
+    return False, None, None
+
+def iter_completed_prompts_via_websocket(session, pending, deadline, client_id, poll_interval=1):
+    """
+    Escucha el WebSocket de ComfyUI (clientId del batch) y genera (prompt_id, outputs, error)
+    cuando llega el evento de fin de cada prompt: /history se pide una sola vez por prompt.
+    Modifica 'pending'; si el WebSocket falla, retorna y el llamador sigue con polling
+    """
+    try:
+        ws = websocket.create_connection(f"{COMFYUI_WS_URL}?clientId={client_id}", timeout=10)
+    except (websocket.WebSocketException, OSError) as e:
+        log_warning(f"⚠️ No se pudo abrir el WebSocket de ComfyUI ({str(e)}), usando polling")
+        return
+    
+    ws.settimeout(poll_interval)
+    awaiting_history = set()  # Terminados según el WebSocket; se reintenta /history hasta que aparezcan
+    next_sweep = 0  # El primer barrido recoge los prompts terminados antes de conectar
+    
+    try:
+        while pending and time.monotonic() < deadline:
+            # Barrido completo de seguridad cada WS_SAFETY_SWEEP_INTERVAL; si no, solo los avisados por el WebSocket
+            if time.monotonic() >= next_sweep:
+                to_check = set(pending)
+                next_sweep = time.monotonic() + WS_SAFETY_SWEEP_INTERVAL
+            else:
+                to_check = set(awaiting_history)
+            
+            for prompt_id in to_check:
+                done, outputs, error = fetch_prompt_result(session, prompt_id)
+                if done:
+                    awaiting_history.discard(prompt_id)
+                    pending.discard(prompt_id)
+                    yield prompt_id, outputs, error
+            
+            try:
+                message = ws.recv()
+            except websocket.WebSocketTimeoutException:
+                continue
+            
+            completion = parse_completion_event(message)
+            if completion is None or completion[0] not in pending:
+                continue
+            
+            prompt_id, error = completion
+            if error:
+                pending.discard(prompt_id)
+                yield prompt_id, None, error
+            else:
+                awaiting_history.add(prompt_id)
+                
+    except (websocket.WebSocketException, OSError) as e:
+        log_warning(f"⚠️ WebSocket de ComfyUI cerrado ({str(e)}), continuando con polling")
+    finally:
+        ws.close()
+
+# Error con el que iter_completed_prompts entrega los prompts que no terminaron a tiempo
+# (pueden seguir en la cola de ComfyUI)
+PROMPT_TIMEOUT_ERROR = "Timeout esperando completion después de {timeout} segundos"
+
+def iter_completed_prompts(prompt_ids, timeout=300, poll_interval=1, client_id=None):
+    """
+    Espera VARIOS prompts a la vez (sin un hilo bloqueado por prompt)
+    Con client_id escucha los eventos del WebSocket de ComfyUI; si no hay WebSocket,
+    cada ciclo consulta /queue una vez y solo pide /history de los prompts que ya salieron de la cola.
+    Genera (prompt_id, outputs, error) conforme cada prompt termina; error es None si fue bien
+    """
+    pending = set(prompt_ids)
+    deadline = time.monotonic() + timeout
+    
+    session = COMFYUI_SESSION
+    if client_id and websocket is not None:
+        yield from iter_completed_prompts_via_websocket(session, pending, deadline, client_id, poll_interval)
+    
+    while pending and time.monotonic() < deadline:
+        try:
+            queue_state = parse_json_response(session.get(f"{COMFYUI_URL}/queue", timeout=30))
+            in_queue = {item[1] for key in ('queue_running', 'queue_pending') for item in queue_state.get(key, [])}
+        except (requests.exceptions.RequestException, ValueError):
+            in_queue = set()  # Sin información de cola: consultar el historial de todos
+        
+        for prompt_id in [pid for pid in pending if pid not in in_queue]:
+            done, outputs, error = fetch_prompt_result(session, prompt_id)
+            if done:
+                pending.discard(prompt_id)
+                yield prompt_id, outputs, error
+        
+        if pending:
+            time.sleep(poll_interval)
+    
+    timeout_error = PROMPT_TIMEOUT_ERROR.format(timeout=timeout)
+    for prompt_id in pending:
+        yield prompt_id, None, timeout_error
+
 # ==================== PROCESAMIENTO DE RESULTADOS ====================
 
+# Patrones de clasificación de nombres de archivo compilados una vez (el escaneo corre en C)
+HAS_DIGIT = re.compile(r'\d').search
+TEMPORAL_TOKENS = frozenset(('tmp_', 'temp_', '_temp'))
+HAS_TEMPORAL_TOKEN = re.compile('|'.join(sorted(TEMPORAL_TOKENS))).search
+ROOM_KEYWORDS = frozenset(('bathroom', 'bedroom', 'office', 'salon', 'kitchen', 'living'))
+# Una sola pasada por nombre: todas las subcadenas relevantes ('original-upscale' antes que sus partes)
+FIND_NAME_TOKENS = re.compile('|'.join(
+    ['original-upscale', 'upscale', 'original', *sorted(TEMPORAL_TOKENS), *sorted(ROOM_KEYWORDS)])).findall
+
 def extract_generated_images(outputs, original_image_filename=None, include_upscale=True):
     """
     Extrae las imágenes GENERADAS de los outputs de ComfyUI para mostrar en el frontend:
@@ -705,82 +1546,86 @@ def extract_generated_images(outputs, original_image_filename=None, include_upsc
     
     Retorna: lista de imágenes generadas filtradas (composición + upscale opcional)
     """
-    # Contenedores para los 3 tipos de imágenes
-    original_image = None
-    upscale_image = None
-    composition_image = None
+    # Mejor imagen encontrada por tipo
+    best = {'composition': None, 'upscale': None, 'original': None}
     
     save_node_id = WORKFLOW_CONFIG['save_image_node_id']
     
-    def classify_image_type(filename):
-        """Clasifica el tipo de imagen basado en el nombre del archivo"""
-        filename_lower = filename.lower()
+    # Nombre original sin extensión, en minúsculas: constante durante toda la extracción
+    original_base = None
+    if original_image_filename:
+        original_base = original_image_filename.split('.', 1)[0].lower()
+    # filename -> si contiene el nombre original (se calcula una vez por candidata)
+    contains_original = {}
+    
+    def classify_image_type(filename_lower):
+        """Clasifica el tipo de imagen basado en el nombre del archivo (ya en minúsculas)"""
+        tokens = set(FIND_NAME_TOKENS(filename_lower))
         
         # Excluir archivos temporales
-        temporal_patterns = ['tmp_', 'temp_', '_temp']
-        for pattern in temporal_patterns:
-            if pattern in filename_lower:
-                return None
+        if not TEMPORAL_TOKENS.isdisjoint(tokens):
+            return None
         
         # Clasificar tipos específicos CORREGIDOS:
         # 1. COMPOSICIÓN FINAL: Imágenes que empiezan con "comfyui" (nodo 704)
-        if filename_lower.startswith('comfyui') and any(char.isdigit() for char in filename_lower):
+        if filename_lower.startswith('comfyui') and HAS_DIGIT(filename_lower) is not None:
             return 'composition'  # ✅ Resultado final del workflow (nodo 704)
         # 2. UPSCALE ORIGINAL: Imágenes con "original-upscale" (nodo 696)
-        elif 'original-upscale' in filename_lower:
+        if 'original-upscale' in tokens:
             return 'upscale'  # ✅ Solo upscale de la imagen original (nodo 696)
+        has_upscale = 'upscale' in tokens
+        has_original = 'original' in tokens
         # 3. UPSCALE GENÉRICO: Otras imágenes con "upscale" pero sin "original"
-        elif 'upscale' in filename_lower and 'original' not in filename_lower:
+        if has_upscale and not has_original:
             return 'upscale'  # Solo upscale
         # 4. ORIGINAL: Imágenes con "original" pero sin "upscale"
-        elif 'original' in filename_lower and 'upscale' not in filename_lower:
+        if has_original and not has_upscale:
             return 'original'  # Solo original
-        else:
-            # Usar keywords de habitaciones como fallback para original
-            room_keywords = ['bathroom', 'bedroom', 'office', 'salon', 'kitchen', 'living']
-            if any(keyword in filename_lower for keyword in room_keywords):
-                return 'original'
+        # Usar keywords de habitaciones como fallback para original
+        if not ROOM_KEYWORDS.isdisjoint(tokens):
+            return 'original'
         
         return None
     
     def add_image_if_better(current_image, new_image_info, image_type):
         """Añade la imagen si es mejor que la actual o si no hay una actual"""
         if current_image is None:
-            log_info(f"✅ Primera imagen {image_type}: {new_image_info['filename']} (nodo {new_image_info['node_id']})")
+            log_debug("✅ Primera imagen %s: %s (nodo %s)", image_type, new_image_info['filename'], new_image_info['node_id'])
             return new_image_info
         
         # 🎯 PRIORIDAD MÁXIMA: Nodo 704 siempre gana para composición
         if image_type == 'composition':
             if new_image_info['node_id'] == '704' and current_image['node_id'] != '704':
-                log_info(f"✅ Mejor imagen {image_type} (nodo 704 - composición final): {new_image_info['filename']}")
+                log_debug("✅ Mejor imagen %s (nodo 704 - composición final): %s", image_type, new_image_info['filename'])
                 return new_image_info
             elif current_image['node_id'] == '704' and new_image_info['node_id'] != '704':
-                log_info(f"⚠️ Manteniendo imagen {image_type} (nodo 704 prioritario): {current_image['filename']}")
+                log_debug("⚠️ Manteniendo imagen %s (nodo 704 prioritario): %s", image_type, current_image['filename'])
                 return current_image
         
         # Preferir imágenes que contengan el nombre original
-        if original_image_filename:
-            original_base = original_image_filename.split('.')[0].lower() if '.' in original_image_filename else original_image_filename.lower()
-            current_has_original = original_base in current_image['filename'].lower()
-            new_has_original = original_base in new_image_info['filename'].lower()
+        if original_base is not None:
+            current_has_original = contains_original[current_image['filename']]
+            new_has_original = contains_original[new_image_info['filename']]
             
             if new_has_original and not current_has_original:
-                log_info(f"✅ Mejor imagen {image_type} (contiene nombre original): {new_image_info['filename']}")
+                log_debug("✅ Mejor imagen %s (contiene nombre original): %s", image_type, new_image_info['filename'])
                 return new_image_info
             elif current_has_original and not new_has_original:
-                log_info(f"⚠️ Manteniendo imagen {image_type} actual (contiene nombre original): {current_image['filename']}")
+                log_debug("⚠️ Manteniendo imagen %s actual (contiene nombre original): %s", image_type, current_image['filename'])
                 return current_image
         
         # Si ambas son similares, preferir la más reciente (por nombre)
         if new_image_info['filename'] > current_image['filename']:
-            log_info(f"✅ Mejor imagen {image_type} (más reciente): {new_image_info['filename']}")
+            log_debug("✅ Mejor imagen %s (más reciente): %s", image_type, new_image_info['filename'])
             return new_image_info
         
-        log_info(f"⚠️ Manteniendo imagen {image_type} actual: {current_image['filename']}")
+        log_debug("⚠️ Manteniendo imagen %s actual: %s", image_type, current_image['filename'])
         return current_image
     
     # Buscar en todos los nodos SaveImage (704 primero para prioridad de composición)
-    all_save_nodes = ['704', save_node_id, '696']  # 704 primero (composición final), luego los demás
+    # dict.fromkeys quita duplicados conservando el orden (save_node_id puede ser '704' o '696')
+    all_save_nodes = list(dict.fromkeys(['704', save_node_id, '696']))  # 704 primero (composición final), luego los demás
+    save_node_set = frozenset(all_save_nodes)
     
     for node_id in all_save_nodes:
         if node_id in outputs and isinstance(outputs[node_id], dict) and 'images' in outputs[node_id]:
@@ -789,12 +1634,19 @@ def extract_generated_images(outputs, original_image_filename=None, include_upsc
                     continue
                 
                 filename = image_info['filename']
-                image_type = classify_image_type(filename)
+                filename_lower = filename.lower()
                 
-                log_info(f"🔍 Analizando imagen: {filename} (nodo {node_id}) -> clasificada como: {image_type}")
+                # 🎯 CLASIFICACIÓN POR NODO (más confiable que el nombre): 704 y 696 no necesitan
+                # clasificar el nombre, solo descartar temporales
+                if node_id == '704' or node_id == '696':
+                    image_type = 'composition' if node_id == '704' else 'upscale'
+                    if HAS_TEMPORAL_TOKEN(filename_lower) is not None:
+                        image_type = None
+                else:
+                    image_type = classify_image_type(filename_lower)
                 
                 if image_type is None:
-                    log_info(f"❌ Archivo excluido (no clasificado): {filename}")
+                    log_debug("❌ Archivo excluido (no clasificado): %s (nodo %s)", filename, node_id)
                     continue
                 
                 # Crear info de imagen
@@ -805,32 +1657,19 @@ def extract_generated_images(outputs, original_image_filename=None, include_upsc
                     'node_id': node_id,
                     'image_type': image_type
                 }
+                if original_base is not None:
+                    contains_original[filename] = original_base in filename_lower
+                log_debug("🔍 Imagen analizada: %s (nodo %s) -> %s", filename, node_id, image_type)
                 
-                # 🎯 CLASIFICACIÓN ADICIONAL POR NODO (más confiable que el nombre)
-                if node_id == '704':
-                    img_info['image_type'] = 'composition'  # Nodo 704 siempre es composición final
-                    log_info(f"🎯 FORZADO: Imagen del nodo 704 clasificada como COMPOSITION: {filename}")
-                elif node_id == '696':
-                    img_info['image_type'] = 'upscale'  # Nodo 696 siempre es upscale original
-                    log_info(f"📈 FORZADO: Imagen del nodo 696 clasificada como UPSCALE: {filename}")
-                
-                # Usar la clasificación forzada por nodo
-                final_image_type = img_info['image_type']
-                
-                # Asignar a la categoría correspondiente usando clasificación forzada por nodo
-                if final_image_type == 'original':
-                    original_image = add_image_if_better(original_image, img_info, 'original')
-                elif final_image_type == 'upscale':
-                    upscale_image = add_image_if_better(upscale_image, img_info, 'upscale')
-                elif final_image_type == 'composition':
-                    composition_image = add_image_if_better(composition_image, img_info, 'composition')
+                # Asignar a la categoría correspondiente
+                best[image_type] = add_image_if_better(best[image_type], img_info, image_type)
     
     # Buscar en otros nodos si no se encontraron todas las imágenes
-    if not all([original_image, upscale_image, composition_image]):
+    if not all(best.values()):
         log_info("🔍 Buscando imágenes faltantes en otros nodos...")
         
         for node_id, node_data in outputs.items():
-            if node_id in all_save_nodes:
+            if node_id in save_node_set:
                 continue  # Ya procesado
             
             if isinstance(node_data, dict) and 'images' in node_data:
@@ -839,76 +1678,166 @@ def extract_generated_images(outputs, original_image_filename=None, include_upsc
                         continue
                     
                     filename = image_info['filename']
-                    image_type = classify_image_type(filename)
+                    image_type = classify_image_type(filename.lower())
                     
-                    if image_type is None:
+                    # Solo asignar si no tenemos una imagen de ese tipo
+                    if image_type is None or best[image_type] is not None:
                         continue
                     
-                    img_info = {
+                    best[image_type] = {
                         'filename': filename,
                         'subfolder': image_info.get('subfolder', ''),
                         'type': image_info.get('type', 'output'),
                         'node_id': node_id,
                         'image_type': image_type
                     }
-                    
-                    # Solo asignar si no tenemos una imagen de ese tipo
-                    if image_type == 'original' and original_image is None:
-                        original_image = img_info
-                        log_info(f"✅ Imagen original encontrada en nodo {node_id}: {filename}")
-                    elif image_type == 'upscale' and upscale_image is None:
-                        upscale_image = img_info
-                        log_info(f"✅ Imagen upscale encontrada en nodo {node_id}: {filename}")
-                    elif image_type == 'composition' and composition_image is None:
-                        composition_image = img_info
-                        log_info(f"✅ Imagen composición encontrada en nodo {node_id}: {filename}")
-    
-    # Ensamblar resultado final - SOLO IMÁGENES GENERADAS (sin la original)
-    final_images = []
-    
-    # 🎯 COMPOSICIÓN: Siempre incluir la imagen de composición (nodo 704)
-    if composition_image:
-        final_images.append(composition_image)
+                    log_info("✅ Imagen %s encontrada en nodo %s: %s", image_type, node_id, filename)
+    
+    original_image = best['original']
+    upscale_image = best['upscale']
+    composition_image = best['composition']
     
-    # 📈 UPSCALE: Incluir solo si el usuario lo solicita
-    if include_upscale and upscale_image:
-        final_images.append(upscale_image)
+    # Ensamblar resultado final - SOLO IMÁGENES GENERADAS (sin la original):
+    # 🎯 composición siempre (nodo 704) y 📈 upscale solo si el usuario lo solicita
+    final_images = [img for img in (composition_image, upscale_image if include_upscale else None) if img]
     
     # Calcular imágenes esperadas según configuración
     expected_generated = 1 + (1 if include_upscale else 0)  # Composición + upscale opcional
     if len(final_images) != expected_generated:
-        log_warning(f"⚠️ Se esperaban {expected_generated} imágenes generadas, pero se encontraron {len(final_images)}")
-        log_warning(f"   Upscale: {'✅' if upscale_image else '❌'} {'(incluido)' if include_upscale else '(excluido por usuario)'}")
-        log_warning(f"   Composición: {'✅' if composition_image else '❌'}")
+        log_warning("⚠️ Se esperaban %s imágenes generadas, pero se encontraron %s", expected_generated, len(final_images))
+        log_warning("   Upscale: %s %s", '✅' if upscale_image else '❌', '(incluido)' if include_upscale else '(excluido por usuario)')
+        log_warning("   Composición: %s", '✅' if composition_image else '❌')
         if original_image:
-            log_info(f"   Original encontrada pero excluida del frontend: {original_image['filename']}")
+            log_info("   Original encontrada pero excluida del frontend: %s", original_image['filename'])
     
-    log_success(f"✅ Total de imágenes generadas para frontend: {len(final_images)}/{expected_generated}")
-    log_info(f"📋 RESUMEN DE IMÁGENES GENERADAS PARA FRONTEND:")
-    for img in final_images:
-        log_info(f"   📷 {img['image_type'].upper()}: {img['filename']} (nodo {img['node_id']})")
+    log_success("✅ Total de imágenes generadas para frontend: %s/%s", len(final_images), expected_generated)
+    log_info("📋 RESUMEN DE IMÁGENES GENERADAS PARA FRONTEND:%s", "".join(
+        f"\n   📷 {img['image_type'].upper()}: {img['filename']} (nodo {img['node_id']})" for img in final_images))
     
     # Log especial para indicar estado del upscale
     if upscale_image:
         if include_upscale:
-            log_info(f"📈 IMAGEN UPSCALE INCLUIDA EN FRONTEND Y GUARDADO: {upscale_image['filename']} (nodo {upscale_image['node_id']})")
+            log_info("📈 IMAGEN UPSCALE INCLUIDA EN FRONTEND Y GUARDADO: %s (nodo %s)", upscale_image['filename'], upscale_image['node_id'])
         else:
-            log_info(f"🚫 IMAGEN UPSCALE EXCLUIDA DEL FRONTEND Y GUARDADO: {upscale_image['filename']} (nodo {upscale_image['node_id']})")
+            log_info("🚫 IMAGEN UPSCALE EXCLUIDA DEL FRONTEND Y GUARDADO: %s (nodo %s)", upscale_image['filename'], upscale_image['node_id'])
     else:
-        log_warning(f"⚠️ No se encontró imagen upscale en los outputs de ComfyUI")
+        log_warning("⚠️ No se encontró imagen upscale en los outputs de ComfyUI")
     
     # Log especial para indicar que la original se excluye
     if original_image:
-        log_info(f"🚫 IMAGEN ORIGINAL EXCLUIDA DEL FRONTEND: {original_image['filename']} (nodo {original_image['node_id']})")
+        log_info("🚫 IMAGEN ORIGINAL EXCLUIDA DEL FRONTEND: %s (nodo %s)", original_image['filename'], original_image['node_id'])
     
     # Log especial para composición final
     if composition_image:
-        log_success(f"🎯 IMAGEN DE COMPOSICIÓN FINAL (nodo 704): {composition_image['filename']}")
+        log_success("🎯 IMAGEN DE COMPOSICIÓN FINAL (nodo 704): %s", composition_image['filename'])
     else:
-        log_error(f"❌ NO SE ENCONTRÓ IMAGEN DE COMPOSICIÓN FINAL (nodo 704)")
+        log_error("❌ NO SE ENCONTRÓ IMAGEN DE COMPOSICIÓN FINAL (nodo 704)")
     
     return final_images
 
+# Conversión de PNG/originales a JPG: la mayor calidad que quepa en JPEG_TARGET_KB
+JPEG_TARGET_KB = 200
+JPEG_MIN_QUALITY = 30  # Último recurso si ni así cabe
+JPEG_FIRST_PROBE = 85  # Primera calidad probada: divide el rango de búsqueda
+
+def encode_jpeg_to_target(image, target_kb=JPEG_TARGET_KB):
+    """
+    Codifica image (RGB) como JPEG con la mayor calidad entre JPEG_MIN_QUALITY y 100 que quepa en target_kb
+    Búsqueda binaria sin optimize (≤7 codificaciones) y una codificación final con optimize=True
+    Retorna: (bytes JPEG, calidad)
+    """
+    target_bytes = target_kb * 1024
+    
+    def fits(quality):
+        buffer = BytesIO()
+        image.save(buffer, format='JPEG', quality=quality)
+        return buffer.tell() <= target_bytes
+    
+    best_quality = JPEG_MIN_QUALITY
+    low, high = JPEG_MIN_QUALITY, 100
+    quality = JPEG_FIRST_PROBE
+    while low <= high:
+        if fits(quality):
+            best_quality = quality
+            low = quality + 1
+        else:
+            high = quality - 1
+        quality = (low + high) // 2
+    
+    # optimize=True solo reduce el tamaño: la calidad elegida sigue cabiendo
+    buffer = BytesIO()
+    image.save(buffer, format='JPEG', quality=best_quality, optimize=True)
+    return buffer.getvalue(), best_quality
+
+def save_jpeg_to_target(image, dest_path, label, source_kb=None, target_kb=JPEG_TARGET_KB):
+    """
+    Guarda image (RGB) como JPEG en dest_path con la mejor calidad que quepa en target_kb y lo registra
+    label: descripción para el log (p. ej. "Imagen original batch")
+    source_kb: tamaño del archivo de origen, para el log de reducción
+    Retorna: los bytes JPEG escritos (para reutilizarlos sin releer dest_path)
+    """
+    jpeg_data, quality = encode_jpeg_to_target(image, target_kb)
+    with open(dest_path, 'wb') as f:
+        f.write(jpeg_data)
+    
+    size_kb = len(jpeg_data) / 1024
+    name = os.path.basename(dest_path)
+    if size_kb <= target_kb:
+        log_success("🎯 %s convertida a JPG: %s (%.1fKB, calidad %s%%)", label, name, size_kb, quality)
+    else:
+        log_warning("⚠️ %s muy grande, guardada con calidad %s%%: %s (%.1fKB)", label, quality, name, size_kb)
+    if source_kb:
+        log_info("   📊 Reducción de tamaño: %.1fKB → %.1fKB (%.1f%% reducción)", source_kb, size_kb, (source_kb - size_kb) / source_kb * 100)
+    return jpeg_data
+
+# Índice nombre de archivo -> ruta del output de ComfyUI (respaldo de find_image_file cuando la ruta
+# directa no existe); se reconstruye si cambia el mtime del directorio o ante un fallo
+OUTPUT_INDEX = {}
+OUTPUT_INDEX_MTIME = None
+OUTPUT_INDEX_LOCK = threading.Lock()
+
+def scan_output_dir(directory, index):
+    """Añade al índice los archivos de directory y sus subcarpetas (gana la primera aparición, como os.walk)"""
+    subdirs = []
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            if entry.is_dir():
+                subdirs.append(entry.path)
+            elif entry.is_file():
+                index.setdefault(entry.name, entry.path)
+    for subdir in subdirs:
+        scan_output_dir(subdir, index)
+
+def rebuild_output_index():
+    """Recorre COMFYUI_OUTPUT_DIR una vez e indexa todos sus archivos por nombre"""
+    global OUTPUT_INDEX, OUTPUT_INDEX_MTIME
+    with OUTPUT_INDEX_LOCK:
+        index = {}
+        try:
+            mtime = os.stat(COMFYUI_OUTPUT_DIR).st_mtime_ns
+            scan_output_dir(COMFYUI_OUTPUT_DIR, index)
+        except OSError as e:
+            log_warning(f"No se pudo indexar {COMFYUI_OUTPUT_DIR}: {str(e)}")
+            mtime = None
+        OUTPUT_INDEX = index
+        OUTPUT_INDEX_MTIME = mtime
+    return index
+
+def lookup_output_index(filename):
+    """Ruta indexada de filename en el output de ComfyUI (reconstruye el índice si está desactualizado)"""
+    try:
+        mtime = os.stat(COMFYUI_OUTPUT_DIR).st_mtime_ns
+    except OSError:
+        mtime = None
+    fresh = mtime is None or mtime != OUTPUT_INDEX_MTIME
+    index = rebuild_output_index() if fresh else OUTPUT_INDEX
+    
+    path = index.get(filename)
+    if not fresh and (path is None or not os.path.isfile(path)):
+        # Archivo nuevo en una subcarpeta (no cambia el mtime de la raíz) o movido: reindexar una vez
+        path = rebuild_output_index().get(filename)
+    return path
+
 def find_image_file(filename, subfolder=''):
     """
     Busca un archivo de imagen en el directorio de output DE COMFYUI (para leer las imágenes generadas)
@@ -920,19 +1849,23 @@ def find_image_file(filename, subfolder=''):
         os.path.join(COMFYUI_OUTPUT_DIR, filename)
     ]
     
-    # Búsqueda recursiva como fallback
-    for root, dirs, files in os.walk(COMFYUI_OUTPUT_DIR):
-        if filename in files:
-            possible_paths.append(os.path.join(root, filename))
-    
     for path in possible_paths:
-        if os.path.exists(path):
-            log_success(f"📖 Imagen encontrada en ComfyUI output: {path}")
+        if os.path.isfile(path):
+            log_success("📖 Imagen encontrada en ComfyUI output: %s", path)
             return path
     
-    log_error(f"❌ Imagen no encontrada en ComfyUI output: {filename}")
+    # Búsqueda recursiva como fallback (vía índice)
+    path = lookup_output_index(filename)
+    if path is not None:
+        log_success("📖 Imagen encontrada en ComfyUI output: %s", path)
+        return path
+    
+    log_error("❌ Imagen no encontrada en ComfyUI output: %s", filename)
     return None
 
+# Imágenes generadas de un job que se codifican/guardan a la vez
+MAX_SAVE_WORKERS = 4
+
 def save_images_to_our_output(output_dir, original_file, generated_images, original_filename, include_upscale, job_id, workflow_name=None, style_id=None):
     """
     Guarda las imágenes en nuestro directorio personalizado de manera organizada
@@ -950,9 +1883,11 @@ def save_images_to_our_output(output_dir, original_file, generated_images, origi
     Returns:
         (original_info, saved_images) - Información de imagen original y lista de generadas guardadas
     """
-    log_info(f"💾 Guardando en directorio personalizado: {output_dir}")
+    log_info("💾 Guardando en directorio personalizado: %s", output_dir)
+    output_base = os.path.basename(output_dir)  # Segmento de las URLs /get-image
     
     saved_images = []
+    session_writes = []  # Escrituras de sesión en curso: se esperan antes de retornar las URLs
     
     # 1. 📷 GUARDAR IMAGEN ORIGINAL (convertida a JPG con optimización)
     log_info("📷 Guardando imagen original...")
@@ -966,94 +1901,36 @@ def save_images_to_our_output(output_dir, original_file, generated_images, origi
     try:
         # Guardar imagen original desde el archivo subido
         original_file.stream.seek(0)  # Reset stream
-        image = Image.open(original_file.stream)
-        original_size_kb = len(original_file.stream.read()) / 1024
+        # Tamaño sin leer el contenido: seek al final y tell
+        original_file.stream.seek(0, os.SEEK_END)
+        original_size_kb = original_file.stream.tell() / 1024
         original_file.stream.seek(0)  # Reset stream again
+        image = Image.open(original_file.stream)
+        # El JPG final pesa como mucho 200KB: los JPEG grandes se decodifican ya reducidos (draft)
+        if image.format == 'JPEG' and (image.width > UPLOAD_MAX_SIZE or image.height > UPLOAD_MAX_SIZE):
+            image.draft('RGB', (UPLOAD_MAX_SIZE, UPLOAD_MAX_SIZE))
         
         # Convertir a RGB si es necesario
-        if image.mode in ('RGBA', 'LA', 'P'):
-            background = Image.new('RGB', image.size, (255, 255, 255))
-            if image.mode == 'P':
-                image = image.convert('RGBA')
-            background.paste(image, mask=image.split()[-1] if image.mode in ('RGBA', 'LA') else None)
-            image = background
-        elif image.mode != 'RGB':
-            image = image.convert('RGB')
+        image = flatten_to_rgb(image)
         
         # Optimizar imagen original a JPG con límite de 200KB
-        target_size_kb = 200
-        
-        # Intentar calidad 100% primero
-        buffer = io.BytesIO()
-        image.save(buffer, format='JPEG', quality=100, optimize=True)
-        size_kb = buffer.tell() / 1024
-        
-        if size_kb <= target_size_kb:
-            # Perfecto con calidad 100%
-            with open(original_dest_path, 'wb') as f:
-                f.write(buffer.getvalue())
-            log_success(f"✅ Imagen original convertida a JPG con calidad 100%: {original_dest_filename} ({size_kb:.1f}KB)")
-            log_info(f"   📊 Reducción de tamaño: {original_size_kb:.1f}KB → {size_kb:.1f}KB ({((original_size_kb - size_kb) / original_size_kb * 100):.1f}% reducción)")
-        else:
-            # Optimizar gradualmente para mantener la mejor calidad posible
-            log_info(f"📏 Imagen original muy grande con calidad 100% ({size_kb:.1f}KB), optimizando para 200KB...")
-            
-            best_quality = 100
-            best_buffer = None
-            
-            # Optimización gradual más inteligente
-            for quality in range(95, 60, -2):  # Reducir de 2 en 2 desde 95% hasta 60%
-                buffer = io.BytesIO()
-                image.save(buffer, format='JPEG', quality=quality, optimize=True)
-                size_kb = buffer.tell() / 1024
-                
-                if size_kb <= target_size_kb:
-                    best_quality = quality
-                    best_buffer = buffer.getvalue()
-                    break
-            
-            # Si aún no encontramos una buena calidad, probar con pasos más grandes
-            if best_buffer is None:
-                for quality in range(60, 30, -5):  # Reducir de 5 en 5 desde 60% hasta 30%
-                    buffer = io.BytesIO()
-                    image.save(buffer, format='JPEG', quality=quality, optimize=True)
-                    size_kb = buffer.tell() / 1024
-                    
-                    if size_kb <= target_size_kb:
-                        best_quality = quality
-                        best_buffer = buffer.getvalue()
-                        break
-            
-            # Guardar la mejor versión encontrada
-            if best_buffer:
-                with open(original_dest_path, 'wb') as f:
-                    f.write(best_buffer)
-                final_size = len(best_buffer) / 1024
-                log_info(f"✅ Imagen original convertida a JPG: {original_dest_filename} ({final_size:.1f}KB, calidad {best_quality}%)")
-                log_info(f"   📊 Reducción de tamaño: {original_size_kb:.1f}KB → {final_size:.1f}KB ({((original_size_kb - final_size) / original_size_kb * 100):.1f}% reducción)")
-            else:
-                # Como último recurso, guardar con calidad 30%
-                image.save(original_dest_path, format='JPEG', quality=30, optimize=True)
-                final_size = os.path.getsize(original_dest_path) / 1024
-                log_warning(f"⚠️ Imagen original muy grande, guardada con calidad 30%: {original_dest_filename} ({final_size:.1f}KB)")
-                log_info(f"   📊 Reducción de tamaño: {original_size_kb:.1f}KB → {final_size:.1f}KB ({((original_size_kb - final_size) / original_size_kb * 100):.1f}% reducción)")
+        original_jpeg = save_jpeg_to_target(image, original_dest_path, "Imagen original", original_size_kb)
         
-        # Guardar también en sesión
-        with open(original_dest_path, 'rb') as img_file:
-            session_original_url = session_manager.save_job_image(job_id, img_file.read(), original_dest_filename)
+        # Guardar también en sesión (mismos bytes, sin releer el archivo)
+        session_original_url = save_job_image_async(job_id, original_jpeg, original_dest_filename, session_writes)
         
         original_info = {
             'filename': original_dest_filename,
-            'url': f"/get-image/{os.path.basename(output_dir)}/{original_dest_filename}",
+            'url': f"/get-image/{output_base}/{original_dest_filename}",
             'session_url': session_original_url,
             'image_type': 'original',
             'status': 'saved'
         }
         
-        log_success(f"✅ Imagen original guardada: {original_dest_path}")
+        log_success("✅ Imagen original guardada: %s", original_dest_path)
         
     except Exception as e:
-        log_error(f"❌ Error guardando imagen original: {str(e)}")
+        log_error("❌ Error guardando imagen original: %s", str(e))
         original_info = {
             'filename': original_dest_filename,
             'error': str(e),
@@ -1061,20 +1938,39 @@ def save_images_to_our_output(output_dir, original_file, generated_images, origi
         }
     
     # 2. 🎯 GUARDAR IMÁGENES GENERADAS (ya filtradas según include_upscale)
-    log_info(f"🎯 Guardando {len(generated_images)} imágenes generadas...")
+    log_info("🎯 Guardando %s imágenes generadas...", len(generated_images))
     
     timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
     
-    # 🔍 VERIFICAR ARCHIVOS EXISTENTES EN EL DIRECTORIO
-    existing_files = []
-    if os.path.exists(output_dir):
-        existing_files = [f.lower() for f in os.listdir(output_dir)]
+    # 🔍 VERIFICAR ARCHIVOS EXISTENTES EN EL DIRECTORIO (un solo listado para todo el bucle)
+    existing_files = os.listdir(output_dir) if os.path.exists(output_dir) else []
     
-    # Verificar si ya existe una imagen upscale
-    existing_upscale = any('upscale_' in f for f in existing_files)
+    # Verificar si ya existe una imagen upscale en disco
+    upscale_file = next((f for f in existing_files if 'upscale_' in f.lower()), None)
+    existing_upscale = upscale_file is not None
     if existing_upscale:
-        log_info(f"📈 Ya existe una imagen upscale en {output_dir}, se omitirán nuevas imágenes upscale")
+        log_info("📈 Ya existe una imagen upscale en %s, se omitirán nuevas imágenes upscale", output_dir)
+    
+    # Componentes del nombre comunes a todas las imágenes
+    workflow_clean = workflow_name.replace('/', '_').replace('-', '_') if workflow_name else 'workflow'
+    style_clean = style_id if style_id and style_id != 'default' else 'nostyle'
+    photo_name = secure_filename(original_filename.rsplit('.', 1)[0] if '.' in original_filename else 'image')
     
+    def error_entry(img_info, e):
+        """Entrada de saved_images para una imagen que no se pudo guardar"""
+        log_error("❌ Error guardando imagen %s: %s", img_info['filename'], str(e))
+        return {
+            'filename': img_info['filename'],
+            'error': str(e),
+            'image_type': img_info.get('image_type', 'unknown'),
+            'status': 'error'
+        }
+    
+    # Fase 1 (secuencial): nombres, duplicados y archivo fuente de cada imagen
+    tasks = []  # (posición, img_info, img_type, source_path, dest_filename, convertir PNG a JPG)
+    # Una casilla por imagen generada, reservada de antemano: cada fase escribe en su posición
+    # y saved_images conserva el orden de generated_images sin ordenar claves al final
+    entries = [None] * len(generated_images)
     for i, img_info in enumerate(generated_images):
         try:
             # Verificar tipo de imagen
@@ -1082,220 +1978,197 @@ def save_images_to_our_output(output_dir, original_file, generated_images, origi
             
             # 🚫 SALTAR UPSCALE SI YA EXISTE UNA
             if img_type == 'upscale' and existing_upscale:
-                log_warning(f"⚠️ Imagen upscale saltada (ya existe una): {img_info['filename']}")
-                # Buscar la imagen upscale existente para agregarla a la respuesta
-                for existing_file in os.listdir(output_dir):
-                    if 'upscale_' in existing_file.lower():
-                        # Crear entrada para la imagen existente
-                        with open(os.path.join(output_dir, existing_file), 'rb') as img_file:
-                            session_url = session_manager.save_job_image(job_id, img_file.read(), existing_file)
-                        
-                        saved_images.append({
-                            'filename': existing_file,
-                            'url': f"/get-image/{os.path.basename(output_dir)}/{existing_file}",
-                            'session_url': session_url,
-                            'original_filename': img_info['filename'],
-                            'node_id': img_info.get('node_id'),
-                            'image_type': img_type,
-                            'status': 'existing'  # Marcar como existente
-                        })
-                        log_info(f"📈 Usando imagen upscale existente: {existing_file}")
-                        break
+                log_warning("⚠️ Imagen upscale saltada (ya existe una): %s", img_info['filename'])
+                # Agregar la imagen upscale existente (en disco antes de esta llamada) a la respuesta
+                if upscale_file:
+                    session_url = stage_job_image(job_id, os.path.join(output_dir, upscale_file), upscale_file)
+                    
+                    entries[i] = {
+                        'filename': upscale_file,
+                        'url': f"/get-image/{output_base}/{upscale_file}",
+                        'session_url': session_url,
+                        'original_filename': img_info['filename'],
+                        'node_id': img_info.get('node_id'),
+                        'image_type': img_type,
+                        'status': 'existing'  # Marcar como existente
+                    }
+                    log_info("📈 Usando imagen upscale existente: %s", upscale_file)
                 continue
             
             # Buscar archivo fuente en ComfyUI output
             source_path = find_image_file(img_info['filename'], img_info['subfolder'])
             if not source_path:
-                log_error(f"❌ No se pudo encontrar: {img_info['filename']}")
+                log_error("❌ No se pudo encontrar: %s", img_info['filename'])
                 continue
             
             # Crear nombre descriptivo
             original_ext = img_info['filename'].rsplit('.', 1)[1] if '.' in img_info['filename'] else 'png'
             
-            # Preparar componentes para el nombre del archivo
-            workflow_clean = workflow_name.replace('/', '_').replace('-', '_') if workflow_name else 'workflow'
-            style_clean = style_id if style_id and style_id != 'default' else 'nostyle'
-            photo_name = secure_filename(original_filename.rsplit('.', 1)[0] if '.' in original_filename else 'image')
-            
             # Nombres descriptivos según tipo
             if img_type == 'composition':
                 # Formato: workflow_estilo_nombreFoto_timestamp.ext
                 dest_filename = f"{workflow_clean}_{style_clean}_{photo_name}_{timestamp}.{original_ext}"
-                log_info(f"🎯 Nombre de composición generado: {dest_filename}")
-                log_info(f"   📝 Componentes: workflow={workflow_clean}, estilo={style_clean}, foto={photo_name}, timestamp={timestamp}")
+                log_debug("🎯 Nombre de composición generado: %s", dest_filename)
+                log_debug("   📝 Componentes: workflow=%s, estilo=%s, foto=%s, timestamp=%s", workflow_clean, style_clean, photo_name, timestamp)
             elif img_type == 'upscale':
                 # Formato: upscale_nombreFoto_timestamp.ext (más simple para upscale)
                 dest_filename = f"upscale_{photo_name}_{timestamp}.{original_ext}"
-                log_info(f"📈 Nombre de upscale generado: {dest_filename}")
+                log_debug("📈 Nombre de upscale generado: %s", dest_filename)
                 # Marcar que ahora tenemos upscale para futuras verificaciones
                 existing_upscale = True
             else:
                 # Formato genérico: generated_numeroSecuencia_timestamp.ext
                 dest_filename = f"generated_{i+1}_{timestamp}.{original_ext}"
             
-            dest_path = os.path.join(output_dir, dest_filename)
-            
             # Verificar si ya existe este archivo específico
-            if os.path.exists(dest_path):
-                log_warning(f"⚠️ Archivo específico ya existe, saltando: {dest_filename}")
+            if os.path.exists(os.path.join(output_dir, dest_filename)):
+                log_warning("⚠️ Archivo específico ya existe, saltando: %s", dest_filename)
                 continue
             
-            # Convertir PNG a JPG con límite de 200KB manteniendo máxima calidad
-            if original_ext.lower() == 'png':
-                # Cambiar extensión a JPG
-                dest_filename = dest_filename.replace('.png', '.jpg')
-                dest_path = os.path.join(output_dir, dest_filename)
-                
+            # Los PNG se convierten a JPG con límite de 200KB manteniendo máxima calidad;
+            # los JPEG y demás formatos ya comprimidos se copian tal cual (sin decodificar ni recodificar)
+            convert_png = original_ext.lower() == 'png'
+            if convert_png:
+                dest_filename = dest_filename.rsplit('.', 1)[0] + '.jpg'  # También con extensión .PNG
+            tasks.append((i, img_info, img_type, source_path, dest_filename, convert_png))
+            
+        except Exception as e:
+            entries[i] = error_entry(img_info, e)
+    
+    def save_generated_image(task):
+        """Fase 2: codifica/copia una imagen y la guarda en sesión (Pillow suelta el GIL al codificar)"""
+        i, img_info, img_type, source_path, dest_filename, convert_png = task
+        dest_path = os.path.join(output_dir, dest_filename)
+        try:
+            if convert_png:
                 # Convertir PNG a JPG con optimización inteligente de tamaño
                 try:
-                    from PIL import Image
-                    import io
-                    
                     # Abrir imagen PNG original
                     img = Image.open(source_path)
                     original_size_kb = os.path.getsize(source_path) / 1024
                     
                     # Convertir a RGB si es necesario (PNG puede tener transparencia)
-                    if img.mode in ('RGBA', 'LA', 'P'):
-                        # Crear fondo blanco para imágenes con transparencia
-                        background = Image.new('RGB', img.size, (255, 255, 255))
-                        if img.mode == 'P':
-                            img = img.convert('RGBA')
-                        background.paste(img, mask=img.split()[-1] if img.mode == 'RGBA' else None)
-                        img = background
-                    elif img.mode != 'RGB':
-                        img = img.convert('RGB')
-                    
-                    # Estrategia de optimización: Comenzar con calidad 100% y reducir gradualmente
-                    target_size_kb = 200
-                    best_quality = 100
-                    best_buffer = None
+                    img = flatten_to_rgb(img)
                     
-                    # Probar calidad 100% primero
-                    buffer = io.BytesIO()
-                    img.save(buffer, format='JPEG', quality=100, optimize=True)
-                    size_kb = buffer.tell() / 1024
-                    
-                    if size_kb <= target_size_kb:
-                        # ¡Perfecto! Calidad 100% y dentro del límite
-                        with open(dest_path, 'wb') as f:
-                            f.write(buffer.getvalue())
-                        log_success(f"🎯 Imagen convertida a JPG con calidad 100%: {dest_filename} ({size_kb:.1f}KB)")
-                        log_info(f"   📊 Reducción de tamaño: {original_size_kb:.1f}KB PNG → {size_kb:.1f}KB JPG ({((original_size_kb - size_kb) / original_size_kb * 100):.1f}% reducción)")
-                    else:
-                        # Necesitamos reducir el tamaño, pero manteniendo la mejor calidad posible
-                        log_info(f"📏 Imagen muy grande con calidad 100% ({size_kb:.1f}KB), optimizando para 200KB...")
-                        
-                        # Algoritmo de optimización más inteligente: reducir en pasos más pequeños
-                        for quality in range(95, 60, -2):  # Reducir de 2 en 2 desde 95% hasta 60%
-                            buffer = io.BytesIO()
-                            img.save(buffer, format='JPEG', quality=quality, optimize=True)
-                            size_kb = buffer.tell() / 1024
-                            
-                            if size_kb <= target_size_kb:
-                                best_quality = quality
-                                best_buffer = buffer.getvalue()
-                                break
-                        
-                        # Si aún no encontramos una buena calidad, probar con pasos más grandes
-                        if best_buffer is None:
-                            log_warning(f"⚠️ Imagen muy grande, probando calidades más bajas...")
-                            for quality in range(60, 30, -5):  # Reducir de 5 en 5 desde 60% hasta 30%
-                                buffer = io.BytesIO()
-                                img.save(buffer, format='JPEG', quality=quality, optimize=True)
-                                size_kb = buffer.tell() / 1024
-                                
-                                if size_kb <= target_size_kb:
-                                    best_quality = quality
-                                    best_buffer = buffer.getvalue()
-                                    break
-                        
-                        # Guardar la mejor versión encontrada
-                        if best_buffer:
-                            with open(dest_path, 'wb') as f:
-                                f.write(best_buffer)
-                            final_size = len(best_buffer) / 1024
-                            log_info(f"🎯 Imagen convertida a JPG: {dest_filename} ({final_size:.1f}KB, calidad {best_quality}%)")
-                            log_info(f"   📊 Reducción de tamaño: {original_size_kb:.1f}KB PNG → {final_size:.1f}KB JPG ({((original_size_kb - final_size) / original_size_kb * 100):.1f}% reducción)")
-                        else:
-                            # Como último recurso, guardar con calidad 30%
-                            img.save(dest_path, format='JPEG', quality=30, optimize=True)
-                            final_size = os.path.getsize(dest_path) / 1024
-                            log_warning(f"⚠️ Imagen muy grande, guardada con calidad 30%: {dest_filename} ({final_size:.1f}KB)")
-                            log_info(f"   📊 Reducción de tamaño: {original_size_kb:.1f}KB PNG → {final_size:.1f}KB JPG ({((original_size_kb - final_size) / original_size_kb * 100):.1f}% reducción)")
+                    # Mejor calidad que quepa en 200KB (búsqueda binaria)
+                    image_data = save_jpeg_to_target(img, dest_path, "Imagen", original_size_kb)
                     
                 except Exception as e:
-                    log_error(f"❌ Error convirtiendo PNG a JPG: {str(e)}")
+                    log_error("❌ Error convirtiendo PNG a JPG: %s", str(e))
                     # Fallback: copiar archivo original
-                    shutil.copy2(source_path, dest_path)
+                    image_data = None
+                    stage_output(source_path, dest_path)
             else:
-                # Copiar archivo no-PNG normalmente
-                shutil.copy2(source_path, dest_path)
+                # Copiar archivo no-PNG tal cual (JPEG ya comprimido: sin recodificar; link/reflink/copia en kernel)
+                image_data = None
+                stage_output(source_path, dest_path)
             
-            # Guardar también en sesión
-            with open(dest_path, 'rb') as img_file:
-                session_url = session_manager.save_job_image(job_id, img_file.read(), dest_filename)
+            # Guardar también en sesión: el JPG ya está en memoria; lo copiado se enlaza desde dest_path
+            if image_data is not None:
+                session_url = save_job_image_async(job_id, image_data, dest_filename, session_writes)
+            else:
+                session_url = stage_job_image(job_id, dest_path, dest_filename)
             
-            # Agregar a lista de guardadas
-            saved_image_info = {
+            log_success("✅ %s guardada: %s", img_type.upper(), dest_path)
+            return i, {
                 'filename': dest_filename,
-                'url': f"/get-image/{os.path.basename(output_dir)}/{dest_filename}",
+                'url': f"/get-image/{output_base}/{dest_filename}",
                 'session_url': session_url,
                 'original_filename': img_info['filename'],
                 'node_id': img_info.get('node_id'),
                 'image_type': img_type,
                 'status': 'saved'
             }
-            
-            saved_images.append(saved_image_info)
-            log_success(f"✅ {img_type.upper()} guardada: {dest_path}")
-            
         except Exception as e:
-            log_error(f"❌ Error guardando imagen {img_info['filename']}: {str(e)}")
-            # Agregar entrada de error
-            saved_images.append({
-                'filename': img_info['filename'],
-                'error': str(e),
-                'image_type': img_info.get('image_type', 'unknown'),
-                'status': 'error'
-            })
+            return i, error_entry(img_info, e)
+    
+    # Fase 2 (en paralelo): composición, upscale y extras son independientes entre sí
+    if len(tasks) > 1:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=min(MAX_SAVE_WORKERS, len(tasks))) as executor:
+            results = list(executor.map(save_generated_image, tasks))
+    else:
+        results = list(map(save_generated_image, tasks))
+    for i, entry in results:
+        entries[i] = entry
+    
+    # Agregar a lista de guardadas en el orden de generated_images (las saltadas quedan en None)
+    saved_images.extend(entry for entry in entries if entry is not None)
     
     # 3. 📊 RESUMEN FINAL
-    successful_saves = len([img for img in saved_images if img.get('status') == 'saved'])
-    log_success(f"✅ Guardado completado: {successful_saves}/{len(generated_images)} imágenes generadas + 1 original")
-    log_info(f"📁 Directorio: {output_dir}")
+    successful_saves = sum(1 for img in saved_images if img.get('status') == 'saved')
+    log_success("✅ Guardado completado: %s/%s imágenes generadas + 1 original", successful_saves, len(generated_images))
+    log_info("📁 Directorio: %s", output_dir)
     
+    # Las session_url van al cliente, que las carga en seguida: los archivos tienen que estar escritos
+    wait_session_writes(session_writes)
     return original_info, saved_images
 
 # ==================== RUTAS DEL API ====================
 
+def json_response(payload, status=200):
+    """
+    Respuesta JSON serializada con orjson si está instalado; si no, jsonify de Flask
+    Los bytes de orjson.dumps se entregan tal cual a Response (sin copias intermedias)
+    """
+    if orjson is None:
+        return jsonify(payload), status
+    return Response(json_bytes(payload), status=status, mimetype='application/json')
+
+def json_bytes(payload):
+    """Serializa payload a bytes JSON (orjson si está instalado) para respuestas precalculadas"""
+    if orjson is not None:
+        return orjson.dumps(payload, option=orjson.OPT_NON_STR_KEYS)
+    return json.dumps(payload).encode('utf-8')
+
+# Respuestas precalculadas de endpoints que se consultan a menudo
+# /health: se reutiliza HEALTH_CACHE_TTL segundos; una sola petición a la vez consulta a ComfyUI
+HEALTH_CACHE_TTL = float(os.getenv("SWITCH_HEALTH_CACHE_TTL", "1.0"))
+HEALTH_PROBE_TIMEOUT = float(os.getenv("SWITCH_HEALTH_PROBE_TIMEOUT", "1.0"))  # Espera máxima a /system_stats
+HEALTH_CACHE = None  # (instante monotónico de caducidad, body)
+HEALTH_LOCK = threading.Lock()
+# /styles: STYLE_PRESETS es fijo mientras corre el servidor, se serializa una vez
+STYLES_BODY = None
+
 @app.route('/health', methods=['GET'])
 def health_check():
-    """Verificación de estado del servicio"""
-    try:
-        # Verificar conexión con ComfyUI
-        response = requests.get(f"{COMFYUI_URL}/system_stats", timeout=5)
-        comfyui_status = "ok" if response.status_code == 200 else "error"
-    except:
-        comfyui_status = "error"
+    """Verificación de estado del servicio (cacheada HEALTH_CACHE_TTL segundos)"""
+    global HEALTH_CACHE
+    cached = HEALTH_CACHE
+    if cached is None or time.monotonic() >= cached[0]:
+        with HEALTH_LOCK:
+            # Las peticiones que esperaban el lock reutilizan la respuesta recién calculada
+            cached = HEALTH_CACHE
+            if cached is None or time.monotonic() >= cached[0]:
+                try:
+                    # Verificar conexión con ComfyUI (conexión keep-alive del pool de COMFYUI_SESSION)
+                    response = COMFYUI_SESSION.get(f"{COMFYUI_URL}/system_stats", timeout=HEALTH_PROBE_TIMEOUT)
+                    comfyui_status = "ok" if response.status_code == 200 else "error"
+                except:
+                    comfyui_status = "error"
+                
+                body = json_bytes({
+                    "status": "ok",
+                    "comfyui_connection": comfyui_status,
+                    "version": "2.0.0",
+                    "timestamp": datetime.now().isoformat()
+                })
+                cached = HEALTH_CACHE = (time.monotonic() + HEALTH_CACHE_TTL, body)
     
-    return jsonify({
-        "status": "ok",
-        "comfyui_connection": comfyui_status,
-        "version": "2.0.0",
-        "timestamp": datetime.now().isoformat()
-    })
+    return Response(cached[1], mimetype='application/json')
 
 @app.route('/styles', methods=['GET'])
 def list_styles():
     """Lista estilos predefinidos disponibles"""
+    global STYLES_BODY
     try:
-        styles = get_available_styles()
-        return jsonify({
-            "styles": styles,
-            "total": len(styles),
-            "message": "Estilos cargados correctamente"
-        })
+        if STYLES_BODY is None:
+            styles = get_available_styles()
+            STYLES_BODY = json_bytes({
+                "styles": styles,
+                "total": len(styles),
+                "message": "Estilos cargados correctamente"
+            })
+        return Response(STYLES_BODY, mimetype='application/json')
     except Exception as e:
         log_error(f"Error cargando estilos: {str(e)}")
         return jsonify({"error": str(e)}), 500
@@ -1303,53 +2176,22 @@ def list_styles():
 @app.route('/workflows', methods=['GET'])
 def list_workflows():
     """Lista workflows disponibles organizados por tipo y orientación"""
-    workflows_structure = {}
-    workflows_list = []
+    catalog = get_workflow_catalog()
     
-    if os.path.exists(WORKFLOWS_DIR):
-        for root, dirs, files in os.walk(WORKFLOWS_DIR):
-            for filename in files:
-                if filename.endswith('.json'):
-                    # Obtener la ruta relativa desde workflows/
-                    rel_path = os.path.relpath(os.path.join(root, filename), WORKFLOWS_DIR)
-                    path_parts = rel_path.replace('\\', '/').split('/')
-                    
-                    # Ejemplo: bathroom/H80x60/cuadro-bathroom-open-H60x802.json
-                    if len(path_parts) >= 3:
-                        room_type = path_parts[0]  # bathroom
-                        orientation = path_parts[1]  # H80x60
-                        workflow_name = path_parts[2].replace('.json', '')  # cuadro-bathroom-open-H60x802
-                        
-                        # ID único para el workflow
-                        workflow_id = f"{room_type}/{orientation}/{workflow_name}"
-                        
-                        # Crear estructura jerárquica
-                        if room_type not in workflows_structure:
-                            workflows_structure[room_type] = {}
-                        if orientation not in workflows_structure[room_type]:
-                            workflows_structure[room_type][orientation] = []
-                        
-                        workflow_info = {
-                            "id": workflow_id,
-                            "name": workflow_name,
-                            "filename": filename,
-                            "room_type": room_type,
-                            "orientation": orientation,
-                            "path": rel_path.replace('\\', '/'),
-                            "status": "available"
-                        }
-                        
-                        workflows_structure[room_type][orientation].append(workflow_info)
-                        workflows_list.append(workflow_info)
+    # La respuesta solo cambia con el catálogo: se serializa una vez por versión del árbol
+    body = catalog['body']
+    if body is None:
+        payload = {
+            "workflows": catalog['list'],
+            "structure": catalog['structure'],
+            "total": len(catalog['list']),
+            "config": WORKFLOW_CONFIG,
+            "available_colors": WORKFLOW_CONFIG.get("frame_colors", ["black", "white", "brown", "gold", "silver"]),
+            "available_styles": get_available_styles()
+        }
+        body = catalog['body'] = json_bytes(payload)
     
-    return jsonify({
-        "workflows": workflows_list,
-        "structure": workflows_structure,
-        "total": len(workflows_list),
-        "config": WORKFLOW_CONFIG,
-        "available_colors": WORKFLOW_CONFIG.get("frame_colors", ["black", "white", "brown", "gold", "silver"]),
-        "available_styles": get_available_styles()
-    })
+    return Response(body, mimetype='application/json')
 
 @app.route('/process-image', methods=['POST'])
 def process_image():
@@ -1388,31 +2230,26 @@ def process_image():
             include_upscale=include_upscale  # Agregar parámetro de upscale
         )
         
-        log_info(f"Trabajo de sesión creado: {job_id}")
-        log_info(f"Parámetros: workflow={workflow_name}, frame_color={frame_color}, style={style_id}, style_node={style_node_id}, file={original_filename}, include_upscale={include_upscale}")
-        
-        # Actualizar estado del trabajo
-        session_manager.update_job(job_id, 
-            status='processing', 
-            current_operation='Validando parámetros...'
-        )
+        log_info("Trabajo de sesión creado: %s", job_id)
+        log_info("Parámetros: workflow=%s, frame_color=%s, style=%s, style_node=%s, file=%s, include_upscale=%s", workflow_name, frame_color, style_id, style_node_id, original_filename, include_upscale)
         
         # Validar color del marco
-        if frame_color not in WORKFLOW_CONFIG['frame_colors']:
+        if frame_color not in FRAME_COLORS:
             frame_color = 'black'
-            log_warning(f"Color de marco no válido, usando: {frame_color}")
+            log_warning("Color de marco no válido, usando: %s", frame_color)
         
         # Validar estilo
-        available_styles = [style['id'] for style in get_available_styles()]
-        if style_id not in available_styles:
+        if style_id not in STYLE_IDS:
             style_id = 'default'
-            log_warning(f"Estilo no válido, usando: {style_id}")
+            log_warning("Estilo no válido, usando: %s", style_id)
         
         # Preparar nombres y directorios
         base_name = secure_filename(original_filename.rsplit('.', 1)[0] if '.' in original_filename else 'image')
         output_dir = create_output_directory(base_name)
         
-        session_manager.update_job(job_id, current_operation='Preparando archivos...')
+        # Estado del trabajo: cada update_job reescribe el archivo de sesión completo, así que solo
+        # se escribe antes de los pasos que tardan (no en cada paso rápido de validación/preparación)
+        session_manager.update_job(job_id, status='processing', current_operation='Preparando archivos...')
         
         # 🚫 NO guardar imagen original aquí - se guardará después con las demás de manera organizada
         log_info("💾 Imagen original se guardará después junto con las generadas en nuestro directorio personalizado")
@@ -1420,8 +2257,6 @@ def process_image():
         # Guardar en input de ComfyUI (para que ComfyUI pueda procesarla)
         input_path, workflow_filename = save_uploaded_image(file, base_name)
         
-        session_manager.update_job(job_id, current_operation='Verificando acceso a la imagen...')
-        
         # Verificar que ComfyUI puede acceder al archivo (sin fallar si no puede)
         log_info("Verificando acceso a la imagen desde ComfyUI...")
         accessibility_check = verify_image_accessibility(workflow_filename)
@@ -1430,12 +2265,10 @@ def process_image():
             # Esperar un poco más para que el archivo se asiente
             time.sleep(1)
         
-        session_manager.update_job(job_id, current_operation='Cargando workflow...')
-        
-        # Cargar y actualizar workflow
-        log_info(f"Cargando workflow: {workflow_name}")
-        workflow = load_workflow(workflow_name)
-        updated_workflow = update_workflow(workflow, workflow_filename, frame_color, style_id, style_node_id, base_name)
+        # Cargar y actualizar workflow (caché por archivo: paso rápido, sin estado propio)
+        log_info("Cargando workflow: %s", workflow_name)
+        workflow, plan = load_workflow(workflow_name, with_plan=True)
+        updated_workflow = update_workflow(workflow, workflow_filename, frame_color, style_id, style_node_id, base_name, plan, include_upscale)
         
         session_manager.update_job(job_id, current_operation='Enviando a ComfyUI...')
         
@@ -1452,15 +2285,13 @@ def process_image():
         log_info("Esperando resultados...")
         outputs = wait_for_completion(prompt_id)
         
-        session_manager.update_job(job_id, current_operation='Extrayendo imágenes generadas...')
-        
         # Extraer imágenes generadas
         log_info("Extrayendo imágenes...")
         generated_images = extract_generated_images(outputs, original_filename, include_upscale)
         
-        log_info(f"📊 Resumen de imágenes extraídas: {len(generated_images)} imágenes (include_upscale={include_upscale})")
+        log_info("📊 Resumen de imágenes extraídas: %s imágenes (include_upscale=%s)", len(generated_images), include_upscale)
         for i, img in enumerate(generated_images):
-            log_info(f"   {i+1}. Tipo: {img.get('image_type', 'unknown')}, Archivo: {img['filename']}, Nodo: {img.get('node_id', 'N/A')}")
+            log_debug("   %s. Tipo: %s, Archivo: %s, Nodo: %s", i + 1, img.get('image_type', 'unknown'), img['filename'], img.get('node_id', 'N/A'))
         
         session_manager.update_job(job_id, current_operation='Guardando imágenes en nuestro directorio personalizado...')
         
@@ -1491,25 +2322,23 @@ def process_image():
             log_warning("⚠️ No se encontró imagen de composición, usando fallback...")
             frontend_images = saved_images[:1]  # Solo la primera
         
-        log_info(f"📤 Para frontend: {len(frontend_images)} imagen(es) de {len(saved_images)} guardadas")
-        log_info(f"💾 Guardadas en disco: {len(saved_images)} imágenes + 1 original")
+        log_info("📤 Para frontend: %s imagen(es) de %s guardadas", len(frontend_images), len(saved_images))
+        log_info("💾 Guardadas en disco: %s imágenes + 1 original", len(saved_images))
         
-        # Log detallado de lo que se está enviando al frontend vs lo que se guarda
-        log_info("📋 RESUMEN DE FILTRADO PARA FRONTEND:")
-        log_info(f"   💾 GUARDADAS EN DISCO ({len(saved_images)} imágenes):")
+        # Log detallado de lo que se está enviando al frontend vs lo que se guarda (nivel DEBUG)
+        log_debug("📋 RESUMEN DE FILTRADO PARA FRONTEND:")
+        log_debug("   💾 GUARDADAS EN DISCO (%s imágenes):", len(saved_images))
         for i, img in enumerate(saved_images):
-            tipo = img.get('image_type', 'unknown')
-            log_info(f"      {i+1}. {tipo.upper()}: {img['filename']}")
+            log_debug("      %s. %s: %s", i + 1, img.get('image_type', 'unknown').upper(), img['filename'])
         
-        log_info(f"   📤 ENVIADAS AL FRONTEND ({len(frontend_images)} imágenes):")
+        log_debug("   📤 ENVIADAS AL FRONTEND (%s imágenes):", len(frontend_images))
         for i, img in enumerate(frontend_images):
-            tipo = img.get('image_type', 'unknown')
-            log_info(f"      {i+1}. {tipo.upper()}: {img['filename']}")
+            log_debug("      %s. %s: %s", i + 1, img.get('image_type', 'unknown').upper(), img['filename'])
         
         # Verificar si se están filtrando upscales
-        upscale_count = len([img for img in saved_images if img.get('image_type') == 'upscale'])
+        upscale_count = sum(1 for img in saved_images if img.get('image_type') == 'upscale')
         if upscale_count > 0:
-            log_success(f"✅ FILTRADO CORRECTO: {upscale_count} imagen(es) upscale guardadas en disco pero excluidas del frontend")
+            log_success("✅ FILTRADO CORRECTO: %s imagen(es) upscale guardadas en disco pero excluidas del frontend", upscale_count)
         
         # Crear respuesta
         processing_mode = "text2img + controlnet_0.85" if (style_id and style_id != 'default') else "img2img_preserving_original"
@@ -1520,7 +2349,7 @@ def process_image():
         if frontend_images:
             final_image_info = frontend_images[0]
             final_image_url = final_image_info['session_url']
-            log_success(f"✅ Imagen final para frontend: {final_image_info['filename']} (nodo: {final_image_info.get('node_id', 'N/A')})")
+            log_success("✅ Imagen final para frontend: %s (nodo: %s)", final_image_info['filename'], final_image_info.get('node_id', 'N/A'))
         
         response = {
             "success": True,
@@ -1561,38 +2390,78 @@ def process_image():
     except FileNotFoundError as e:
         if job_id:
             session_manager.update_job(job_id, status='error', error=f"Workflow no encontrado: {str(e)}")
-        log_error(f"Workflow no encontrado: {str(e)}")
+        log_error("Workflow no encontrado: %s", str(e))
         return jsonify({"error": f"Workflow no encontrado: {str(e)}"}), 404
     except TimeoutError as e:
         if job_id:
             session_manager.update_job(job_id, status='error', error=f"Timeout en procesamiento: {str(e)}")
-        log_error(f"Timeout en procesamiento: {str(e)}")
+        log_error("Timeout en procesamiento: %s", str(e))
         return jsonify({"error": f"Timeout en procesamiento: {str(e)}"}), 408
     except Exception as e:
         if job_id:
             session_manager.update_job(job_id, status='error', error=str(e))
-        log_error(f"Error en procesamiento: {str(e)}")
+        log_error("Error en procesamiento: %s", str(e))
         return jsonify({"error": str(e)}), 500
 
+THUMBNAIL_SIZE = 256  # Lado máximo de las miniaturas de /get-thumb
+
+def resolve_output_image(base_name, filename):
+    """
+    Localiza una imagen de salida: primero en nuestro directorio, luego en ComfyUI
+    Retorna: ruta completa del archivo o None
+    """
+    our_file_path = os.path.join(OUR_OUTPUT_DIR, base_name, filename)
+    if os.path.exists(our_file_path):
+        return our_file_path
+    
+    comfyui_file_path = os.path.join(COMFYUI_OUTPUT_DIR, base_name, filename)
+    if os.path.exists(comfyui_file_path):
+        return comfyui_file_path
+    
+    return None
+
+def send_image_file(path, **kwargs):
+    """
+    send_file de una imagen; con SWITCH_X_ACCEL_PREFIX y path bajo X_ACCEL_LOCATIONS responde solo con
+    X-Accel-Redirect y nginx envía el archivo (sendfile, Range y 304 incluidos)
+    Sin proxy: send_file con conditional=True (304/206 sin leer el archivo en Python)
+    """
+    if X_ACCEL_PREFIX:
+        for root, location in X_ACCEL_LOCATIONS:
+            if path.startswith(root + os.sep):
+                relative = os.path.relpath(path, root).replace(os.sep, '/')
+                response = Response(mimetype=mimetypes.guess_type(path)[0] or 'application/octet-stream')
+                response.headers['X-Accel-Redirect'] = quote(f"{X_ACCEL_PREFIX}/{location}/{relative}")
+                if kwargs.get('as_attachment'):
+                    download_name = kwargs.get('download_name') or os.path.basename(path)
+                    response.headers['Content-Disposition'] = f'attachment; filename="{download_name}"'
+                return response
+    kwargs.setdefault('conditional', True)
+    return send_file(path, **kwargs)
+
+@lru_cache(maxsize=2048)
+def cached_secure_filename(name):
+    """
+    secure_filename memoizado para las rutas que sirven imágenes: el cliente pide las mismas URLs
+    una y otra vez (miniaturas, imagen final) y secure_filename es una función pura
+    """
+    return secure_filename(name)
+
 @app.route('/get-image/<base_name>/<filename>', methods=['GET'])
 def get_image(base_name, filename):
     """Descarga una imagen del directorio de salida (mantener compatibilidad)"""
     try:
         # Sanitizar parámetros
-        base_name = secure_filename(base_name)
-        filename = secure_filename(filename)
+        base_name = cached_secure_filename(base_name)
+        filename = cached_secure_filename(filename)
         
-        # 1. Buscar primero en nuestro directorio personalizado
-        our_file_path = os.path.join(OUR_OUTPUT_DIR, base_name, filename)
-        if os.path.exists(our_file_path):
-            log_success(f"📤 Enviando archivo desde nuestro directorio: {our_file_path}")
-            return send_file(our_file_path, as_attachment=True, download_name=filename)
-        
-        # 2. Buscar en el directorio de ComfyUI como respaldo
-        comfyui_file_path = os.path.join(COMFYUI_OUTPUT_DIR, base_name, filename)
-        if os.path.exists(comfyui_file_path):
-            log_success(f"📤 Enviando archivo desde ComfyUI output: {comfyui_file_path}")
-            return send_file(comfyui_file_path, as_attachment=True, download_name=filename)
+        # Buscar primero en nuestro directorio personalizado, luego en ComfyUI como respaldo
+        file_path = resolve_output_image(base_name, filename)
+        if file_path:
+            log_success(f"📤 Enviando archivo: {file_path}")
+            # conditional=True: Werkzeug responde 304 (If-None-Match) y 206 (Range) automáticamente
+            return send_image_file(file_path, as_attachment=True, download_name=filename,
+                                   etag=True, last_modified=os.path.getmtime(file_path))
         
         log_error(f"❌ Archivo no encontrado en ningún directorio: {filename}")
         return jsonify({"error": "Archivo no encontrado"}), 404
@@ -1601,6 +2470,32 @@ def get_image(base_name, filename):
         log_error(f"❌ Error al obtener imagen: {str(e)}")
         return jsonify({"error": str(e)}), 500
 
+@app.route('/get-thumb/<base_name>/<filename>', methods=['GET'])
+def get_thumbnail(base_name, filename):
+    """Devuelve una miniatura JPEG de una imagen de salida (para listados en el cliente web)"""
+    try:
+        base_name = cached_secure_filename(base_name)
+        filename = cached_secure_filename(filename)
+        
+        file_path = resolve_output_image(base_name, filename)
+        if not file_path:
+            return jsonify({"error": "Archivo no encontrado"}), 404
+        
+        with Image.open(file_path) as image:
+            # Con JPEG, draft() hace que libjpeg decodifique ya reducido (sin IDCT completa)
+            image.draft('RGB', (THUMBNAIL_SIZE, THUMBNAIL_SIZE))
+            thumb = image.convert('RGB') if image.mode != 'RGB' else image
+            thumb.thumbnail((THUMBNAIL_SIZE, THUMBNAIL_SIZE))
+            buffer = BytesIO()
+            thumb.save(buffer, format='JPEG', quality=80)
+        
+        return Response(buffer.getvalue(), mimetype='image/jpeg',
+                        headers={'Cache-Control': 'public, max-age=86400'})
+        
+    except Exception as e:
+        log_error(f"❌ Error generando miniatura: {str(e)}")
+        return jsonify({"error": str(e)}), 500
+
 @app.route('/workflow-nodes/<path:workflow_name>', methods=['GET'])
 def get_workflow_nodes(workflow_name):
     """Obtiene los nodos candidatos para aplicar estilos en un workflow específico"""
@@ -1610,36 +2505,36 @@ def get_workflow_nodes(workflow_name):
         # Use the existing load_workflow function that handles path resolution
         workflow_data = load_workflow(workflow_name)
         
-        # Collect SeargeTextInputV2 nodes as style candidates
-        candidates = []
+        # Collect SeargeTextInputV2 nodes as style candidates (una pasada: filtro + construcción)
+        # Cada candidato va con su clave de orden ya calculada: recomendados primero, luego por ID
+        keyed_candidates = []
         for node_id, node in workflow_data.items():
-            if node.get('class_type') == 'SeargeTextInputV2':
-                title = node.get('_meta', {}).get('title', '')
-                current_prompt = node.get('inputs', {}).get('prompt', '')
-                
-                # Determine if this is a recommended style node
-                is_recommended = 'style' in title.lower() or node_id == '6'
-                
-                # Create node info with all properties the client expects
-                node_info = {
-                    'id': node_id,
-                    'title': title,
-                    'name': title or f'Nodo {node_id}',
-                    'type': 'SeargeTextInputV2',
-                    'description': f'Nodo de texto para prompts ({title})' if title else f'Nodo de texto {node_id}',
-                    'recommended': is_recommended,
-                    'current_value': current_prompt[:100] + '...' if len(current_prompt) > 100 else current_prompt,
-                    'class_type': node.get('class_type')
-                }
-                
-                candidates.append(node_info)
-                log_info(f"📝 Nodo encontrado: {node_id} - {title} (recomendado: {is_recommended})")
+            if node.get('class_type') != 'SeargeTextInputV2':
+                continue
+            title = node.get('_meta', {}).get('title', '')
+            current_prompt = node.get('inputs', {}).get('prompt', '')
+            
+            # Determine if this is a recommended style node
+            is_recommended = node_id == '6' or 'style' in title.lower()
+            
+            # Create node info with all properties the client expects
+            keyed_candidates.append(((not is_recommended, int(node_id) if node_id.isdigit() else node_id), {
+                'id': node_id,
+                'title': title,
+                'name': title or f'Nodo {node_id}',
+                'type': 'SeargeTextInputV2',
+                'description': f'Nodo de texto para prompts ({title})' if title else f'Nodo de texto {node_id}',
+                'recommended': is_recommended,
+                'current_value': current_prompt[:100] + '...' if len(current_prompt) > 100 else current_prompt,
+                'class_type': 'SeargeTextInputV2'
+            }))
         
         # Sort candidates: recommended first, then by node ID
-        candidates.sort(key=lambda x: (not x['recommended'], int(x['id']) if x['id'].isdigit() else x['id']))
+        keyed_candidates.sort(key=itemgetter(0))
+        candidates = [node_info for _, node_info in keyed_candidates]
         
         log_success(f"✅ {len(candidates)} nodos candidatos encontrados para {workflow_name}")
-        return jsonify({
+        return json_response({
             'success': True,
             'workflow_name': workflow_name, 
             'nodes': candidates,
@@ -1649,25 +2544,63 @@ def get_workflow_nodes(workflow_name):
         
     except FileNotFoundError:
         log_error(f"❌ Workflow no encontrado: {workflow_name}")
-        return jsonify({'success': False, 'error': 'Workflow not found'}), 404
+        return json_response({'success': False, 'error': 'Workflow not found'}, 404)
     except Exception as e:
         log_error(f"❌ Error getting workflow nodes for {workflow_name}: {str(e)}")
-        return jsonify({'success': False, 'error': str(e)}), 500
+        return json_response({'success': False, 'error': str(e)}, 500)
+
+def results_with_iso_times(results):
+    """
+    Añade 'completion_time' en ISO 8601 a partir de 'completion_time_ns'
+    Solo se formatea al responder (?iso=1), nunca en el camino de completado
+    Con orjson se guarda el datetime y orjson lo formatea al serializar
+    """
+    converted = []
+    for result in results:
+        completion_ns = result.get('completion_time_ns') if result else None
+        if completion_ns is not None:
+            result = dict(result)
+            completion_time = datetime.fromtimestamp(completion_ns / 1e9)
+            result['completion_time'] = completion_time if orjson is not None else completion_time.isoformat()
+        converted.append(result)
+    return converted
+
+# Espera máxima de un long-poll de /batch-status (?wait=N): cada espera ocupa un hilo/greenlet del servidor
+BATCH_STATUS_MAX_WAIT = float(os.getenv("SWITCH_BATCH_STATUS_MAX_WAIT", "10"))
 
 @app.route('/batch-status/<batch_id>', methods=['GET'])
 def get_batch_status(batch_id):
     """
     Obtiene el status actual de un batch en progreso con información de sesión
-    Consulta tanto ACTIVE_BATCHES como el sistema de sesión para persistencia
+    Consulta los batches activos, los terminados recientes y el sistema de sesión para persistencia
+    Batches en memoria: ETag con la versión del batch; If-None-Match igual -> 304 sin cuerpo.
+    Con ?wait=N (y If-None-Match) la petición espera hasta N segundos a que el batch cambie (long-poll)
     """
-    batch_info = None
+    iso = request.args.get('iso') == '1'
+    
+    # 1. Primero intentar obtener el batch en progreso o de COMPLETED_BATCHES (recientes)
+    tracked = find_batch(batch_id)
+    version = None
+    if tracked is not None:
+        version = tracked.version
+        etag = f'"{version}-{int(iso)}"'
+        if request.headers.get('If-None-Match') == etag:
+            wait = min(request.args.get('wait', 0, type=float), BATCH_STATUS_MAX_WAIT)
+            if wait > 0:
+                version = wait_batch_change(tracked, version, wait)
+                etag = f'"{version}-{int(iso)}"'
+            if request.headers.get('If-None-Match') == etag:
+                return Response(status=304, headers={'ETag': etag})
+        
+        # Si el batch no ha cambiado desde el último poll se reutiliza la respuesta ya serializada
+        cached = tracked.status_body
+        if cached is not None and cached[0] == version and cached[1] == iso:
+            return Response(cached[2], mimetype='application/json', headers={'ETag': etag})
     
-    # 1. Primero intentar obtener de ACTIVE_BATCHES (batch en progreso)
-    with BATCH_LOCK:
-        if batch_id in ACTIVE_BATCHES:
-            batch_info = ACTIVE_BATCHES[batch_id].copy()
+    # Búsqueda sin locks; la foto (sin los internos del drainer) solo toma el lock de ese batch
+    batch_info = batch_snapshot(batch_id)
     
-    # 2. Si no está en ACTIVE_BATCHES, buscar en el sistema de sesión
+    # 2. Si no está en memoria, buscar en el sistema de sesión
     if not batch_info:
         # Buscar en todos los jobs de sesión por batch_tracking_id
         all_jobs = session_manager.get_all_active_jobs()
@@ -1689,7 +2622,15 @@ def get_batch_status(batch_id):
                 break
     
     if not batch_info:
-        return jsonify({"error": "Batch no encontrado"}), 404
+        return json_response({"error": "Batch no encontrado"}, 404)
+    
+    # Estimación de tiempo restante calculada solo al leer (las completions son mucho más frecuentes que los polls)
+    completed = batch_info.get('completed_workflows', 0)
+    if 'start_time' in batch_info and completed and batch_info.get('status') not in ('completed', 'error'):
+        now = time.time()
+        avg_time_per_workflow = (now - batch_info['start_time']) / completed
+        remaining_workflows = batch_info['total_workflows'] - completed
+        batch_info['estimated_completion'] = now + avg_time_per_workflow * remaining_workflows
     
     # 3. Agregar información del job de sesión si está disponible
     session_job_id = batch_info.get('session_job_id')
@@ -1704,41 +2645,53 @@ def get_batch_status(batch_id):
                 'results_count': len(session_job.get('results', []))
             }
     
-    return jsonify(batch_info)
+    # Timestamps como enteros (ns) salvo que el cliente pida ISO explícitamente
+    # (results y final_results llevan los mismos dicts de resultado: se convierten los dos)
+    if iso:
+        for key in ('results', 'final_results'):
+            if batch_info.get(key):
+                batch_info[key] = results_with_iso_times(batch_info[key])
+    
+    if version is None:
+        return json_response(batch_info)
+    
+    # La ETA queda fijada hasta la siguiente completion (se recalcula al cambiar la versión)
+    body = json_bytes(batch_info)
+    tracked.status_body = (version, iso, body)
+    return Response(body, mimetype='application/json', headers={'ETag': etag})
 
 @app.route('/batch-status/<batch_id>', methods=['DELETE'])
 def clear_batch_status(batch_id):
     """
     Limpia un batch completado del tracking (mantiene la sesión persistente)
     """
-    with BATCH_LOCK:
-        if batch_id in ACTIVE_BATCHES:
-            session_job_id = ACTIVE_BATCHES[batch_id].get('session_job_id')
-            del ACTIVE_BATCHES[batch_id]
-            
-            message = f"Batch {batch_id} eliminado del tracking"
-            if session_job_id:
-                message += f". Job de sesión {session_job_id} mantenido para persistencia"
-            
-            return jsonify({
-                "success": True, 
-                "message": message,
-                "session_job_id": session_job_id
-            })
-        else:
-            return jsonify({"error": "Batch no encontrado"}), 404
+    removed = remove_batch(batch_id)
+    if removed is not None:
+        session_job_id = removed.session_job_id
+        
+        message = f"Batch {batch_id} eliminado del tracking"
+        if session_job_id:
+            message += f". Job de sesión {session_job_id} mantenido para persistencia"
+        
+        return json_response({
+            "success": True, 
+            "message": message,
+            "session_job_id": session_job_id
+        })
+    else:
+        return json_response({"error": "Batch no encontrado"}, 404)
 
 @app.route('/active-batches', methods=['GET'])
 def get_active_batches():
     """
     Obtiene la lista de todos los batches activos
     """
-    with BATCH_LOCK:
-        batches = {bid: {"status": info["status"], "total_workflows": info["total_workflows"], 
-                        "completed_workflows": info["completed_workflows"]} 
-                  for bid, info in ACTIVE_BATCHES.items()}
+    # Foto sin locks: cada campo es una lectura simple
+    batches = {bid: {"status": info.status, "total_workflows": info.total_workflows, 
+                     "completed_workflows": info.completed_workflows} 
+               for bid, info in snapshot_active_batches().items()}
     
-    return jsonify({"active_batches": batches, "count": len(batches)})
+    return json_response({"active_batches": batches, "count": len(batches)})
 
 # ===== ENDPOINTS DE PERSISTENCIA DE SESIÓN =====
 
@@ -1749,13 +2702,13 @@ def get_session_jobs():
         jobs = session_manager.get_all_active_jobs()
         summary = session_manager.get_session_summary()
         
-        return jsonify({
+        return json_response({
             "success": True,
             "jobs": jobs,
             "summary": summary
         })
     except Exception as e:
-        return jsonify({"success": False, "error": str(e)}), 500
+        return json_response({"success": False, "error": str(e)}, 500)
 
 @app.route('/session/jobs/<job_id>', methods=['GET'])
 def get_session_job(job_id):
@@ -1765,11 +2718,11 @@ def get_session_job(job_id):
         if job:
             # Agregar URLs de imágenes si existen
             job['image_urls'] = session_manager.get_job_images(job_id)
-            return jsonify({"success": True, "job": job})
+            return json_response({"success": True, "job": job})
         else:
-            return jsonify({"success": False, "error": "Trabajo no encontrado"}), 404
+            return json_response({"success": False, "error": "Trabajo no encontrado"}, 404)
     except Exception as e:
-        return jsonify({"success": False, "error": str(e)}), 500
+        return json_response({"success": False, "error": str(e)}, 500)
 
 @app.route('/session/jobs/<job_id>', methods=['DELETE'])
 def delete_session_job(job_id):
@@ -1777,19 +2730,19 @@ def delete_session_job(job_id):
     try:
         success = session_manager.delete_job(job_id)
         if success:
-            return jsonify({"success": True, "message": "Trabajo eliminado"})
+            return json_response({"success": True, "message": "Trabajo eliminado"})
         else:
-            return jsonify({"success": False, "error": "Trabajo no encontrado"}), 404
+            return json_response({"success": False, "error": "Trabajo no encontrado"}, 404)
     except Exception as e:
-        return jsonify({"success": False, "error": str(e)}), 500
+        return json_response({"success": False, "error": str(e)}, 500)
 
 @app.route('/session/images/<job_id>/<filename>', methods=['GET'])
 def serve_session_image(job_id, filename):
     """Sirve imágenes de trabajos de sesión"""
     try:
         # Sanitizar parámetros
-        job_id = secure_filename(job_id)
-        filename = secure_filename(filename)
+        job_id = cached_secure_filename(job_id)
+        filename = cached_secure_filename(filename)
         
         image_path = os.path.join(session_manager.session_dir, job_id, filename)
         
@@ -1797,7 +2750,7 @@ def serve_session_image(job_id, filename):
         
         if os.path.exists(image_path):
             log_success(f"Imagen de sesión encontrada: {image_path}")
-            return send_file(image_path)
+            return send_image_file(image_path)
         else:
             log_error(f"Imagen de sesión no encontrada: {image_path}")
             return jsonify({"error": "Imagen no encontrada"}), 404
@@ -1844,44 +2797,64 @@ def clear_session():
             "session_reset": False
         }), 500
 
+@app.route('/admin/invalidate-cache', methods=['POST'])
+def invalidate_cache():
+    """Fuerza a releer los workflows del disco (índice, catálogo de /workflows y workflows parseados)"""
+    try:
+        dropped = invalidate_workflow_caches()
+        log_info("🧹 Cachés de workflows invalidadas (%d workflows parseados descartados)", dropped)
+        return jsonify({
+            "success": True,
+            "message": "Cachés de workflows invalidadas",
+            "workflows_dropped": dropped
+        })
+    except Exception as e:
+        log_error("❌ Error invalidando cachés: %s", str(e))
+        return jsonify({"success": False, "error": str(e)}), 500
+
+# Clientes web: rutas resueltas una vez al importar
+FIXED_CLIENT_PATH = os.path.join(STATIC_DIR, 'web_client_fixed.html')
+ORIGINAL_CLIENT_PATH = os.path.join(STATIC_DIR, 'web_client.html')
+
 @app.route('/')
 def serve_client():
-    """Sirve el cliente web principal"""
-    client_path = os.path.join(BASE_DIR, 'web_client_fixed.html')
-    if os.path.exists(client_path):
-        return send_file(client_path)
-    else:
-        # Fallback al cliente original
-        fallback_path = os.path.join(BASE_DIR, 'web_client.html')
-        if os.path.exists(fallback_path):
-            return send_file(fallback_path)
-        else:
-            return jsonify({
-                "message": "ComfyUI API REST - Nueva implementación",
-                "version": "2.0.0",
-                "endpoints": ["/health", "/workflows", "/styles", "/workflow-nodes/<workflow_name>", "/process-image", "/process-batch", "/get-image"],
-                "web_clients": ["/web_client_fixed.html", "/web_client.html"]
-            })
+    """
+    Sirve el cliente web principal directamente (sin redirección: el navegador revalida con ETag)
+    Sin os.path.exists previo: send_file ya hace el stat; se elige el cliente en cada petición
+    """
+    for client_path in (FIXED_CLIENT_PATH, ORIGINAL_CLIENT_PATH):  # Fallback al cliente original
+        try:
+            return send_file(client_path, conditional=True, max_age=CLIENT_MAX_AGE)
+        except FileNotFoundError:
+            pass
+    return jsonify({
+        "message": "ComfyUI API REST - Nueva implementación",
+        "version": "2.0.0",
+        "endpoints": ["/health", "/workflows", "/styles", "/workflow-nodes/<workflow_name>", "/process-image", "/process-batch", "/get-image"],
+        "web_clients": ["/web_client_fixed.html", "/web_client.html"]
+    })
 
 @app.route('/web_client_fixed.html')
 def serve_fixed_client():
     """Sirve el cliente web corregido"""
-    client_path = os.path.join(BASE_DIR, 'web_client_fixed.html')
-    if os.path.exists(client_path):
-        return send_file(client_path)
-    else:
+    # Sin os.path.exists previo: send_file ya hace el stat (y falla si el archivo no está)
+    try:
+        # conditional=True: el navegador revalida con ETag/If-Modified-Since (304)
+        return send_file(FIXED_CLIENT_PATH, conditional=True, max_age=CLIENT_MAX_AGE)
+    except FileNotFoundError:
         return jsonify({"error": "Cliente web corregido no encontrado"}), 404
 
 @app.route('/web_client.html')
 def serve_original_client():
     """Servir el cliente web original (fallback)"""
     try:
-        return send_file('web_client.html')
+        return send_file(ORIGINAL_CLIENT_PATH, conditional=True, max_age=CLIENT_MAX_AGE)
     except FileNotFoundError:
-        return jsonify({
-            "error": "Cliente web original no encontrado",
-            "message": "Use /web_client_fixed.html en su lugar"
-        }), 404
+        pass
+    return jsonify({
+        "error": "Cliente web original no encontrado",
+        "message": "Use /web_client_fixed.html en su lugar"
+    }), 404
 
 # ==================== FUNCIONES AUXILIARES ADICIONALES ====================
 
@@ -1890,39 +2863,11 @@ def is_allowed_file(filename):
     return allowed_file(filename)
 
 def get_available_workflows():
-    """Obtiene la lista de workflows disponibles"""
-    workflows = []
-    
-    if os.path.exists(WORKFLOWS_DIR):
-        for root, dirs, files in os.walk(WORKFLOWS_DIR):
-            for filename in files:
-                if filename.endswith('.json'):
-                    # Obtener la ruta relativa desde workflows/
-                    rel_path = os.path.relpath(os.path.join(root, filename), WORKFLOWS_DIR)
-                    path_parts = rel_path.replace('\\', '/').split('/')
-                    
-                    # Ejemplo: bathroom/H80x60/cuadro-bathroom-open-H60x802.json
-                    if len(path_parts) >= 3:
-                        room_type = path_parts[0]  # bathroom
-                        orientation = path_parts[1]  # H80x60
-                        workflow_name = path_parts[2].replace('.json', '')  # cuadro-bathroom-open-H60x802
-                        
-                        # ID único para el workflow
-                        workflow_id = f"{room_type}/{orientation}/{workflow_name}"
-                        
-                        workflow_info = {
-                            "id": workflow_id,
-                            "name": workflow_name,
-                            "filename": filename,
-                            "room_type": room_type,
-                            "orientation": orientation,
-                            "path": rel_path.replace('\\', '/'),
-                            "status": "available"
-                        }
-                        
-                        workflows.append(workflow_info)
-    
-    return workflows
+    """
+    Obtiene la lista de workflows disponibles (del catálogo cacheado)
+    Lista nueva, pero los diccionarios de cada workflow son compartidos: no modificarlos
+    """
+    return list(get_workflow_catalog()['list'])
 
 # ==================== PROCESAMIENTO EN LOTE ====================
 
@@ -1951,7 +2896,7 @@ def process_batch():
         if 'batch_config' in request.form:
             try:
                 batch_config = json.loads(request.form['batch_config'])
-                log_info(f"📋 Configuración del batch desde JSON: {batch_config}")
+                log_info("📋 Configuración del batch desde JSON: %s", batch_config)
             except json.JSONDecodeError:
                 log_warning("⚠️ Error decodificando batch_config JSON, usando parámetros individuales")
         
@@ -1979,10 +2924,10 @@ def process_batch():
         # Verificar que tenemos un nombre válido
         if not original_filename or original_filename.strip() == '':
             original_filename = image_file.filename
-            log_warning(f"⚠️ original_filename vacío, usando filename del archivo: '{original_filename}'")
+            log_warning("⚠️ original_filename vacío, usando filename del archivo: '%s'", original_filename)
         
-        log_info(f"📋 Nombre archivo original para batch: '{original_filename}' (de form: '{request.form.get('original_filename')}', filename: '{image_file.filename}')")
-        log_info(f"📈 Incluir upscale en batch: {include_upscale}")
+        log_info("📋 Nombre archivo original para batch: '%s' (de form: '%s', filename: '%s')", original_filename, request.form.get('original_filename'), image_file.filename)
+        log_info("📈 Incluir upscale en batch: %s", include_upscale)
         
         # ===== CREAR TRABAJO DE SESIÓN PARA BATCH =====
         batch_job_id = session_manager.create_job(
@@ -1998,36 +2943,20 @@ def process_batch():
             failed=0
         )
         
-        log_info(f"🆔 Trabajo de sesión batch creado: {batch_job_id}")
+        log_info("🆔 Trabajo de sesión batch creado: %s", batch_job_id)
         
-        # Actualizar estado del trabajo
-        session_manager.update_job(batch_job_id, 
-            status='processing', 
-            current_operation='Validando parámetros del batch...'
-        )
-        
-        log_info(f"📋 Configuración del batch: {batch_config}")
-        log_info(f"🎨 Parámetros: frame_color={frame_color}, style={style}")
-        
-        # Actualizar estado del trabajo
-        session_manager.update_job(batch_job_id, current_operation='Validando estilo...')
+        log_info("📋 Configuración del batch: %s", batch_config)
+        log_info("🎨 Parámetros: frame_color=%s, style=%s", frame_color, style)
         
-        # Validar estilo
-        available_styles = get_available_styles()
-        available_style_ids = [style['id'] for style in available_styles]
-        if style not in available_style_ids:
+        # Validar estilo, obtener y filtrar workflows: pasos rápidos, el estado se escribe una vez al final
+        if style not in STYLE_IDS:
+            available_style_ids = [style['id'] for style in get_available_styles()]
             session_manager.update_job(batch_job_id, status='error', error=f"Estilo no encontrado: {style}")
             return jsonify({"error": f"Estilo no encontrado: {style}. Estilos disponibles: {available_style_ids}"}), 400
         
-        # Actualizar estado del trabajo
-        session_manager.update_job(batch_job_id, current_operation='Obteniendo workflows disponibles...')
-        
         # Obtener workflows disponibles
         available_workflows = get_available_workflows()
         
-        # Actualizar estado del trabajo
-        session_manager.update_job(batch_job_id, current_operation='Filtrando workflows...')
-        
         # Filtrar workflows según criterios del batch
         filtered_workflows = filter_workflows_for_batch(batch_config, available_workflows)
         
@@ -2040,22 +2969,28 @@ def process_batch():
                 "criteria": batch_config
             }), 400
         
-        # Actualizar total de workflows en el job de sesión
+        log_info("🎯 Workflows seleccionados: %s/%s", len(filtered_workflows), len(available_workflows))
+        
+        # Generar ID único para este batch (diferente del job_id de sesión)
+        batch_id = datetime.now().strftime("%Y%m%d_%H%M%S") + "_" + str(uuid.uuid4())[:8]
+        
+        # Actualizar el job de sesión en una sola escritura: estado, total de workflows y
+        # referencia entre batch_id y job_id de sesión
         session_manager.update_job(batch_job_id, 
+            status='processing',
             total_workflows=len(filtered_workflows),
             workflows=[w["id"] for w in filtered_workflows],
-            current_operation=f'Preparando procesamiento de {len(filtered_workflows)} workflows...'
+            current_operation=f'Preparando procesamiento de {len(filtered_workflows)} workflows...',
+            batch_tracking_id=batch_id
         )
         
-        log_info(f"🎯 Workflows seleccionados: {len(filtered_workflows)}/{len(available_workflows)}")
-        
-        # Guardar imagen original en la sesión inmediatamente
-
-        session_manager.update_job(batch_job_id, current_operation='Guardando imagen original...')
+        # Guardar imagen original en la sesión inmediatamente (escritura en segundo plano,
+        # se espera antes de responder con su URL)
+        session_writes = []
         image_file.seek(0)
         original_image_data = image_file.read()
-        session_original_url = session_manager.save_job_image(batch_job_id, original_image_data, 'original.png')
-        log_info(f"🖼️ Imagen original guardada en sesión: {session_original_url}")
+        session_original_url = save_job_image_async(batch_job_id, original_image_data, 'original.png', session_writes)
+        log_info("🖼️ Imagen original guardada en sesión: %s", session_original_url)
         
         # Preparar parámetros comunes
         common_params = {
@@ -2065,7 +3000,7 @@ def process_batch():
             "original_filename": original_filename  # Agregar nombre de imagen original
         }
         
-        log_info(f"🔧 Parámetros comunes para batch: {common_params}")
+        log_info("🔧 Parámetros comunes para batch: %s", common_params)
         
         # Obtener nodos de estilo si es necesario
         if filtered_workflows:
@@ -2074,35 +3009,22 @@ def process_batch():
             if style_nodes:
                 common_params["style_node"] = style_nodes[0]["id"]
         
-        # Generar ID único para este batch (diferente del job_id de sesión)
-        batch_id = datetime.now().strftime("%Y%m%d_%H%M%S") + "_" + str(uuid.uuid4())[:8]
-        
-        # Almacenar referencia entre batch_id y job_id de sesión
-        session_manager.update_job(batch_job_id, batch_tracking_id=batch_id)
-        
         # Inicializar tracking del batch
-        with BATCH_LOCK:
-            ACTIVE_BATCHES[batch_id] = {
-                "batch_id": batch_id,
-                "session_job_id": batch_job_id,  # Referencia al job de sesión
-                "status": "starting",
-                "total_workflows": len(filtered_workflows),
-                "completed_workflows": 0,
-                "successful": 0,
-                "failed": 0,
-                "results": [],
-                "start_time": time.time(),
-                "estimated_completion": None,
-                "current_operation": "Iniciando procesamiento...",
-                "workflow_list": [w["id"] for w in filtered_workflows]
-            }
+        tracked_batch = BatchInfo(
+            batch_id=batch_id,
+            total_workflows=len(filtered_workflows),
+            session_job_id=batch_job_id,  # Referencia al job de sesión
+            start_time=time.time(),
+            workflow_list=[w["id"] for w in filtered_workflows]
+        )
+        register_batch(tracked_batch)
         
-        log_info(f"🚀 Iniciando procesamiento simultáneo de {len(filtered_workflows)} workflows...")
-        log_info(f"📊 Batch ID para tracking: {batch_id}")
-        log_info(f"🆔 Session Job ID: {batch_job_id}")
+        log_info("🚀 Iniciando procesamiento simultáneo de %s workflows...", len(filtered_workflows))
+        log_info("📊 Batch ID para tracking: %s", batch_id)
+        log_info("🆔 Session Job ID: %s", batch_job_id)
         
         # 🎯 APLICAR THROTTLING DE BATCH
-        log_info(f"⏰ Aplicando throttling de batch para {len(filtered_workflows)} workflows...")
+        log_info("⏰ Aplicando throttling de batch para %s workflows...", len(filtered_workflows))
         throttle_wait_time = enforce_batch_throttle(len(filtered_workflows))
         
         if throttle_wait_time > 0:
@@ -2118,17 +3040,22 @@ def process_batch():
         # Iniciar procesamiento en thread separado
         def process_batch_async():
             try:
-                results = process_all_workflows_simultáneamente_with_tracking(
-                    image_data, filtered_workflows, common_params, batch_id, batch_job_id
-                )
+                drainer = start_batch_drainer(tracked_batch, batch_job_id)
+                try:
+                    results = process_all_workflows_simultáneamente_with_tracking(
+                        image_data, filtered_workflows, common_params, batch_id, batch_job_id
+                    )
+                finally:
+                    # Integrar los últimos resultados encolados antes de finalizar
+                    stop_batch_drainer(tracked_batch, drainer)
                 
                 # Finalizar batch Y sesión
-                with BATCH_LOCK:
-                    if batch_id in ACTIVE_BATCHES:
-                        batch_info = ACTIVE_BATCHES[batch_id]
-                        batch_info["status"] = "completed"
-                        batch_info["total_processing_time"] = round(time.time() - batch_info["start_time"], 2)
-                        batch_info["final_results"] = results
+                # El estado se asigna el último: quien vea "completed" ya ve los resultados finales
+                set_batch_fields(batch_id,
+                    total_processing_time=round(time.time() - tracked_batch.start_time, 2),
+                    final_results=results,
+                    status="completed"
+                )
                 
                 # Finalizar job de sesión con URLs de sesión mejoradas
                 successful_results = [r for r in results if r.get('success', False)]
@@ -2145,7 +3072,7 @@ def process_batch():
                             if img.get('session_url') and img['session_url'] not in all_session_images:
                                 all_session_images.append(img['session_url'])
                 
-                log_info(f"📊 Finalizando batch - Total URLs de sesión recolectadas: {len(all_session_images)}")
+                log_info("📊 Finalizando batch - Total URLs de sesión recolectadas: %s", len(all_session_images))
                 
                 # Preparar results mejorados para sesión
                 session_results = []
@@ -2171,14 +3098,12 @@ def process_batch():
                     current_operation=f'Completado: {len(successful_results)} exitosos, {len(failed_results)} fallidos'
                 )
                 
-                log_success(f"✅ Batch {batch_id} completado: {len(successful_results)}/{len(results)} exitosos")
+                log_success("✅ Batch %s completado: %s/%s exitosos", batch_id, len(successful_results), len(results))
+                retire_batch(batch_id)
                         
             except Exception as e:
-                log_error(f"❌ Error en procesamiento async de batch {batch_id}: {str(e)}")
-                with BATCH_LOCK:
-                    if batch_id in ACTIVE_BATCHES:
-                        ACTIVE_BATCHES[batch_id]["status"] = "error"
-                        ACTIVE_BATCHES[batch_id]["error"] = str(e)
+                log_exception("❌ Error en procesamiento async de batch %s: %s", batch_id, e)
+                set_batch_fields(batch_id, error=str(e), status="error")
                 
                 # Actualizar job de sesión con error pero conservando posibles imágenes ya procesadas
                 existing_images = session_manager.get_job_images(batch_job_id)
@@ -2189,13 +3114,15 @@ def process_batch():
                     # Conservar imágenes ya procesadas si existen
                     completed_workflows=len(existing_images) if existing_images else 0
                 )
+                retire_batch(batch_id)
         
         # Iniciar thread
         thread = threading.Thread(target=process_batch_async)
         thread.daemon = True
         thread.start()
         
-        # Retornar inmediatamente el ID del batch para tracking
+        # Retornar inmediatamente el ID del batch para tracking (con la original de sesión ya en disco)
+        wait_session_writes(session_writes)
         return jsonify({
             "success": True,
             "batch_id": batch_id,
@@ -2220,7 +3147,7 @@ def process_batch():
         })
         
     except Exception as e:
-        log_error(f"❌ Error en procesamiento batch: {str(e)}")
+        log_error("❌ Error en procesamiento batch: %s", str(e))
         
         # Actualizar job de sesión si existe
         if batch_job_id:
@@ -2244,53 +3171,71 @@ def get_batch_throttle_status():
         with BATCH_THROTTLE_LOCK:
             # Calcular tiempo restante para poder enviar el siguiente lote
             remaining_wait_time = calculate_batch_throttle_delay(0)  # 0 prompts para solo calcular
-            
-            # Información sobre el lote actual
-            time_since_last_batch = current_time - LAST_BATCH_SUBMIT_TIME if LAST_BATCH_SUBMIT_TIME > 0 else 0
-            # Tiempo estimado de procesamiento mínimo (1s por prompt)
-            estimated_completion_time = LAST_BATCH_SUBMIT_TIME + (CURRENT_BATCH_PROMPTS * 1.0)
-            
-            return jsonify({
-                "success": True,
-                "throttle_status": {
-                    "can_send_batch": remaining_wait_time == 0,
-                    "remaining_wait_time": round(remaining_wait_time, 1),
-                    "current_batch_prompts": CURRENT_BATCH_PROMPTS,
-                    "prompt_send_delay": BATCH_PROMPT_SEND_DELAY,
-                    "immediate_sending": True,
-                    "last_batch_submit_time": LAST_BATCH_SUBMIT_TIME,
-                    "time_since_last_batch": round(time_since_last_batch, 1),
-                    "estimated_completion_time": estimated_completion_time,
-                    "current_time": current_time
-                }
-            })
+            last_submit = LAST_BATCH_SUBMIT_TIME
+            batch_prompts = CURRENT_BATCH_PROMPTS
+        
+        # Pasar los instantes monotónicos a hora de reloj para el cliente
+        monotonic_offset = current_time - time.monotonic()
+        last_submit_time = last_submit + monotonic_offset if last_submit > 0 else 0
+        
+        # Información sobre el lote actual
+        time_since_last_batch = max(0, current_time - last_submit_time) if last_submit > 0 else 0
+        # Tiempo estimado de procesamiento mínimo (1s por prompt)
+        estimated_completion_time = last_submit_time + (batch_prompts * 1.0)
+        
+        return jsonify({
+            "success": True,
+            "throttle_status": {
+                "can_send_batch": remaining_wait_time == 0,
+                "remaining_wait_time": round(remaining_wait_time, 1),
+                "current_batch_prompts": batch_prompts,
+                "prompt_send_delay": BATCH_PROMPT_SEND_DELAY,
+                "immediate_sending": True,
+                "last_batch_submit_time": last_submit_time,
+                "time_since_last_batch": round(time_since_last_batch, 1),
+                "estimated_completion_time": estimated_completion_time,
+                "current_time": current_time
+            }
+        })
     except Exception as e:
         return jsonify({
             "success": False,
             "error": str(e)
         }), 500
 
+def criteria_set(values):
+    """
+    frozenset de un criterio del batch, o None si está vacío (sin filtro)
+    Un criterio enviado como texto ("bathroom") es un único valor, no un conjunto de caracteres
+    """
+    if not values:
+        return None
+    if isinstance(values, str):
+        values = [values]
+    return frozenset(values)
+
 def filter_workflows_for_batch(batch_config, available_workflows):
     """
     Filtra workflows según los criterios del batch
     """
     filtered = []
     
-    room_types = batch_config.get("room_types", [])
-    orientations = batch_config.get("orientations", [])
-    specific_workflows = batch_config.get("specific_workflows", [])
+    # Criterios como frozenset una sola vez (None = sin filtro): cada comprobación es un hash, no recorrer la lista
+    room_set = criteria_set(batch_config.get("room_types", []))
+    orient_set = criteria_set(batch_config.get("orientations", []))
+    specific_set = criteria_set(batch_config.get("specific_workflows", []))
     
     for workflow in available_workflows:
         # Si hay workflows específicos, usar solo esos
-        if specific_workflows and workflow["id"] not in specific_workflows:
+        if specific_set is not None and workflow["id"] not in specific_set:
             continue
             
         # Filtrar por tipo de habitación
-        if room_types and workflow["room_type"] not in room_types:
+        if room_set is not None and workflow["room_type"] not in room_set:
             continue
             
         # Filtrar por orientación  
-        if orientations and workflow["orientation"] not in orientations:
+        if orient_set is not None and workflow["orientation"] not in orient_set:
             continue
             
         filtered.append(workflow)
@@ -2314,14 +3259,16 @@ def process_single_workflow_for_batch(image_file, workflow_info, common_params):
         image_file.save(input_path)
         
         # Cargar y actualizar workflow
-        workflow = load_workflow(workflow_info["id"])
+        workflow, plan = load_workflow(workflow_info["id"], with_plan=True)
         workflow = update_workflow(
             workflow, 
             filename, 
             common_params["frame_color"], 
             common_params["style"], 
             common_params.get("style_node"),
-            workflow_info["id"]  # output_subfolder
+            workflow_info["id"],  # output_subfolder
+            plan,
+            common_params.get("include_upscale", True)
         )
         
         # Enviar a ComfyUI
@@ -2392,8 +3339,8 @@ def process_single_workflow_for_batch(image_file, workflow_info, common_params):
                     })
                     continue
                 
-                # Copiar archivo si no existe
-                shutil.copy2(source_path, dest_path)
+                # Copiar archivo si no existe (link/reflink/copia en kernel; sin copystat)
+                stage_output(source_path, dest_path)
                 saved_images.append({
                     'filename': new_filename,
                     'url': f"/get-image/{base_image_name}/{new_filename}",
@@ -2454,22 +3401,94 @@ def process_single_workflow_for_batch(image_file, workflow_info, common_params):
             "processing_time": 0
         }
 
+# Pool para el trabajo de imagen de los batches (Pillow suelta el GIL al decodificar, redimensionar y codificar):
+# la imagen maestra se procesa mientras el hilo del batch prepara y envía los workflows
+IMAGE_EXECUTOR = concurrent.futures.ThreadPoolExecutor(max_workers=os.cpu_count() or 2, thread_name_prefix='image')
+
+def prepare_batch_input(image_data, master_image, reuse_bytes, input_path, batch_id):
+    """
+    Normaliza la imagen maestra de un batch (RGB, UPLOAD_MAX_SIZE) y escribe el input de ComfyUI
+    reuse_bytes: la imagen ya sirve tal cual -> se escriben sus bytes originales sin recodificar
+    Retorna: Future (en IMAGE_EXECUTOR) de encode_batch_original con la imagen ya normalizada
+    """
+    max_size = UPLOAD_MAX_SIZE
+    if master_image.format == 'JPEG' and (master_image.width > max_size or master_image.height > max_size):
+        master_image.draft('RGB', (max_size, max_size))  # libjpeg reduce durante la decodificación
+    
+    # Convertir a RGB si es necesario
+    master_image = flatten_to_rgb(master_image)
+    
+    # Redimensionar si es muy grande
+    if master_image.width > max_size or master_image.height > max_size:
+        master_image.thumbnail((max_size, max_size), Image.Resampling.LANCZOS)
+        log_info("📏 Imagen redimensionada a: %sx%s", master_image.width, master_image.height)
+    
+    if reuse_bytes:
+        input_buffer = image_data
+        log_info("📷 Imagen RGB dentro de límites: se envía sin recodificar")
+    else:
+        input_buffer = BytesIO()
+        master_image.save(input_buffer, format='PNG', compress_level=INPUT_PNG_COMPRESS_LEVEL)
+    with input_buffer.getbuffer() as input_bytes:
+        write_file_bytes(input_path, input_bytes)
+    
+    log_success("✅ Imagen pre-cargada correctamente")
+    return IMAGE_EXECUTOR.submit(encode_batch_original, master_image, batch_id)
+
+def encode_batch_original(master_image, batch_id):
+    """
+    Codifica la imagen original UNA vez por batch en un archivo canónico temporal;
+    los hilos de espera solo la enlazan a su carpeta de salida (sin retener la imagen decodificada)
+    Retorna: (ruta canónica o None, nombre de destino, bytes del JPG para la sesión o None)
+    """
+    canonical_original_path = os.path.join(TEMP_UPLOADS_DIR, f"{batch_id}_original.jpg")
+    try:
+        # Optimizar imagen original a JPG con límite de 200KB (master_image ya está en RGB)
+        jpeg_data = save_jpeg_to_target(master_image, canonical_original_path, "Imagen original batch")
+        return canonical_original_path, 'original.jpg', jpeg_data
+    except Exception as e:
+        log_error("❌ Error convirtiendo imagen original batch a JPG: %s", str(e))
+    
+    # Fallback: guardar como PNG
+    canonical_original_path = os.path.join(TEMP_UPLOADS_DIR, f"{batch_id}_original.png")
+    try:
+        master_image.save(canonical_original_path, format='PNG')
+        log_info("💾 Imagen original batch preparada como PNG (fallback): %s", canonical_original_path)
+        return canonical_original_path, 'original.png', None
+    except Exception as e:
+        log_error("❌ Error guardando imagen original batch como PNG: %s", str(e))
+        return None, 'original.png', None
+
+def remove_batch_original(original_future):
+    """Espera a encode_batch_original (IMAGE_EXECUTOR) y borra el archivo canónico que haya escrito"""
+    canonical_original_path = original_future.result()[0]
+    if canonical_original_path:
+        remove_file_quietly(canonical_original_path)
+
+def fail_batch_preload(batch_id, session_job_id, error):
+    """Marca el batch (y su job de sesión) como fallido al no poder preparar la imagen de entrada"""
+    log_error("❌ Error pre-cargando imagen: %s", str(error))
+    set_batch_fields(batch_id, error=f"Error pre-cargando imagen: {str(error)}", status="error")
+    
+    # Actualizar también el job de sesión
+    if session_job_id:
+        session_manager.update_job(session_job_id, 
+            status='error',
+            error=f"Error pre-cargando imagen: {str(error)}"
+        )
+
 def process_all_workflows_simultáneamente_with_tracking(image_data, workflows, common_params, batch_id, session_job_id=None):
     """
     Procesa todos los workflows simultáneamente con tracking en tiempo real y persistencia
     image_data: BytesIO object con el contenido de la imagen
     session_job_id: ID del job de sesión para persistencia
     """
-    import concurrent.futures
-    
-    results = []
+    # Un hueco por workflow en el orden original: cada resultado se escribe en su índice (sin ordenar al final)
+    results = [None] * len(workflows)
     submitted_prompts = {}  # prompt_id -> workflow_info
     
     # Actualizar status: enviando workflows
-    with BATCH_LOCK:
-        if batch_id in ACTIVE_BATCHES:
-            ACTIVE_BATCHES[batch_id]["status"] = "submitting"
-            ACTIVE_BATCHES[batch_id]["current_operation"] = "Enviando workflows a ComfyUI..."
+    set_batch_fields(batch_id, current_operation="Enviando workflows a ComfyUI...", status="submitting")
     
     # Actualizar también el job de sesión
     if session_job_id:
@@ -2478,122 +3497,80 @@ def process_all_workflows_simultáneamente_with_tracking(image_data, workflows,
             current_operation="Enviando workflows a ComfyUI..."
         )
     
-    log_info(f"🚀 Enviando {len(workflows)} workflows simultáneamente a ComfyUI...")
-    log_info(f"⚡ Envío inmediato sin delay entre prompts")
+    log_info("🚀 Enviando %s workflows simultáneamente a ComfyUI...", len(workflows))
+    log_info("⚡ Envío inmediato sin delay entre prompts")
     
     # Pre-cargar la imagen una vez para todos los workflows
     log_info("📷 Pre-cargando imagen para todos los workflows...")
     try:
         image_data.seek(0)
-        master_image = Image.open(image_data)
+        master_image = Image.open(image_data)  # Solo la cabecera: decodificar es trabajo de IMAGE_EXECUTOR
         
-        # Convertir a RGB si es necesario
-        if master_image.mode in ('RGBA', 'LA', 'P'):
-            background = Image.new('RGB', master_image.size, (255, 255, 255))
-            if master_image.mode == 'P':
-                master_image = master_image.convert('RGBA')
-            background.paste(master_image, mask=master_image.split()[-1] if master_image.mode in ('RGBA', 'LA') else None)
-            master_image = background
-        elif master_image.mode != 'RGB':
-            master_image = master_image.convert('RGB')
-            
-        # Redimensionar si es muy grande
-        max_size = 2048
-        if master_image.width > max_size or master_image.height > max_size:
-            master_image.thumbnail((max_size, max_size), Image.Resampling.LANCZOS)
-            log_info(f"📏 Imagen redimensionada a: {master_image.width}x{master_image.height}")
-            
-        log_success("✅ Imagen pre-cargada correctamente")
+        # Si la imagen ya sirve tal cual (RGB, tamaño y formato aceptados) el input de ComfyUI
+        # son sus bytes originales; si no, se recodifica como PNG tras normalizarla
+        input_extension = passthrough_extension(master_image, UPLOAD_MAX_SIZE)
         
-    except Exception as e:
-        log_error(f"❌ Error pre-cargando imagen: {str(e)}")
-        with BATCH_LOCK:
-            if batch_id in ACTIVE_BATCHES:
-                ACTIVE_BATCHES[batch_id]["status"] = "error"
-                ACTIVE_BATCHES[batch_id]["error"] = f"Error pre-cargando imagen: {str(e)}"
+        # Un único archivo de entrada en ComfyUI para todo el batch: todos los workflows lo referencian
+        # (su nombre se conoce ya, así que los workflows se preparan mientras la imagen se procesa)
+        shared_input_filename = f"batch_{batch_id}_master{input_extension or '.png'}"
+        shared_input_path = os.path.join(COMFYUI_INPUT_DIR, shared_input_filename)
+        input_future = IMAGE_EXECUTOR.submit(prepare_batch_input, image_data, master_image,
+                                             input_extension is not None, shared_input_path, batch_id)
+        del master_image
         
-        # Actualizar también el job de sesión
-        if session_job_id:
-            session_manager.update_job(session_job_id, 
-                status='error',
-                error=f"Error pre-cargando imagen: {str(e)}"
-            )
+    except Exception as e:
+        fail_batch_preload(batch_id, session_job_id, e)
         return []
 
-    # Fase 1: Preparar y enviar todos los workflows a ComfyUI sin delay
+    # Fase 1: Preparar los workflows y encolar cada uno en cuanto está listo: el pool de envíos
+    # hace los POSTs en paralelo mientras se preparan los siguientes (preparación y red solapadas)
     start_sending_time = time.time()
+    batch_client_id = secrets.token_hex(16)  # ComfyUI envía los eventos del batch a este clientId (WebSocket)
+    prepared = []  # (índice, workflow_info, input_filename, Future del envío)
+    backlog = []  # (índice, workflow_info, workflow) preparados antes de que el input esté en disco
+    
+    def enqueue_backlog():
+        """Encola lo preparado (ComfyUI valida que el archivo de entrada exista al recibir el prompt)"""
+        for i, workflow_info, workflow in backlog:
+            prepared.append((i, workflow_info, shared_input_filename, enqueue_workflow_submission(workflow, batch_client_id)))
+        backlog.clear()
+    
+    # Usar el nombre base de la imagen original para mantener consistencia (igual para todos los workflows)
+    original_image_name = common_params.get('original_filename', 'batch_image')
+    base_image_name = secure_filename(original_image_name.rsplit('.', 1)[0] if '.' in original_image_name else 'image')
+    log_info("🔧 Imagen original del batch: '%s' -> base: '%s'", original_image_name, base_image_name)
     
     for i, workflow_info in enumerate(workflows):
         try:
-            # Actualizar progreso
-            with BATCH_LOCK:
-                if batch_id in ACTIVE_BATCHES:
-                    elapsed_sending = time.time() - start_sending_time
-                    ACTIVE_BATCHES[batch_id]["current_operation"] = f"Enviando {i+1}/{len(workflows)}: {workflow_info['id']} (⚡ {elapsed_sending:.1f}s)"
-            
-            log_info(f"📤 Preparando {i+1}/{len(workflows)}: {workflow_info['id']}")
-            
-            # Sin delay entre prompts - envío inmediato
-            
-            # Guardar imagen temporal única para cada workflow
-            timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-            unique_filename = f"batch_{batch_id}_{i:03d}_{workflow_info['id'].replace('/', '_')}.png"
-            
-            input_path = os.path.join(COMFYUI_INPUT_DIR, unique_filename)
+            # Actualizar progreso (una sola asignación: no necesita lock)
+            tracked_batch = get_active_batch(batch_id)
+            if tracked_batch is not None:
+                set_current_op(tracked_batch, {
+                    "state": "sending",
+                    "id": workflow_info['id'],
+                    "done": i + 1,
+                    "total": len(workflows),
+                    "elapsed": time.time() - start_sending_time
+                })
             
-            # Guardar copia de la imagen pre-cargada
-            master_image.save(input_path, format='PNG', optimize=False)
+            log_info("📤 Preparando %d/%d: %s", i + 1, len(workflows), workflow_info['id'])
             
             # Cargar y actualizar workflow
-            # Usar el nombre base de la imagen original para mantener consistencia
-            original_image_name = common_params.get('original_filename', 'batch_image')
-            base_image_name = secure_filename(original_image_name.rsplit('.', 1)[0] if '.' in original_image_name else 'image')
-            
-            log_info(f"🔧 Workflow {i+1}/{len(workflows)} - original: '{original_image_name}' -> base: '{base_image_name}'")
-            
-            workflow = load_workflow(workflow_info["id"])
+            workflow, plan = load_workflow(workflow_info["id"], with_plan=True)
             workflow = update_workflow(
                 workflow, 
-                unique_filename, 
+                shared_input_filename, 
                 common_params["frame_color"], 
                 common_params["style"], 
                 common_params.get("style_node"),
-                base_image_name  # output_subfolder basado en imagen original, no en workflow
+                base_image_name,  # output_subfolder basado en imagen original, no en workflow
+                plan,
+                common_params.get("include_upscale", True)
             )
-            
-            # Enviar a ComfyUI (sin esperar respuesta)
-            log_info(f"🚀 Enviando prompt {i+1}/{len(workflows)} a ComfyUI...")
-            prompt_id = submit_workflow_to_comfyui(workflow)
-            
-            if prompt_id:
-                submitted_prompts[prompt_id] = {
-                    "workflow_info": workflow_info,
-                    "unique_filename": unique_filename,
-                    "submit_time": time.time(),
-                    "index": i
-                }
-                log_success(f"✅ Enviado {i+1}/{len(workflows)}: {workflow_info['id']} (prompt_id: {prompt_id})")
-            else:
-                log_error(f"❌ Error enviando {i+1}/{len(workflows)}: {workflow_info['id']}")
-                result = {
-                    "workflow_id": workflow_info["id"],
-                    "workflow_info": workflow_info,
-                    "success": False,
-                    "error": "Error enviando workflow a ComfyUI",
-                    "processing_time": 0
-                }
-                results.append(result)
-                
-                # Actualizar tracking inmediatamente
-                with BATCH_LOCK:
-                    if batch_id in ACTIVE_BATCHES:
-                        batch_info = ACTIVE_BATCHES[batch_id]
-                        batch_info["completed_workflows"] += 1
-                        batch_info["failed"] += 1
-                        batch_info["results"].append(result)
+            backlog.append((i, workflow_info, workflow))
                 
         except Exception as e:
-            log_error(f"❌ Error preparando workflow {workflow_info['id']}: {str(e)}")
+            log_error("❌ Error preparando workflow %s: %s", workflow_info['id'], str(e))
             result = {
                 "workflow_id": workflow_info["id"],
                 "workflow_info": workflow_info,
@@ -2601,25 +3578,58 @@ def process_all_workflows_simultáneamente_with_tracking(image_data, workflows,
                 "error": f"Error preparando workflow: {str(e)}",
                 "processing_time": 0
             }
-            results.append(result)
+            results[i] = result
+            
+            # Actualizar tracking inmediatamente (lo integra el drainer)
+            record_batch_result(batch_id, False, result)
+        
+        if input_future.done() and input_future.exception() is None:
+            enqueue_backlog()
+    
+    # El input tiene que estar en disco antes de encolar lo que quede preparado
+    try:
+        original_future = input_future.result()
+    except Exception as e:
+        fail_batch_preload(batch_id, session_job_id, e)
+        return []
+    enqueue_backlog()
+    
+    # Esperar los envíos ya encolados (sin esperar su ejecución)
+    log_info("🚀 Esperando confirmación de %d prompts enviados a ComfyUI...", len(prepared))
+    submissions = submission_results([item[3] for item in prepared])
+    submit_time = time.time()
+    
+    for (i, workflow_info, input_filename, _), (prompt_id, error) in zip(prepared, submissions):
+        if prompt_id:
+            submitted_prompts[prompt_id] = {
+                "workflow_info": workflow_info,
+                "input_filename": input_filename,
+                "submit_time": submit_time,
+                "index": i
+            }
+            log_success("✅ Enviado %s/%s: %s (prompt_id: %s)", i + 1, len(workflows), workflow_info['id'], prompt_id)
+        else:
+            log_error("❌ Error enviando %s/%s: %s", i + 1, len(workflows), workflow_info['id'])
+            result = {
+                "workflow_id": workflow_info["id"],
+                "workflow_info": workflow_info,
+                "success": False,
+                "error": f"Error enviando workflow a ComfyUI: {error}",
+                "processing_time": 0
+            }
+            results[i] = result
             
-            # Actualizar tracking inmediatamente
-            with BATCH_LOCK:
-                if batch_id in ACTIVE_BATCHES:
-                    batch_info = ACTIVE_BATCHES[batch_id]
-                    batch_info["completed_workflows"] += 1
-                    batch_info["failed"] += 1
-                    batch_info["results"].append(result)
+            # Actualizar tracking inmediatamente (lo integra el drainer)
+            record_batch_result(batch_id, False, result)
     
     total_sending_time = time.time() - start_sending_time
-    log_success(f"📤 Todos los prompts enviados en {total_sending_time:.1f}s (promedio: {total_sending_time/len(workflows):.2f}s por prompt)")
+    log_success("📤 Todos los prompts enviados en %.1fs (promedio: %.2fs por prompt)", total_sending_time, total_sending_time / len(workflows))
     
     if not submitted_prompts:
         log_error("❌ No se pudo enviar ningún workflow a ComfyUI")
-        with BATCH_LOCK:
-            if batch_id in ACTIVE_BATCHES:
-                ACTIVE_BATCHES[batch_id]["status"] = "error"
-                ACTIVE_BATCHES[batch_id]["error"] = "No se pudo enviar ningún workflow"
+        set_batch_fields(batch_id, error="No se pudo enviar ningún workflow", status="error")
+        remove_file_quietly(shared_input_path)  # Ningún prompt la va a leer
+        remove_batch_original(original_future)  # Ni se va a enlazar la original en ninguna carpeta
         
         # Actualizar también el job de sesión
         if session_job_id:
@@ -2630,10 +3640,11 @@ def process_all_workflows_simultáneamente_with_tracking(image_data, workflows,
         return results
     
     # Actualizar status: procesando
-    with BATCH_LOCK:
-        if batch_id in ACTIVE_BATCHES:
-            ACTIVE_BATCHES[batch_id]["status"] = "processing"
-            ACTIVE_BATCHES[batch_id]["current_operation"] = f"Procesando {len(submitted_prompts)} workflows..."
+    set_batch_fields(batch_id,
+        current_operation=f"Procesando {len(submitted_prompts)} workflows...",
+        current_op=None,  # El texto fijo manda hasta el siguiente estado estructurado
+        status="processing"
+    )
     
     # Actualizar también el job de sesión
     if session_job_id:
@@ -2641,503 +3652,361 @@ def process_all_workflows_simultáneamente_with_tracking(image_data, workflows,
             current_operation=f"Procesando {len(submitted_prompts)} workflows..."
         )
     
-    log_info(f"🏁 {len(submitted_prompts)} workflows enviados a ComfyUI. Esperando resultados...")
+    log_info("🏁 %s workflows enviados a ComfyUI. Esperando resultados...", len(submitted_prompts))
     
-    # Fase 2: Esperar y recoger resultados simultáneamente CON TRACKING
-    def wait_for_single_workflow_with_tracking(prompt_id, workflow_data, master_image):
-        """Espera el resultado de un workflow específico CON TRACKING"""
-        try:
-            start_time = workflow_data["submit_time"]
-            workflow_info = workflow_data["workflow_info"]
-            index = workflow_data["index"]
-            
-            log_info(f"⏳ Esperando resultado {index+1}: {workflow_info['id']} (prompt_id: {prompt_id})")
-            
-            # Actualizar status individual
-            with BATCH_LOCK:
-                if batch_id in ACTIVE_BATCHES:
-                    ACTIVE_BATCHES[batch_id]["current_operation"] = f"Procesando: {workflow_info['id']}"
-            
-            # Esperar completion de este workflow específico
-            outputs = wait_for_completion(prompt_id, timeout=60000) # 10 minutos timeout
-            
-            # Extraer imágenes generadas
-            original_image_name = common_params.get('original_filename', 'batch_image')
-            include_upscale = common_params.get('include_upscale', True)
-            generated_images = extract_generated_images(outputs, original_image_name, include_upscale)
-            
-            # Obtener nombre base de la imagen original usando la misma lógica que process_image individual
-            original_image_name = common_params.get('original_filename', 'batch_image')
-            base_image_name = secure_filename(original_image_name.rsplit('.', 1)[0] if '.' in original_image_name else 'image')
-            
-            log_info(f"📁 Procesando batch - original: '{original_image_name}' -> base: '{base_image_name}'")
-            
-            # Crear directorio de salida basado en nombre de imagen original (shared)
-            batch_output_dir = create_output_directory(base_image_name)
-            
-            # 🔍 VERIFICAR ARCHIVOS EXISTENTES EN EL DIRECTORIO PARA EVITAR DUPLICADOS DE UPSCALE
-            existing_files = []
-            if os.path.exists(batch_output_dir):
-                existing_files = [f.lower() for f in os.listdir(batch_output_dir)]
-            
-            # Verificar si ya existe una imagen upscale
-            existing_upscale = any('upscale_' in f for f in existing_files)
-            if existing_upscale:
-                log_info(f"📈 Ya existe una imagen upscale en {batch_output_dir}, se omitirán nuevas imágenes upscale")
-            
-            # Copiar imágenes generadas con nombre de workflow y estilo (evitando duplicados)
-            # Las imágenes en generated_images ya están filtradas según include_upscale
-            saved_images = []
-            session_images = []  # Para URLs de sesión
-            include_upscale = common_params.get('include_upscale', True)
-            log_info(f"📊 Tracking Batch - Resumen de imágenes extraídas: {len(generated_images)} imágenes (include_upscale={include_upscale})")
-            for i, img in enumerate(generated_images):
-                log_info(f"   {i+1}. Tipo: {img.get('image_type', 'unknown')}, Archivo: {img['filename']}, Nodo: {img.get('node_id', 'N/A')}")
-            
-            for img_info in generated_images:
+    try:
+        # Archivo canónico de la imagen original (codificado en IMAGE_EXECUTOR en paralelo a la fase 1)
+        canonical_original_path, original_dest_name, canonical_original_data = original_future.result()
+    
+        # Fase 2: Esperar (un solo bucle de polling) y procesar resultados CON TRACKING
+        def process_completed_workflow_with_tracking(prompt_id, workflow_data, outputs, error):
+            """Procesa el resultado de un workflow ya terminado en ComfyUI CON TRACKING"""
+            try:
+                start_time = workflow_data["submit_time"]
+                workflow_info = workflow_data["workflow_info"]
+                index = workflow_data["index"]
+            
+                log_info("📥 Procesando resultado %d: %s (prompt_id: %s)", index + 1, workflow_info['id'], prompt_id)
+            
+                # Actualizar status individual (una sola asignación: no necesita lock)
+                tracked_batch = get_active_batch(batch_id)
+                if tracked_batch is not None:
+                    set_current_op(tracked_batch, {"state": "processing", "id": workflow_info['id']})
+            
+                if error:
+                    raise Exception(error)
+            
+                # Extraer imágenes generadas
+                original_image_name = common_params.get('original_filename', 'batch_image')
+                include_upscale = common_params.get('include_upscale', True)
+                generated_images = extract_generated_images(outputs, original_image_name, include_upscale)
+            
+                # Obtener nombre base de la imagen original usando la misma lógica que process_image individual
+                original_image_name = common_params.get('original_filename', 'batch_image')
+                base_image_name = secure_filename(original_image_name.rsplit('.', 1)[0] if '.' in original_image_name else 'image')
+            
+                log_info("📁 Procesando batch - original: '%s' -> base: '%s'", original_image_name, base_image_name)
+            
+                # Crear directorio de salida basado en nombre de imagen original (shared)
+                batch_output_dir = create_output_directory(base_image_name)
+            
+                # 🔍 VERIFICAR ARCHIVOS EXISTENTES EN EL DIRECTORIO PARA EVITAR DUPLICADOS DE UPSCALE
+                existing_files = os.listdir(batch_output_dir) if os.path.exists(batch_output_dir) else []
+            
+                # Verificar si ya existe una imagen upscale (se guarda el nombre para referenciarla sin volver a listar)
+                existing_upscale_file = next((f for f in existing_files if 'upscale_' in f.lower()), None)
+                existing_upscale = existing_upscale_file is not None
+                if existing_upscale:
+                    log_info("📈 Ya existe una imagen upscale en %s, se omitirán nuevas imágenes upscale", batch_output_dir)
+            
+                # Copiar imágenes generadas con nombre de workflow y estilo (evitando duplicados)
+                # Las imágenes en generated_images ya están filtradas según include_upscale
+                saved_images = []
+                session_images = []  # Para URLs de sesión
+                session_writes = []  # Escrituras de sesión en curso: se esperan antes de publicar el resultado
+                include_upscale = common_params.get('include_upscale', True)
+                log_info("📊 Tracking Batch - Resumen de imágenes extraídas: %s imágenes (include_upscale=%s)", len(generated_images), include_upscale)
+                for i, img in enumerate(generated_images):
+                    log_debug("   %s. Tipo: %s, Archivo: %s, Nodo: %s", i + 1, img.get('image_type', 'unknown'), img['filename'], img.get('node_id', 'N/A'))
+            
+                # Marca de tiempo de los nombres de archivo: una vez por resultado, no por imagen
+                timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+            
+                for img_info in generated_images:
                 
-                source_path = find_image_file(img_info['filename'], img_info['subfolder'])
-                if source_path:
-                    # Obtener extensión original
-                    if '.' in img_info['filename']:
-                        original_ext = img_info['filename'].rsplit('.', 1)[1]
-                    else:
-                        original_ext = 'png'
+                    source_path = find_image_file(img_info['filename'], img_info['subfolder'])
+                    if source_path:
+                        # Obtener extensión original
+                        if '.' in img_info['filename']:
+                            original_ext = img_info['filename'].rsplit('.', 1)[1]
+                        else:
+                            original_ext = 'png'
                     
-                    # Diferentes estrategias de naming según el tipo de imagen
-                    image_type = img_info.get('image_type', 'unknown')
+                        # Diferentes estrategias de naming según el tipo de imagen
+                        image_type = img_info.get('image_type', 'unknown')
                     
-                    # 🔍 LOG DETALLADO PARA DEBUGGING EN BATCH TRACKING
-                    log_info(f"🔍 BATCH TRACKING - Procesando imagen: {img_info['filename']}")
-                    log_info(f"   📋 Tipo detectado: {image_type}")
-                    log_info(f"   📋 Nodo origen: {img_info.get('node_id', 'N/A')}")
-                    log_info(f"   📋 Workflow: {workflow_info['id']}")
-                    log_info(f"   📋 Archivo original de ComfyUI: {img_info['filename']}")
-                    log_info(f"   📋 Subfolder: {img_info.get('subfolder', 'N/A')}")
+                        # 🔍 LOG DETALLADO PARA DEBUGGING EN BATCH TRACKING
+                        log_debug("🔍 BATCH TRACKING - Procesando imagen: %s", img_info['filename'])
+                        log_debug("   📋 Tipo detectado: %s", image_type)
+                        log_debug("   📋 Nodo origen: %s", img_info.get('node_id', 'N/A'))
+                        log_debug("   📋 Workflow: %s", workflow_info['id'])
+                        log_debug("   📋 Archivo original de ComfyUI: %s", img_info['filename'])
+                        log_debug("   📋 Subfolder: %s", img_info.get('subfolder', 'N/A'))
                     
-                    if image_type == 'upscale':
-                        # 🔍 VERIFICAR SI YA EXISTE UPSCALE ANTES DE PROCESAR
-                        if existing_upscale:
-                            log_warning(f"⚠️ Ya existe imagen upscale, saltando: {img_info['filename']}")
-                            # Buscar el archivo upscale existente para referenciarlo
-                            existing_upscale_file = next((f for f in os.listdir(batch_output_dir) if 'upscale_' in f.lower()), None)
-                            if existing_upscale_file:
-                                # Agregar referencia al archivo existente
-                                saved_images.append({
-                                    'filename': existing_upscale_file,
-                                    'url': f"/get-image/{base_image_name}/{existing_upscale_file}",
-                                    'original_filename': img_info['filename'],
-                                    'workflow': workflow_info['id'],
-                                    'image_type': image_type,
-                                    'status': 'existing_previous'  # Marcar como existente de workflow anterior
-                                })
-                                log_info(f"📈 Referenciando upscale existente: {existing_upscale_file}")
-                            continue
+                        if image_type == 'upscale':
+                            # 🔍 VERIFICAR SI YA EXISTE UPSCALE ANTES DE PROCESAR
+                            if existing_upscale:
+                                log_warning("⚠️ Ya existe imagen upscale, saltando: %s", img_info['filename'])
+                                # Referenciar el archivo upscale existente
+                                if existing_upscale_file:
+                                    # Agregar referencia al archivo existente
+                                    saved_images.append({
+                                        'filename': existing_upscale_file,
+                                        'url': f"/get-image/{base_image_name}/{existing_upscale_file}",
+                                        'original_filename': img_info['filename'],
+                                        'workflow': workflow_info['id'],
+                                        'image_type': image_type,
+                                        'status': 'existing_previous'  # Marcar como existente de workflow anterior
+                                    })
+                                    log_info("📈 Referenciando upscale existente: %s", existing_upscale_file)
+                                continue
                         
-                        # ✅ UPSCALE: Nombre consistente basado en imagen original (no en workflow)
-                        # Formato: upscale_nombreoriginal_timestamp.ext
-                        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-                        new_filename = f"upscale_{base_image_name}_{timestamp}.{original_ext}"
+                            # ✅ UPSCALE: Nombre consistente basado en imagen original (no en workflow)
+                            # Formato: upscale_nombreoriginal_timestamp.ext
+                            new_filename = f"upscale_{base_image_name}_{timestamp}.{original_ext}"
                         
-                        log_info(f"📈 BATCH TRACKING UPSCALE - Nombre generado: {new_filename}")
-                        log_info(f"   📈 Razón: image_type='{image_type}' -> usando formato upscale_[base]_[timestamp]")
-                    else:
-                        # ✅ COMPOSICIÓN: Nombre único con workflow para distinguir diferentes composiciones
-                        # Formato: workflow_estilo_timestamp_numero.ext
-                        style_name = common_params.get('style', 'default')
-                        workflow_clean = workflow_info['id'].replace('/', '_').replace('-', '_')
-                        img_number = len(saved_images) + 1
-                        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-                        new_filename = f"{workflow_clean}_{style_name}_{timestamp}_{img_number:03d}.{original_ext}"
+                            log_debug("📈 BATCH TRACKING UPSCALE - Nombre generado: %s", new_filename)
+                            log_debug("   📈 Razón: image_type='%s' -> usando formato upscale_[base]_[timestamp]", image_type)
+                        else:
+                            # ✅ COMPOSICIÓN: Nombre único con workflow para distinguir diferentes composiciones
+                            # Formato: workflow_estilo_timestamp_numero.ext
+                            style_name = common_params.get('style', 'default')
+                            workflow_clean = workflow_info['id'].replace('/', '_').replace('-', '_')
+                            img_number = len(saved_images) + 1
+                            new_filename = f"{workflow_clean}_{style_name}_{timestamp}_{img_number:03d}.{original_ext}"
                         
-                        log_info(f"🎯 BATCH TRACKING COMPOSICIÓN - Nombre generado: {new_filename}")
-                        log_info(f"   🎯 Razón: image_type='{image_type}' -> usando formato [workflow]_[style]_[timestamp]_[num]")
-                        log_info(f"   🎯 Componentes: workflow='{workflow_clean}', style='{style_name}', num={img_number:03d}")
+                            log_debug("🎯 BATCH TRACKING COMPOSICIÓN - Nombre generado: %s", new_filename)
+                            log_debug("   🎯 Razón: image_type='%s' -> usando formato [workflow]_[style]_[timestamp]_[num]", image_type)
+                            log_debug("   🎯 Componentes: workflow='%s', style='%s', num=%03d", workflow_clean, style_name, img_number)
                     
-                    dest_path = os.path.join(batch_output_dir, new_filename)
+                        dest_path = os.path.join(batch_output_dir, new_filename)
                     
-                    # ✅ VERIFICAR SI YA EXISTE PARA EVITAR DUPLICADOS
-                    if os.path.exists(dest_path):
-                        log_warning(f"⚠️ Archivo de tracking ya existe, saltando: {new_filename}")
-                        # Intentar guardarlo en sesión si no está ya guardado
-                        session_url = None
-                        if session_job_id:
-                            try:
-                                with open(dest_path, 'rb') as img_file:
-                                    session_url = session_manager.save_job_image(session_job_id, img_file.read(), new_filename)
-                            except Exception as e:
-                                log_warning(f"⚠️ No se pudo guardar archivo existente en sesión: {str(e)}")
+                        # ✅ VERIFICAR SI YA EXISTE PARA EVITAR DUPLICADOS
+                        if os.path.exists(dest_path):
+                            log_warning("⚠️ Archivo de tracking ya existe, saltando: %s", new_filename)
+                            # Intentar guardarlo en sesión si no está ya guardado
+                            session_url = None
+                            if session_job_id:
+                                try:
+                                    session_url = stage_job_image(session_job_id, dest_path, new_filename)
+                                except Exception as e:
+                                    log_warning("⚠️ No se pudo guardar archivo existente en sesión: %s", str(e))
                         
-                        saved_images.append({
-                            'filename': new_filename,
-                            'url': f"/get-image/{base_image_name}/{new_filename}",
-                            'session_url': session_url,
-                            'original_filename': img_info['filename'],
-                            'workflow': workflow_info['id'],
-                            'image_type': image_type,  # Agregar tipo de imagen
-                            'status': 'existing'  # Marcar como existente
-                        })
+                            saved_images.append({
+                                'filename': new_filename,
+                                'url': f"/get-image/{base_image_name}/{new_filename}",
+                                'session_url': session_url,
+                                'original_filename': img_info['filename'],
+                                'workflow': workflow_info['id'],
+                                'image_type': image_type,  # Agregar tipo de imagen
+                                'status': 'existing'  # Marcar como existente
+                            })
                         
-                        if session_url:
-                            session_images.append(session_url)
-                        continue
+                            if session_url:
+                                session_images.append(session_url)
+                            continue
                     
-                    # Convertir PNG a JPG con límite de 200KB (igual que en save_images_to_our_output)
-                    if original_ext.lower() == 'png':
-                        # Cambiar extensión a JPG
-                        new_filename = new_filename.replace('.png', '.jpg')
-                        dest_path = os.path.join(batch_output_dir, new_filename)
+                        # Convertir PNG a JPG con límite de 200KB (igual que en save_images_to_our_output)
+                        if original_ext.lower() == 'png':
+                            # Cambiar extensión a JPG
+                            new_filename = new_filename.rsplit('.', 1)[0] + '.jpg'  # También con extensión .PNG
+                            dest_path = os.path.join(batch_output_dir, new_filename)
                         
-                        # Convertir PNG a JPG con optimización inteligente de tamaño
-                        try:
-                            from PIL import Image
-                            import io
-                            
-                            # Abrir imagen PNG original
-                            img = Image.open(source_path)
-                            original_size_kb = os.path.getsize(source_path) / 1024
-                            
-                            # Convertir a RGB si es necesario (PNG puede tener transparencia)
-                            if img.mode in ('RGBA', 'LA', 'P'):
-                                # Crear fondo blanco para imágenes con transparencia
-                                background = Image.new('RGB', img.size, (255, 255, 255))
-                                if img.mode == 'P':
-                                    img = img.convert('RGBA')
-                                background.paste(img, mask=img.split()[-1] if img.mode == 'RGBA' else None)
-                                img = background
-                            elif img.mode != 'RGB':
-                                img = img.convert('RGB')
-                            
-                            # Estrategia de optimización: Comenzar con calidad 100% y reducir gradualmente
-                            target_size_kb = 200
+                            # Convertir PNG a JPG con optimización inteligente de tamaño
+                            image_data = None
+                            try:
+                                # Abrir imagen PNG original
+                                img = Image.open(source_path)
+                                original_size_kb = os.path.getsize(source_path) / 1024
                             
-                            # Probar calidad 100% primero
-                            buffer = io.BytesIO()
-                            img.save(buffer, format='JPEG', quality=100, optimize=True)
-                            size_kb = buffer.tell() / 1024
+                                # Convertir a RGB si es necesario (PNG puede tener transparencia)
+                                img = flatten_to_rgb(img)
                             
-                            if size_kb <= target_size_kb:
-                                # ¡Perfecto! Calidad 100% y dentro del límite
-                                with open(dest_path, 'wb') as f:
-                                    f.write(buffer.getvalue())
-                                log_success(f"🎯 Imagen batch convertida a JPG con calidad 100%: {new_filename} ({size_kb:.1f}KB)")
-                                log_info(f"   📊 Reducción de tamaño: {original_size_kb:.1f}KB PNG → {size_kb:.1f}KB JPG ({((original_size_kb - size_kb) / original_size_kb * 100):.1f}% reducción)")
-                            else:
-                                # Necesitamos reducir el tamaño, pero manteniendo la mejor calidad posible
-                                log_info(f"📏 Imagen batch muy grande con calidad 100% ({size_kb:.1f}KB), optimizando para 200KB...")
-                                
-                                best_quality = 100
-                                best_buffer = None
-                                
-                                # Algoritmo de optimización más inteligente: reducir en pasos más pequeños
-                                for quality in range(95, 60, -2):  # Reducir de 2 en 2 desde 95% hasta 60%
-                                    buffer = io.BytesIO()
-                                    img.save(buffer, format='JPEG', quality=quality, optimize=True)
-                                    size_kb = buffer.tell() / 1024
-                                    
-                                    if size_kb <= target_size_kb:
-                                        best_quality = quality
-                                        best_buffer = buffer.getvalue()
-                                        break
-                                
-                                # Si aún no encontramos una buena calidad, probar con pasos más grandes
-                                if best_buffer is None:
-                                    log_warning(f"⚠️ Imagen batch muy grande, probando calidades más bajas...")
-                                    for quality in range(60, 30, -5):  # Reducir de 5 en 5 desde 60% hasta 30%
-                                        buffer = io.BytesIO()
-                                        img.save(buffer, format='JPEG', quality=quality, optimize=True)
-                                        size_kb = buffer.tell() / 1024
-                                        
-                                        if size_kb <= target_size_kb:
-                                            best_quality = quality
-                                            best_buffer = buffer.getvalue()
-                                            break
-                                
-                                # Guardar la mejor versión encontrada
-                                if best_buffer:
-                                    with open(dest_path, 'wb') as f:
-                                        f.write(best_buffer)
-                                    final_size = len(best_buffer) / 1024
-                                    log_info(f"🎯 Imagen batch convertida a JPG: {new_filename} ({final_size:.1f}KB, calidad {best_quality}%)")
-                                    log_info(f"   📊 Reducción de tamaño: {original_size_kb:.1f}KB PNG → {final_size:.1f}KB JPG ({((original_size_kb - final_size) / original_size_kb * 100):.1f}% reducción)")
-                                else:
-                                    # Como último recurso, guardar con calidad 30%
-                                    img.save(dest_path, format='JPEG', quality=30, optimize=True)
-                                    final_size = os.path.getsize(dest_path) / 1024
-                                    log_warning(f"⚠️ Imagen batch muy grande, guardada con calidad 30%: {new_filename} ({final_size:.1f}KB)")
-                                    log_info(f"   📊 Reducción de tamaño: {original_size_kb:.1f}KB PNG → {final_size:.1f}KB JPG ({((original_size_kb - final_size) / original_size_kb * 100):.1f}% reducción)")
+                                # Mejor calidad que quepa en 200KB (búsqueda binaria)
+                                image_data = save_jpeg_to_target(img, dest_path, "Imagen batch", original_size_kb)
                             
-                        except Exception as e:
-                            log_error(f"❌ Error convirtiendo PNG a JPG en batch: {str(e)}")
-                            # Fallback: copiar archivo original
-                            shutil.copy2(source_path, dest_path)
-                    else:
-                        # Copiar archivo no-PNG normalmente
-                        shutil.copy2(source_path, dest_path)
-                    
-                    # Guardar también en sesión
-                    with open(dest_path, 'rb') as img_file:
-                        session_url = session_manager.save_job_image(session_job_id, img_file.read(), new_filename)
-                    
-                    # Agregar a lista de guardadas
-                    saved_images.append({
-                        'filename': new_filename,
-                        'url': f"/get-image/{base_image_name}/{new_filename}",
-                        'session_url': session_url,  # URL de sesión persistente
-                        'original_filename': img_info['filename'],
-                        'workflow': workflow_info['id'],
-                        'image_type': image_type,  # Agregar tipo de imagen
-                        'status': 'new'  # Marcar como nuevo
-                    })
-                    
-                    # Log específico para upscales y composiciones en batch tracking
-                    if image_type == 'upscale':
-                        log_info(f"📈 BATCH TRACKING UPSCALE guardado con nombre consistente: {new_filename}")
-                        # Marcar que ya existe upscale para evitar duplicados en siguientes workflows del batch
-                        existing_upscale = True
-                    else:
-                        log_info(f"🎯 BATCH TRACKING COMPOSICIÓN guardada con nombre único: {new_filename}")
-                    
-                    if session_url:
-                        session_images.append(session_url)
-            
-            # Guardar imagen original solo una vez (check si ya existe) - convertir a JPG
-            original_dest = os.path.join(batch_output_dir, 'original.jpg')  # Cambiar a JPG
-            if not os.path.exists(original_dest):  # Solo si no existe ya
-                try:
-                    # Convertir imagen original a JPG con optimización
-                    original_rgb = master_image.convert('RGB') if master_image.mode != 'RGB' else master_image
+                            except Exception as e:
+                                log_error("❌ Error convirtiendo PNG a JPG en batch: %s", str(e))
+                                # Fallback: copiar archivo original
+                                stage_output(source_path, dest_path)
+                        else:
+                            # Copiar archivo no-PNG normalmente (link/reflink/copia en kernel)
+                            image_data = None
+                            stage_output(source_path, dest_path)
                     
-                    # Optimizar imagen original a JPG con límite de 200KB
-                    target_size_kb = 200
+                        # Guardar también en sesión: el JPG ya está en memoria; lo copiado se enlaza desde dest_path
+                        if image_data is not None:
+                            session_url = save_job_image_async(session_job_id, image_data, new_filename, session_writes)
+                        else:
+                            session_url = stage_job_image(session_job_id, dest_path, new_filename)
                     
-                    # Intentar calidad 100% primero
-                    buffer = io.BytesIO()
-                    original_rgb.save(buffer, format='JPEG', quality=100, optimize=True)
-                    size_kb = buffer.tell() / 1024
+                        # Agregar a lista de guardadas
+                        saved_images.append({
+                            'filename': new_filename,
+                            'url': f"/get-image/{base_image_name}/{new_filename}",
+                            'session_url': session_url,  # URL de sesión persistente
+                            'original_filename': img_info['filename'],
+                            'workflow': workflow_info['id'],
+                            'image_type': image_type,  # Agregar tipo de imagen
+                            'status': 'new'  # Marcar como nuevo
+                        })
                     
-                    if size_kb <= target_size_kb:
-                        # Perfecto con calidad 100%
-                        with open(original_dest, 'wb') as f:
-                            f.write(buffer.getvalue())
-                        log_success(f"✅ Imagen original batch convertida a JPG con calidad 100%: original.jpg ({size_kb:.1f}KB)")
-                    else:
-                        # Optimizar gradualmente para mantener la mejor calidad posible
-                        log_info(f"📏 Imagen original batch muy grande con calidad 100% ({size_kb:.1f}KB), optimizando para 200KB...")
-                        
-                        best_quality = 100
-                        best_buffer = None
-                        
-                        # Optimización gradual más inteligente
-                        for quality in range(95, 60, -2):  # Reducir de 2 en 2 desde 95% hasta 60%
-                            buffer = io.BytesIO()
-                            original_rgb.save(buffer, format='JPEG', quality=quality, optimize=True)
-                            size_kb = buffer.tell() / 1024
-                            
-                            if size_kb <= target_size_kb:
-                                best_quality = quality
-                                best_buffer = buffer.getvalue()
-                                break
-                        
-                        # Si aún no encontramos una buena calidad, probar con pasos más grandes
-                        if best_buffer is None:
-                            for quality in range(60, 30, -5):  # Reducir de 5 en 5 desde 60% hasta 30%
-                                buffer = io.BytesIO()
-                                original_rgb.save(buffer, format='JPEG', quality=quality, optimize=True)
-                                size_kb = buffer.tell() / 1024
-                                
-                                if size_kb <= target_size_kb:
-                                    best_quality = quality
-                                    best_buffer = buffer.getvalue()
-                                    break
-                        
-                        # Guardar la mejor versión encontrada
-                        if best_buffer:
-                            with open(original_dest, 'wb') as f:
-                                f.write(best_buffer)
-                            final_size = len(best_buffer) / 1024
-                            log_info(f"✅ Imagen original batch convertida a JPG: original.jpg ({final_size:.1f}KB, calidad {best_quality}%)")
+                        # Log específico para upscales y composiciones en batch tracking
+                        if image_type == 'upscale':
+                            log_info("📈 BATCH TRACKING UPSCALE guardado con nombre consistente: %s", new_filename)
+                            # Marcar que ya existe upscale para evitar duplicados en siguientes workflows del batch
+                            existing_upscale = True
+                            existing_upscale_file = new_filename
                         else:
-                            # Como último recurso, guardar con calidad 30%
-                            original_rgb.save(original_dest, format='JPEG', quality=30, optimize=True)
-                            final_size = os.path.getsize(original_dest) / 1024
-                            log_warning(f"⚠️ Imagen original batch muy grande, guardada con calidad 30%: original.jpg ({final_size:.1f}KB)")
-                    
-                    log_info(f"💾 Imagen original batch guardada como JPG: {original_dest}")
+                            log_info("🎯 BATCH TRACKING COMPOSICIÓN guardada con nombre único: %s", new_filename)
                     
-                except Exception as e:
-                    log_error(f"❌ Error convirtiendo imagen original batch a JPG: {str(e)}")
-                    # Fallback: guardar como PNG
-                    original_dest = os.path.join(batch_output_dir, 'original.png')
-                    master_image.save(original_dest, format='PNG')
-                    log_info(f"💾 Imagen original batch guardada como PNG (fallback): {original_dest}")
-            
-            # Guardar también imagen original en la sesión (solo una vez por batch)
-            original_session_url = None
-            if session_job_id:
-                try:
-                    # Verificar si ya se guardó la original en sesión
-                    existing_images = session_manager.get_job_images(session_job_id)
-                    original_already_saved = any('original.' in img for img in existing_images)  # Buscar tanto PNG como JPG
+                        if session_url:
+                            session_images.append(session_url)
+            
+                # Enlazar la imagen original (codificada una sola vez por batch) si no existe ya
+                original_dest = os.path.join(batch_output_dir, original_dest_name)
+                if canonical_original_path and not os.path.exists(original_dest):
+                    try:
+                        stage_output(canonical_original_path, original_dest)
+                        log_info("💾 Imagen original batch guardada: %s", original_dest)
+                    except OSError as e:
+                        log_error("❌ Error guardando imagen original batch: %s", str(e))
+            
+                # Guardar también imagen original en la sesión (solo una vez por batch)
+                original_session_url = None
+                if session_job_id:
+                    try:
+                        # Verificar si ya se guardó la original en sesión
+                        existing_images = session_manager.get_job_images(session_job_id)
+                        original_already_saved = any('original.' in img for img in existing_images)  # Buscar tanto PNG como JPG
                     
-                    if not original_already_saved:
-                        with open(original_dest, 'rb') as img_file:
+                        if not original_already_saved:
                             original_filename = os.path.basename(original_dest)  # original.jpg o original.png
-                            original_session_url = session_manager.save_job_image(session_job_id, img_file.read(), original_filename)
-                except Exception as e:
-                    log_warning(f"⚠️ No se pudo guardar imagen original en sesión: {str(e)}")
+                            if canonical_original_data is not None:
+                                original_session_url = save_job_image_async(session_job_id, canonical_original_data, original_filename, session_writes)
+                            else:
+                                original_session_url = stage_job_image(session_job_id, original_dest, original_filename)
+                    except Exception as e:
+                        log_warning("⚠️ No se pudo guardar imagen original en sesión: %s", str(e))
             
-            processing_time = time.time() - start_time
+                processing_time = time.time() - start_time
             
-            # 🎯 FILTRAR IMÁGENES PARA EL FRONTEND EN BATCH TRACKING - SOLO COMPOSICIÓN FINAL
-            log_info(f"🎯 Filtrando imágenes para frontend en batch tracking - solo composición final...")
-            frontend_images = []
+                # 🎯 FILTRAR IMÁGENES PARA EL FRONTEND EN BATCH TRACKING - SOLO COMPOSICIÓN FINAL
+                log_info("🎯 Filtrando imágenes para frontend en batch tracking - solo composición final...")
+                frontend_images = []
             
-            # En batch tracking, filtrar para mostrar solo la primera imagen (composición)
-            if saved_images:
-                frontend_images = [saved_images[0]]  # Solo la primera (composición)
-                log_info(f"✅ Batch tracking - Imagen de composición para frontend: {saved_images[0]['filename']}")
+                # En batch tracking, filtrar para mostrar solo la primera imagen (composición)
+                if saved_images:
+                    frontend_images = [saved_images[0]]  # Solo la primera (composición)
+                    log_info("✅ Batch tracking - Imagen de composición para frontend: %s", saved_images[0]['filename'])
             
-            log_info(f"📤 Batch tracking - Para frontend: {len(frontend_images)} imagen(es) de {len(saved_images)} guardadas")
+                log_info("📤 Batch tracking - Para frontend: %s imagen(es) de %s guardadas", len(frontend_images), len(saved_images))
             
-            result = {
-                "workflow_id": workflow_info["id"],
-                "workflow_info": workflow_info,
-                "success": True,
-                "generated_images": frontend_images,  # ✅ SOLO IMÁGENES PARA FRONTEND (composición únicamente)
-                "all_images_saved": saved_images,  # Todas las imágenes guardadas en disco (para debugging)
-                "session_images": session_images,  # URLs de sesión persistentes
-                "original_image": {
-                    "filename": "original.png",
-                    "url": f"/get-image/{base_image_name}/original.png",
-                    "session_url": original_session_url  # URL de sesión para imagen original
-                },
-                "processing_time": round(processing_time, 2),
-                "prompt_id": prompt_id,
-                "completion_time": datetime.now().isoformat()
-            }
+                result = {
+                    "workflow_id": workflow_info["id"],
+                    "workflow_info": workflow_info,
+                    "success": True,
+                    "generated_images": frontend_images,  # ✅ SOLO IMÁGENES PARA FRONTEND (composición únicamente)
+                    "all_images_saved": saved_images,  # Todas las imágenes guardadas en disco (para debugging)
+                    "session_images": session_images,  # URLs de sesión persistentes
+                    "original_image": {
+                        "filename": "original.png",
+                        "url": f"/get-image/{base_image_name}/original.png",
+                        "session_url": original_session_url  # URL de sesión para imagen original
+                    },
+                    "processing_time": round(processing_time, 2),
+                    "prompt_id": prompt_id,
+                    "completion_time_ns": time.time_ns()  # ISO solo al serializar (?iso=1)
+                }
             
-            log_success(f"✅ Completado {index+1}: {workflow_info['id']} en {processing_time:.1f}s ({len(saved_images)} imágenes)")
+                log_success("✅ Completado %d: %s en %.1fs (%d imágenes)", index + 1, workflow_info['id'], processing_time, len(saved_images))
             
-            # *** ACTUALIZAR TRACKING INMEDIATAMENTE CUANDO TERMINA ***
-            with BATCH_LOCK:
-                if batch_id in ACTIVE_BATCHES:
-                    batch_info = ACTIVE_BATCHES[batch_id]
-                    batch_info["completed_workflows"] += 1
-                    batch_info["successful"] += 1
-                    batch_info["results"].append(result)
-                    
-                    # Calcular estimación de tiempo restante
-                    if batch_info["completed_workflows"] > 0:
-                        elapsed_time = time.time() - batch_info["start_time"]
-                        avg_time_per_workflow = elapsed_time / batch_info["completed_workflows"]
-                        remaining_workflows = batch_info["total_workflows"] - batch_info["completed_workflows"]
-                        estimated_remaining = avg_time_per_workflow * remaining_workflows
-                        batch_info["estimated_completion"] = time.time() + estimated_remaining
-                    
-                    batch_info["current_operation"] = f"Completado: {workflow_info['id']} ({batch_info['completed_workflows']}/{batch_info['total_workflows']})"
-            
-            # *** ACTUALIZAR TAMBIÉN EL JOB DE SESIÓN ***
-            if session_job_id:
-                # Obtener estado actual del batch
-                with BATCH_LOCK:
-                    if batch_id in ACTIVE_BATCHES:
-                        batch_info = ACTIVE_BATCHES[batch_id]
-                        session_manager.update_job(session_job_id,
-                            completed_workflows=batch_info["completed_workflows"],
-                            successful=batch_info["successful"],
-                            failed=batch_info["failed"],
-                            current_operation=batch_info["current_operation"],
-                            results=batch_info["results"][:10]  # Solo los últimos 10 para no sobrecargar
-                        )
-            
-            return result
+                # Las URLs de sesión del resultado se publican en /batch-status: esperar a que estén en disco
+                wait_session_writes(session_writes)
             
-        except Exception as e:
-            processing_time = time.time() - workflow_data["submit_time"]
-            log_error(f"❌ Error procesando {workflow_info['id']}: {str(e)}")
+                # *** ACTUALIZAR TRACKING INMEDIATAMENTE CUANDO TERMINA (tracking y sesión los integra el drainer) ***
+                record_batch_result(batch_id, True, result)
             
-            result = {
-                "workflow_id": workflow_info["id"],
-                "workflow_info": workflow_info,
-                "success": False,
-                "error": str(e),
-                "processing_time": round(processing_time, 2),
-                "prompt_id": prompt_id,
-                "completion_time": datetime.now().isoformat()
-            }
+                return result
             
-            # *** ACTUALIZAR TRACKING INMEDIATAMENTE EN CASO DE ERROR ***
-            with BATCH_LOCK:
-                if batch_id in ACTIVE_BATCHES:
-                    batch_info = ACTIVE_BATCHES[batch_id]
-                    batch_info["completed_workflows"] += 1
-                    batch_info["failed"] += 1
-                    batch_info["results"].append(result)
-                    batch_info["current_operation"] = f"Error en: {workflow_info['id']} ({batch_info['completed_workflows']}/{batch_info['total_workflows']})"
-            
-            # *** ACTUALIZAR TAMBIÉN EL JOB DE SESIÓN EN CASO DE ERROR ***
-            if session_job_id:
-                # Obtener estado actual del batch
-                with BATCH_LOCK:
-                    if batch_id in ACTIVE_BATCHES:
-                        batch_info = ACTIVE_BATCHES[batch_id]
-                        session_manager.update_job(session_job_id,
-                            completed_workflows=batch_info["completed_workflows"],
-                            successful=batch_info["successful"],
-                            failed=batch_info["failed"],
-                            current_operation=batch_info["current_operation"],
-                            results=batch_info["results"][:10]  # Solo los últimos 10 para no sobrecargar
-                        )
-            
-            return result
-    
-    # Usar ThreadPoolExecutor para esperar todos los workflows en paralelo
-    max_workers = min(len(submitted_prompts), 10)  # Máximo 10 hilos concurrentes
-    
-    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
-        # Enviar todas las tareas de espera (crear copia de imagen para cada hilo)
-        future_to_prompt = {
-            executor.submit(wait_for_single_workflow_with_tracking, prompt_id, workflow_data, master_image.copy()): prompt_id 
-            for prompt_id, workflow_data in submitted_prompts.items()
-        }
-        
-        # Recoger resultados conforme van completándose
-        for future in concurrent.futures.as_completed(future_to_prompt):
-            prompt_id = future_to_prompt[future]
-            try:
-                result = future.result()
-                results.append(result)
-                completed = len(results)
-                total = len(submitted_prompts)
-                log_info(f"📈 Progreso: {completed}/{total} workflows completados")
             except Exception as e:
-                workflow_data = submitted_prompts[prompt_id]
-                workflow_info = workflow_data["workflow_info"]
-                log_error(f"❌ Error obteniendo resultado de {workflow_info['id']}: {str(e)}")
-                error_result = {
+                processing_time = time.time() - workflow_data["submit_time"]
+                log_exception("❌ Error procesando %s: %s", workflow_info['id'], e)
+            
+                result = {
                     "workflow_id": workflow_info["id"],
                     "workflow_info": workflow_info,
                     "success": False,
-                    "error": f"Error obteniendo resultado: {str(e)}",
-                    "processing_time": 0,
-                    "prompt_id": prompt_id
+                    "error": str(e),
+                    "processing_time": round(processing_time, 2),
+                    "prompt_id": prompt_id,
+                    "completion_time_ns": time.time_ns()  # ISO solo al serializar (?iso=1)
                 }
-                results.append(error_result)
+            
+                # *** ACTUALIZAR TRACKING INMEDIATAMENTE EN CASO DE ERROR (tracking y sesión los integra el drainer) ***
+                record_batch_result(batch_id, False, result)
+            
+                return result
+    
+        # Un único bucle espera todos los prompts; los hilos solo procesan resultados ya terminados
+        max_workers = min(len(submitted_prompts), MAX_WAIT_WORKERS)  # Configurable con SWITCH_MAX_WAIT_WORKERS
+    
+        total = len(submitted_prompts)
+        completed_count = 0
+        
+        def collect_results(done):
+            """Integra en results un grupo de futures terminados y registra el progreso"""
+            nonlocal completed_count
+            for future in done:
+                prompt_id, index = future.prompt_id, future.index
+                # El worker ya captura sus propios errores: exception() evita relanzar/desenrollar en el caso normal
+                e = future.exception()
+                if e is None:
+                    results[index] = future.result()
+                else:
+                    workflow_data = submitted_prompts[prompt_id]
+                    workflow_info = workflow_data["workflow_info"]
+                    log_error("❌ Error obteniendo resultado de %s: %r", workflow_info['id'], e)
+                    error_result = {
+                        "workflow_id": workflow_info["id"],
+                        "workflow_info": workflow_info,
+                        "success": False,
+                        "error": f"Error obteniendo resultado: {str(e)}",
+                        "processing_time": 0,
+                        "prompt_id": prompt_id
+                    }
+                    results[index] = error_result
+                    
+                    # Actualizar tracking
+                    record_batch_result(batch_id, False, error_result)
+            
+            completed_count += len(done)
+            log_info("📈 Progreso: %d/%d workflows completados (+%d)", completed_count, total, len(done))
+        
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+            # Cada Future lleva su prompt_id e índice como atributos (sin dict Future -> prompt_id)
+            pending = set()
+            wait_timeout = 60000
+            timeout_error = PROMPT_TIMEOUT_ERROR.format(timeout=wait_timeout)
+            timed_out = 0  # Prompts sin terminar: ComfyUI aún puede leer la imagen de entrada
+            for prompt_id, outputs, error in iter_completed_prompts(submitted_prompts, timeout=wait_timeout, client_id=batch_client_id):
+                if error == timeout_error:
+                    timed_out += 1
+                workflow_data = submitted_prompts[prompt_id]
+                future = executor.submit(process_completed_workflow_with_tracking, prompt_id, workflow_data, outputs, error)
+                future.prompt_id = prompt_id
+                future.index = workflow_data["index"]
+                pending.add(future)
                 
-                # Actualizar tracking
-                with BATCH_LOCK:
-                    if batch_id in ACTIVE_BATCHES:
-                        batch_info = ACTIVE_BATCHES[batch_id]
-                        batch_info["completed_workflows"] += 1
-                        batch_info["failed"] += 1
-                        batch_info["results"].append(error_result)
-    
-    # Ordenar resultados por el índice original para mantener orden
-    results.sort(key=lambda x: next(
-        (data["index"] for prompt_id, data in submitted_prompts.items() 
-         if x.get("prompt_id") == prompt_id), 999
-    ))
+                # Recoger sin bloquear lo ya procesado: el progreso se registra mientras ComfyUI sigue trabajando
+                done, pending = concurrent.futures.wait(pending, timeout=0)
+                if done:
+                    collect_results(done)
+            
+            # Todos los prompts terminaron en ComfyUI: esperar a los hilos que aún guardan resultados
+            if pending:
+                collect_results(concurrent.futures.wait(pending).done)
+    finally:
+        # El archivo canónico ya está enlazado/copiado en la carpeta de salida; se borra también
+        # si la fase 2 falla a medias
+        remove_batch_original(original_future)
+    
+    # Si todos los prompts terminaron, ComfyUI ya no necesita la imagen de entrada compartida
+    # (con prompts sin terminar se deja: alguno puede seguir en la cola de ComfyUI)
+    if timed_out:
+        log_warning("⚠️ %d prompts sin terminar: se conserva la imagen de entrada %s", timed_out, shared_input_filename)
+    else:
+        remove_file_quietly(shared_input_path)
     
     return results
 
@@ -3219,9 +4088,11 @@ def cancel_specific_job(prompt_id):
 # ==================== INICIO DEL SERVIDOR ====================
 
 if __name__ == '__main__':
-    import os
+    debug_mode = os.getenv('DEBUG', 'False').lower() == 'true'
+    api_port = int(os.getenv('API_PORT', '5000'))
+    
     # Solo ejecutar el arranque si es el proceso principal del reloader
-    if os.environ.get('WERKZEUG_RUN_MAIN') == 'true' or not app.debug:
+    if os.environ.get('WERKZEUG_RUN_MAIN') == 'true' or not debug_mode:
         log_info("🚀 Iniciando ComfyUI API REST v2.0.0...")
         log_info(f"📁 Directorio de workflows: {WORKFLOWS_DIR}")
         log_info(f"📁 Directorio de input: {COMFYUI_INPUT_DIR}")
@@ -3229,7 +4100,7 @@ if __name__ == '__main__':
         log_info(f"🌐 ComfyUI URL: {COMFYUI_URL}")
         # Verificar conexión con ComfyUI
         try:
-            response = requests.get(f"{COMFYUI_URL}/system_stats", timeout=5)
+            response = COMFYUI_SESSION.get(f"{COMFYUI_URL}/system_stats", timeout=5)
             if response.status_code == 200:
                 log_success("Conexión exitosa con ComfyUI")
             else:
@@ -3238,16 +4109,24 @@ if __name__ == '__main__':
             log_warning(f"⚠️ No se pudo conectar con ComfyUI: {str(e)}")
         # Contar workflows disponibles
         try:
-            workflows = []
-            if os.path.exists(WORKFLOWS_DIR):
-                for root, dirs, files in os.walk(WORKFLOWS_DIR):
-                    for filename in files:
-                        if filename.endswith('.json'):
-                            workflows.append(filename)
-            log_info(f"📊 {len(workflows)} workflows encontrados")
+            log_info(f"📊 {len(get_workflow_catalog()['list'])} workflows encontrados")
         except Exception as e:
             log_warning(f"⚠️ Error contando workflows: {str(e)}")
-        # Iniciar servidor
-        log_info("🌟 Servidor iniciado en http://localhost:5000")
-        log_info("📱 Cliente web disponible en: http://localhost:5000")
-        app.run(host='0.0.0.0', port=5000, debug=True)
+        log_info(f"🌟 Servidor iniciado en http://localhost:{api_port}")
+        log_info(f"📱 Cliente web disponible en: http://localhost:{api_port}")
+    
+    # Iniciar servidor: el servidor de desarrollo (debugger + reloader) solo con DEBUG=True
+    if debug_mode:
+        app.run(host='0.0.0.0', port=api_port, debug=True)
+    else:
+        try:
+            from waitress import serve
+        except ImportError:
+            serve = None
+        
+        if serve:
+            log_info("🏭 Servidor de producción: waitress (32 hilos)")
+            serve(app, host='0.0.0.0', port=api_port, threads=32)
+        else:
+            log_warning("waitress no instalado (pip install waitress): usando servidor Flask multihilo sin debug")
+            app.run(host='0.0.0.0', port=api_port, debug=False, threaded=True)
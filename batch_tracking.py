@@ -0,0 +1,287 @@
+#!/usr/bin/env python3
+"""
+Tracking en memoria de batches en progreso (camino caliente de las completions)
+
+Módulo separado y con tipos para poder compilarlo con mypyc sin tocar el resto de la API
+(comprobado con mypy 2.4 / CPython 3.11):
+    pip install mypy
+    python build_batch_tracking.py
+Si existe la extensión compilada (batch_tracking.*.so / .pyd) Python la importa en lugar
+de este archivo; sin compilar funciona igual en Python puro. Tras editar este archivo hay
+que recompilar (o borrar la extensión): si no, se sigue importando la versión anterior.
+"""
+import os
+import threading
+from collections import OrderedDict, deque
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional, Tuple
+
+from job_persistence import session_manager
+
+# Batches en progreso repartidos en shards (lock + dict por shard)
+# El lock del shard solo se toma para altas/bajas; buscar un batch es un dict.get sin lock
+# Cada batch tiene su propio lock (BatchInfo.lock) para los cambios compuestos del drainer
+# (contadores + results) y para sacar una foto coherente en /batch-status: los polls de un batch
+# no compiten con los de otros batches. Lecturas simples y asignaciones de un campo van sin lock
+# (atómicas con el GIL): un lector puede ver una actualización a medias, nunca un objeto corrupto
+BATCH_SHARD_COUNT = 16  # Potencia de 2
+BATCH_LOCKS: List[threading.Lock] = [threading.Lock() for _ in range(BATCH_SHARD_COUNT)]
+ACTIVE_BATCHES_SHARDS: List[Dict[str, "BatchInfo"]] = [{} for _ in range(BATCH_SHARD_COUNT)]
+
+# Batches terminados: fuera de los shards activos, acotados (los más antiguos se descartan;
+# siguen disponibles desde el sistema de sesión, que ya los persiste en disco)
+COMPLETED_BATCHES: "OrderedDict[str, BatchInfo]" = OrderedDict()
+COMPLETED_BATCHES_LOCK = threading.Lock()
+MAX_COMPLETED_BATCHES = int(os.getenv("SWITCH_MAX_COMPLETED_BATCHES", "50"))
+
+# Textos de 'current_operation': el estado se guarda estructurado en BatchInfo.current_op
+# y solo se formatea al leerlo (/batch-status, sesión), no en cada completion
+CURRENT_OP_TEMPLATES: Dict[str, str] = {
+    "sending": "Enviando {done}/{total}: {id} (⚡ {elapsed:.1f}s)",
+    "processing": "Procesando: {id}",
+    "done": "Completado: {id} ({done}/{total})",
+    "error": "Error en: {id} ({done}/{total})",
+}
+
+def format_current_op(current_op: Dict[str, Any]) -> str:
+    """Convierte el estado estructurado current_op en el texto de current_operation"""
+    return CURRENT_OP_TEMPLATES[current_op["state"]].format(**current_op)
+
+@dataclass(slots=True)
+class BatchInfo:
+    """
+    Estado en memoria de un batch (valor de ACTIVE_BATCHES_SHARDS / COMPLETED_BATCHES)
+    Atributos con slots: el camino de completado accede por offset, no por hash de claves
+    """
+    batch_id: str
+    total_workflows: int
+    session_job_id: Optional[str] = None  # Referencia al job de sesión
+    status: str = "starting"
+    completed_workflows: int = 0
+    successful: int = 0
+    failed: int = 0
+    results: List[Dict[str, Any]] = field(default_factory=list)
+    start_time: float = 0.0
+    estimated_completion: Optional[float] = None
+    current_operation: str = "Iniciando procesamiento..."
+    current_op: Optional[Dict[str, Any]] = None  # Estado estructurado; se formatea al serializar
+    workflow_list: List[str] = field(default_factory=list)
+    error: Optional[str] = None
+    total_processing_time: Optional[float] = None
+    final_results: Optional[List[Dict[str, Any]]] = None
+    # Internos del drainer: nunca se serializan
+    pending_updates: deque = field(default_factory=deque)
+    drain_event: threading.Event = field(default_factory=threading.Event)
+    lock: threading.Lock = field(default_factory=threading.Lock)
+    # Versión visible del batch: sube con cada cambio (ETag y long-poll de /batch-status)
+    version: int = 0
+    changed: threading.Condition = field(default_factory=threading.Condition)
+    # Última respuesta de /batch-status serializada: (versión, ?iso, body)
+    status_body: Optional[Tuple[int, bool, bytes]] = None
+
+    def to_dict(self) -> Dict[str, Any]:
+        """Foto serializable para /batch-status (llamar con self.lock tomado)"""
+        data: Dict[str, Any] = {
+            "batch_id": self.batch_id,
+            "session_job_id": self.session_job_id,
+            "status": self.status,
+            "total_workflows": self.total_workflows,
+            "completed_workflows": self.completed_workflows,
+            "successful": self.successful,
+            "failed": self.failed,
+            "results": list(self.results),
+            "start_time": self.start_time,
+            "estimated_completion": self.estimated_completion,
+            "current_operation": format_current_op(self.current_op) if self.current_op else self.current_operation,
+            "workflow_list": self.workflow_list
+        }
+        # Campos opcionales: solo aparecen cuando tienen valor
+        if self.error is not None:
+            data["error"] = self.error
+        if self.total_processing_time is not None:
+            data["total_processing_time"] = self.total_processing_time
+        if self.final_results is not None:
+            data["final_results"] = self.final_results
+        return data
+
+def batch_shard(batch_id: str) -> Tuple[threading.Lock, Dict[str, BatchInfo]]:
+    """Retorna (lock, dict de batches activos) del shard al que pertenece batch_id"""
+    index = hash(batch_id) & (BATCH_SHARD_COUNT - 1)
+    return BATCH_LOCKS[index], ACTIVE_BATCHES_SHARDS[index]
+
+def get_active_batch(batch_id: str) -> Optional[BatchInfo]:
+    """Batch activo o None (lectura simple de dict, sin lock)"""
+    return batch_shard(batch_id)[1].get(batch_id)
+
+def find_batch(batch_id: str) -> Optional[BatchInfo]:
+    """Batch activo o terminado reciente, o None (sin locks: dos dict.get)"""
+    batch_info = get_active_batch(batch_id)
+    if batch_info is None:
+        batch_info = COMPLETED_BATCHES.get(batch_id)
+    return batch_info
+
+def bump_batch_version(batch_info: BatchInfo) -> None:
+    """Marca un cambio visible del batch y despierta a los long-polls de /batch-status que lo esperan"""
+    with batch_info.changed:
+        batch_info.version += 1
+        batch_info.changed.notify_all()
+
+def wait_batch_change(batch_info: BatchInfo, seen_version: int, timeout: float) -> int:
+    """
+    Espera (hasta timeout segundos) a que la versión del batch deje de ser seen_version
+    Retorna: la versión actual (igual a seen_version si no hubo cambios)
+    """
+    with batch_info.changed:
+        batch_info.changed.wait_for(lambda: batch_info.version != seen_version, timeout)
+        return batch_info.version
+
+def set_current_op(batch_info: BatchInfo, current_op: Dict[str, Any]) -> None:
+    """Reemplaza current_op (una sola asignación, atómica con el GIL) y publica el cambio"""
+    batch_info.current_op = current_op
+    bump_batch_version(batch_info)
+
+def batch_snapshot(batch_id: str) -> Optional[Dict[str, Any]]:
+    """Foto de un batch para /batch-status tomando solo el lock de ese batch, o None si no está en memoria"""
+    batch_info = find_batch(batch_id)
+    if batch_info is None:
+        return None
+    with batch_info.lock:
+        return batch_info.to_dict()
+
+def register_batch(batch_info: BatchInfo) -> None:
+    """Da de alta un batch en su shard (el lock solo cubre la inserción)"""
+    lock, shard = batch_shard(batch_info.batch_id)
+    with lock:
+        shard[batch_info.batch_id] = batch_info
+
+def set_batch_fields(batch_id: str, **fields: Any) -> Optional[BatchInfo]:
+    """
+    Asigna campos de un batch activo sin tomar el lock de su shard
+    Se asignan en el orden recibido: pasar el estado ('status') el último
+    Retorna: el batch, o None si ya no está activo
+    """
+    batch_info = get_active_batch(batch_id)
+    if batch_info is not None:
+        for name, value in fields.items():
+            setattr(batch_info, name, value)
+        bump_batch_version(batch_info)
+    return batch_info
+
+def snapshot_active_batches() -> Dict[str, BatchInfo]:
+    """Copia de todos los batches activos sin locks (dict.copy es atómico con el GIL)"""
+    batches: Dict[str, BatchInfo] = {}
+    for shard in ACTIVE_BATCHES_SHARDS:
+        batches.update(shard.copy())
+    return batches
+
+def remove_batch(batch_id: str) -> Optional[BatchInfo]:
+    """Quita un batch del tracking (activo o terminado); retorna el batch quitado o None"""
+    lock, shard = batch_shard(batch_id)
+    with lock:
+        batch_info = shard.pop(batch_id, None)
+    if batch_info is None:
+        with COMPLETED_BATCHES_LOCK:
+            batch_info = COMPLETED_BATCHES.pop(batch_id, None)
+    return batch_info
+
+def retire_batch(batch_id: str) -> None:
+    """
+    Mueve un batch terminado de su shard activo a COMPLETED_BATCHES (acotado, FIFO)
+    Mantiene los shards activos pequeños para el camino caliente
+    """
+    lock, shard = batch_shard(batch_id)
+    with lock:
+        batch_info = shard.pop(batch_id, None)
+    if batch_info is None:
+        return
+    with COMPLETED_BATCHES_LOCK:
+        COMPLETED_BATCHES[batch_id] = batch_info
+        while len(COMPLETED_BATCHES) > MAX_COMPLETED_BATCHES:
+            COMPLETED_BATCHES.popitem(last=False)
+
+def record_batch_result(batch_id: str, ok: bool, result: Dict[str, Any]) -> None:
+    """
+    Encola el resultado de un workflow SIN tomar el lock del shard (deque.append es thread-safe)
+    El hilo drainer del batch lo integra en batch_info
+    """
+    batch_info = get_active_batch(batch_id)
+    if batch_info is None:
+        return
+    batch_info.pending_updates.append((ok, result))
+    batch_info.drain_event.set()
+
+def drain_batch_updates(batch_info: BatchInfo, session_job_id: Optional[str]) -> None:
+    """
+    Hilo drainer de un batch: integra los resultados encolados por los workers
+    Una adquisición del lock del batch y una escritura de sesión por ciclo (no por workflow)
+    La ETA no se calcula aquí: se deriva al consultar /batch-status
+    Termina al recibir el centinela None de stop_batch_drainer
+    """
+    pending = batch_info.pending_updates
+    drain_event = batch_info.drain_event
+    lock = batch_info.lock
+    stopping = False
+
+    while not stopping:
+        drain_event.wait()
+        drain_event.clear()
+
+        updates: List[Tuple[bool, Dict[str, Any]]] = []
+        while pending:
+            item = pending.popleft()
+            if item is None:
+                stopping = True
+            else:
+                updates.append(item)
+
+        if not updates:
+            continue
+
+        # Bajo el lock solo los contadores y el append; se toma una foto de los contadores
+        with lock:
+            for ok, result in updates:
+                batch_info.completed_workflows += 1
+                if ok:
+                    batch_info.successful += 1
+                else:
+                    batch_info.failed += 1
+                batch_info.results.append(result)
+            completed = batch_info.completed_workflows
+            successful = batch_info.successful
+            failed = batch_info.failed
+
+        # Fuera del lock: current_op se reemplaza con una sola asignación (atómica con el GIL)
+        last_ok, last_result = updates[-1]
+        current_op: Dict[str, Any] = {
+            "state": "done" if last_ok else "error",
+            "id": last_result["workflow_id"],
+            "done": completed,
+            "total": batch_info.total_workflows
+        }
+        set_current_op(batch_info, current_op)
+
+        # *** ACTUALIZAR TAMBIÉN EL JOB DE SESIÓN (fuera del lock) ***
+        if session_job_id:
+            session_manager.update_job(session_job_id,
+                completed_workflows=completed,
+                successful=successful,
+                failed=failed,
+                current_operation=format_current_op(current_op),
+                results=batch_info.results[:10]  # Solo los últimos 10 para no sobrecargar
+            )
+
+def start_batch_drainer(batch_info: BatchInfo, session_job_id: Optional[str]) -> threading.Thread:
+    """Arranca el hilo drainer de un batch"""
+    thread = threading.Thread(target=drain_batch_updates, args=(batch_info, session_job_id))
+    thread.daemon = True
+    thread.start()
+    return thread
+
+def stop_batch_drainer(batch_info: BatchInfo, thread: threading.Thread) -> None:
+    """
+    Vacía las actualizaciones pendientes y espera a que el drainer termine
+    Recibe batch_info directamente: funciona aunque el batch ya se haya quitado del tracking
+    """
+    batch_info.pending_updates.append(None)
+    batch_info.drain_event.set()
+    thread.join()
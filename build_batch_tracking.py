@@ -0,0 +1,36 @@
+#!/usr/bin/env python3
+"""
+Script para compilar batch_tracking.py con mypyc (opcional)
+Deja batch_tracking.*.so / .pyd junto al código: Python importa la extensión en lugar del .py
+Requiere: pip install mypy (y un compilador de C). Para volver a Python puro, borrar la extensión
+"""
+import glob
+import os
+import shutil
+import subprocess
+import sys
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+def build_batch_tracking():
+    """Compila batch_tracking.py y comprueba que la extensión se importa"""
+    print("🔧 Compilando batch_tracking.py con mypyc...")
+    result = subprocess.run([sys.executable, '-m', 'mypyc', 'batch_tracking.py'], cwd=BASE_DIR)
+    # Temporales de la compilación (el .so ya está copiado junto al código)
+    shutil.rmtree(os.path.join(BASE_DIR, 'build'), ignore_errors=True)
+    if result.returncode != 0:
+        print("❌ mypyc falló: se sigue usando batch_tracking.py en Python puro")
+        return False
+
+    extensions = glob.glob(os.path.join(BASE_DIR, 'batch_tracking.*.so')) + glob.glob(os.path.join(BASE_DIR, 'batch_tracking.*.pyd'))
+    check = subprocess.run([sys.executable, '-c', 'import batch_tracking; print(batch_tracking.__file__)'],
+                           cwd=BASE_DIR, capture_output=True, text=True)
+    if check.returncode != 0 or not check.stdout.strip().endswith(('.so', '.pyd')):
+        print(f"❌ La extensión no se importa correctamente: {check.stderr.strip() or check.stdout.strip()}")
+        return False
+
+    print(f"✅ Extensión compilada: {', '.join(os.path.basename(path) for path in extensions)}")
+    return True
+
+if __name__ == "__main__":
+    sys.exit(0 if build_batch_tracking() else 1)
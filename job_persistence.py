@@ -7,6 +7,7 @@ import os
 import json
 import uuid
 import shutil
+import threading
 import time
 from datetime import datetime, timedelta
 from typing import Dict, List, Optional
@@ -16,6 +17,11 @@ class SessionJobManager:
         self.base_dir = base_dir or os.path.dirname(os.path.abspath(__file__))
         self.session_dir = os.path.join(self.base_dir, 'session_jobs')
         self.session_file = os.path.join(self.base_dir, 'active_jobs.json')
+        # Serializa el acceso a active_jobs.json entre hilos (drainers, /batch-status, peticiones):
+        # cada leer-modificar-guardar es atómico (sin actualizaciones perdidas) y en Windows ningún
+        # hilo tiene el archivo abierto mientras otro hace os.replace (daría PermissionError)
+        # Reentrante: los métodos que toman el lock llaman a _load/_save, que también lo toman
+        self._jobs_lock = threading.RLock()
         
         # Crear directorio de sesión
         os.makedirs(self.session_dir, exist_ok=True)
@@ -28,17 +34,29 @@ class SessionJobManager:
             self._save_active_jobs({})
     
     def _save_active_jobs(self, jobs: Dict):
-        """Guarda los trabajos activos en memoria"""
-        with open(self.session_file, 'w', encoding='utf-8') as f:
-            json.dump(jobs, f, indent=2, ensure_ascii=False, default=str)
+        """
+        Guarda los trabajos activos en memoria
+        Escritura atómica (temporal + os.replace): un lector nunca ve el archivo a medio escribir
+        """
+        tmp_path = f"{self.session_file}.{uuid.uuid4().hex}.tmp"
+        with self._jobs_lock:
+            try:
+                with open(tmp_path, 'w', encoding='utf-8') as f:
+                    json.dump(jobs, f, indent=2, ensure_ascii=False, default=str)
+                os.replace(tmp_path, self.session_file)
+            except BaseException:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+                raise
     
     def _load_active_jobs(self) -> Dict:
         """Carga los trabajos activos"""
-        try:
-            with open(self.session_file, 'r', encoding='utf-8') as f:
-                return json.load(f)
-        except (FileNotFoundError, json.JSONDecodeError):
-            return {}
+        with self._jobs_lock:
+            try:
+                with open(self.session_file, 'r', encoding='utf-8') as f:
+                    return json.load(f)
+            except (FileNotFoundError, json.JSONDecodeError):
+                return {}
     
     def create_job(self, job_type: str = 'individual', **config) -> str:
         """Crea un nuevo trabajo y devuelve su ID"""
@@ -57,28 +75,30 @@ class SessionJobManager:
         }
         
         # Guardar en memoria activa
-        active_jobs = self._load_active_jobs()
-        active_jobs[job_id] = job_data
-        self._save_active_jobs(active_jobs)
+        with self._jobs_lock:
+            active_jobs = self._load_active_jobs()
+            active_jobs[job_id] = job_data
+            self._save_active_jobs(active_jobs)
         
         return job_id
     
     def update_job(self, job_id: str, **updates) -> bool:
         """Actualiza un trabajo existente"""
-        active_jobs = self._load_active_jobs()
-        
-        if job_id not in active_jobs:
-            return False
-        
-        # Actualizar campos
-        for key, value in updates.items():
-            active_jobs[job_id][key] = value
-        
-        # Marcar tiempo de completado si es necesario
-        if updates.get('status') == 'completed':
-            active_jobs[job_id]['completed_at'] = datetime.now().isoformat()
-        
-        self._save_active_jobs(active_jobs)
+        with self._jobs_lock:
+            active_jobs = self._load_active_jobs()
+            
+            if job_id not in active_jobs:
+                return False
+            
+            # Actualizar campos
+            for key, value in updates.items():
+                active_jobs[job_id][key] = value
+            
+            # Marcar tiempo de completado si es necesario
+            if updates.get('status') == 'completed':
+                active_jobs[job_id]['completed_at'] = datetime.now().isoformat()
+            
+            self._save_active_jobs(active_jobs)
         return True
     
     def get_job(self, job_id: str) -> Optional[Dict]:
@@ -99,19 +119,24 @@ class SessionJobManager:
     
     def delete_job(self, job_id: str) -> bool:
         """Elimina un trabajo de la sesión"""
-        active_jobs = self._load_active_jobs()
-        
-        if job_id in active_jobs:
+        with self._jobs_lock:
+            active_jobs = self._load_active_jobs()
+            if job_id not in active_jobs:
+                return False
             del active_jobs[job_id]
             self._save_active_jobs(active_jobs)
-            
-            # Limpiar archivos asociados si existen
-            job_dir = os.path.join(self.session_dir, job_id)
-            if os.path.exists(job_dir):
-                shutil.rmtree(job_dir)
-            
-            return True
-        return False
+        
+        # Limpiar archivos asociados si existen (fuera del lock)
+        job_dir = os.path.join(self.session_dir, job_id)
+        if os.path.exists(job_dir):
+            shutil.rmtree(job_dir)
+        
+        return True
+    
+    @staticmethod
+    def job_image_url(job_id: str, filename: str) -> str:
+        """Ruta del frontend para una imagen de trabajo (no depende de que ya esté escrita)"""
+        return f"/session/images/{job_id}/{filename}"
     
     def save_job_image(self, job_id: str, image_data: bytes, filename: str) -> str:
         """Guarda una imagen asociada a un trabajo"""
@@ -123,7 +148,7 @@ class SessionJobManager:
             f.write(image_data)
         
         # Devolver ruta correcta para el frontend
-        return f"/session/images/{job_id}/{filename}"
+        return self.job_image_url(job_id, filename)
     
     def get_job_images(self, job_id: str) -> List[str]:
         """Obtiene las rutas de todas las imágenes de un trabajo"""
@@ -141,25 +166,26 @@ class SessionJobManager:
     def cleanup_old_jobs(self, hours: int = 24):
         """Limpia trabajos más antiguos que X horas (por defecto 24h)"""
         cutoff_time = datetime.now() - timedelta(hours=hours)
-        active_jobs = self._load_active_jobs()
-        cleaned_jobs = {}
-        
-        for job_id, job_data in active_jobs.items():
-            try:
-                created_time = datetime.fromisoformat(job_data['created_at'])
-                if created_time > cutoff_time:
+        with self._jobs_lock:
+            active_jobs = self._load_active_jobs()
+            cleaned_jobs = {}
+            
+            for job_id, job_data in active_jobs.items():
+                try:
+                    created_time = datetime.fromisoformat(job_data['created_at'])
+                    if created_time > cutoff_time:
+                        cleaned_jobs[job_id] = job_data
+                    else:
+                        # Eliminar archivos del trabajo antiguo
+                        job_dir = os.path.join(self.session_dir, job_id)
+                        if os.path.exists(job_dir):
+                            shutil.rmtree(job_dir)
+                except (ValueError, KeyError):
+                    # Mantener trabajos con fecha inválida (probablemente recientes)
                     cleaned_jobs[job_id] = job_data
-                else:
-                    # Eliminar archivos del trabajo antiguo
-                    job_dir = os.path.join(self.session_dir, job_id)
-                    if os.path.exists(job_dir):
-                        shutil.rmtree(job_dir)
-            except (ValueError, KeyError):
-                # Mantener trabajos con fecha inválida (probablemente recientes)
-                cleaned_jobs[job_id] = job_data
-        
-        # Guardar solo los trabajos limpios
-        self._save_active_jobs(cleaned_jobs)
+            
+            # Guardar solo los trabajos limpios
+            self._save_active_jobs(cleaned_jobs)
         
         return len(active_jobs) - len(cleaned_jobs)
     
@@ -205,11 +231,12 @@ class SessionJobManager:
         """Limpia completamente toda la sesión - todos los trabajos e imágenes"""
         try:
             # Obtener conteo actual antes de limpiar
-            active_jobs = self._load_active_jobs()
-            job_count = len(active_jobs)
-            
-            # Limpiar archivo de trabajos activos
-            self._save_active_jobs({})
+            with self._jobs_lock:
+                active_jobs = self._load_active_jobs()
+                job_count = len(active_jobs)
+                
+                # Limpiar archivo de trabajos activos
+                self._save_active_jobs({})
             
             # Limpiar completamente el directorio de sesión
             if os.path.exists(self.session_dir):